@@ -1,4 +1,5 @@
 from flask import Flask
+from qa327.pool import engine_options
 import os
 
 """
@@ -17,6 +18,100 @@ templates = os.path.join(
 app = Flask('this is a simple web application', template_folder=templates)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = '69cae04b04756f65eabcd2c5a11c8c24'
+# number of tickets shown on each page of the profile page
+app.config['TICKETS_PER_PAGE'] = 25
+# bulk imports commit this many tickets at a time, and report
+# the errors of at most this many rows
+app.config['IMPORT_BATCH_SIZE'] = 500
+app.config['IMPORT_MAX_ERRORS'] = 1000
+# logged in users are cached in each process for up to USER_CACHE_TTL
+# seconds, so balance changes made by other processes show up after that
+app.config['USER_CACHE_SIZE'] = 10000
+app.config['USER_CACHE_TTL'] = 5
+# rendered ticket lists are rebuilt whenever the tickets change,
+# the TTL only bounds how long unused pages are kept
+app.config['TICKET_LIST_CACHE_SIZE'] = 1000
+app.config['TICKET_LIST_CACHE_TTL'] = 3600
+# responses smaller than COMPRESS_MIN_SIZE bytes are sent uncompressed,
+# larger ones are compressed at these (fast) levels
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 4
+# /search returns SEARCH_LIMIT tickets unless asked for more, and never
+# more than SEARCH_MAX_LIMIT; results are ranked among the first
+# SEARCH_CANDIDATES matches, which keeps one-letter prefixes fast
+app.config['SEARCH_LIMIT'] = 20
+app.config['SEARCH_MAX_LIMIT'] = 100
+app.config['SEARCH_CANDIDATES'] = 200
+# /api/tickets pages hold at most API_MAX_PAGE_SIZE tickets, and exports
+# read EXPORT_PAGE_SIZE tickets per query while they stream
+app.config['API_MAX_PAGE_SIZE'] = 100
+app.config['EXPORT_PAGE_SIZE'] = 1000
+# /events/tickets pushes ticket changes to at most EVENTS_MAX_CLIENTS
+# clients per process. Under the production server each client holds a
+# thread, so the default leaves half of WEB_THREADS for other requests.
+# Changes are looked for every EVENTS_POLL_INTERVAL seconds, and clients
+# are told to reload the list instead when more than EVENTS_MAX_CHANGES
+# tickets changed at once or more than EVENTS_QUEUE_SIZE events are
+# waiting for them. The change log keeps TICKET_CHANGE_LOG_SIZE versions.
+app.config['EVENTS_MAX_CLIENTS'] = int(os.getenv(
+    'EVENTS_MAX_CLIENTS', max(1, int(os.getenv('WEB_THREADS', 4)) // 2)))
+app.config['EVENTS_POLL_INTERVAL'] = float(os.getenv('EVENTS_POLL_INTERVAL', 1))
+app.config['EVENTS_HEARTBEAT'] = 15
+app.config['EVENTS_RETRY_MS'] = 3000
+app.config['EVENTS_MAX_CHANGES'] = 50
+app.config['EVENTS_QUEUE_SIZE'] = 100
+app.config['TICKET_CHANGE_LOG_SIZE'] = 1000
+# read replicas, see qa327/replicas.py: a comma separated list of database
+# URLs. Replicas more than REPLICA_MAX_LAG seconds behind are left out, and
+# users read from the primary for REPLICA_STICKY_SECONDS after they write.
+app.config['REPLICA_URLS'] = [url.strip() for url in os.getenv(
+    'REPLICA_URLS', '').split(',') if url.strip()]
+app.config['REPLICA_MAX_LAG'] = float(os.getenv('REPLICA_MAX_LAG', 5))
+app.config['REPLICA_CHECK_INTERVAL'] = float(os.getenv('REPLICA_CHECK_INTERVAL', 1))
+app.config['REPLICA_STICKY_SECONDS'] = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
+# login and registration attempts, see qa327/ratelimit.py: every client
+# address and every email gets a bucket of BURST attempts, refilled at
+# PER_MINUTE attempts a minute, kept in RATE_LIMIT_STORE
+app.config['RATE_LIMIT'] = os.getenv('RATE_LIMIT', '1') == '1'
+app.config['RATE_LIMIT_STORE'] = os.getenv('RATE_LIMIT_STORE', 'memory://')
+app.config['RATE_LIMIT_IP_BURST'] = int(os.getenv('RATE_LIMIT_IP_BURST', 30))
+app.config['RATE_LIMIT_IP_PER_MINUTE'] = float(os.getenv('RATE_LIMIT_IP_PER_MINUTE', 30))
+app.config['RATE_LIMIT_EMAIL_BURST'] = int(os.getenv('RATE_LIMIT_EMAIL_BURST', 10))
+app.config['RATE_LIMIT_EMAIL_PER_MINUTE'] = float(os.getenv('RATE_LIMIT_EMAIL_PER_MINUTE', 2))
+# holds set tickets aside for HOLD_TTL seconds while a user checks out,
+# each process releases the expired ones every HOLD_SWEEP_INTERVAL seconds,
+# HOLD_SWEEP_BATCH per transaction
+app.config['HOLD_TTL'] = int(os.getenv('HOLD_TTL', 600))
+app.config['HOLD_SWEEP_INTERVAL'] = float(os.getenv('HOLD_SWEEP_INTERVAL', 5))
+app.config['HOLD_SWEEP_BATCH'] = 500
+# worker processes share their request metrics through snapshot files
+# in METRICS_DIR, written every METRICS_FLUSH_INTERVAL seconds
+app.config['METRICS_DIR'] = os.getenv('METRICS_DIR')
+app.config['METRICS_FLUSH_INTERVAL'] = float(
+    os.getenv('METRICS_FLUSH_INTERVAL', 2))
+# SQL_PROFILER=1 records the queries of every request, see qa327/profiler.py,
+# and logs those slower than SLOW_QUERY_MS to SLOW_QUERY_LOG if it is set
+app.config['SQL_PROFILER'] = os.getenv('SQL_PROFILER') == '1'
+app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', 100))
+app.config['SLOW_QUERY_LOG'] = os.getenv('SLOW_QUERY_LOG')
+# algorithm and work factor for new password hashes, hashes made with
+# anything else are upgraded the next time their user logs in
+app.config['PASSWORD_HASH_METHOD'] = os.getenv(
+    'PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+app.config['PASSWORD_HASH_ITERATIONS'] = int(
+    os.getenv('PASSWORD_HASH_ITERATIONS', 150000))
+# at most this many hashes run at once in each process, by default the
+# cores shared out between the production workers, and at most
+# PASSWORD_HASH_QUEUE more requests wait for a turn before logins are
+# turned away. Hashing never holds more than PASSWORD_HASH_THREADS server
+# threads, one less than WEB_THREADS, so other routes always get a thread.
+hash_processes = int(os.getenv('WEB_WORKERS', 2 * (os.cpu_count() or 1) + 1)) \
+    if os.getenv('SERVER_MODE') == 'production' else 1
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv(
+    'PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 1) // hash_processes)))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.getenv('PASSWORD_HASH_QUEUE', 32))
+app.config['PASSWORD_HASH_THREADS'] = max(1, int(os.getenv('WEB_THREADS', 4)) - 1)
 # if the user supplies a database file name, we use
 # that instead, and it should an absolute path
 # for windows user, C:\ is the root directory, so it
@@ -32,3 +127,11 @@ else:
     # db.sqlite at the working directory
     database_url = 'sqlite:///db.sqlite'
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+# server databases get a sized, self-healing connection pool,
+# see qa327/pool.py for the DB_POOL_* settings
+if not database_url.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(os.environ)
+# SQLITE_TUNING=1 turns on the SQLite performance profile,
+# see qa327/sqlite_tuning.py for what it does and its SQLITE_* settings
+app.config['SQLITE_TUNING'] = database_url.startswith('sqlite') and \
+    os.getenv('SQLITE_TUNING') == '1'
@@ -1,10 +1,23 @@
-from qa327 import app, frontend
+from qa327 import app, api, assets, compression, events, frontend, holds, metrics, profiler
+import os
 
 """
 This file runs the server at a given port
+
+By default this is the Flask development server with the debugger and
+reloader. Set SERVER_MODE=production to run the multi-process server
+defined in qa327/wsgi.py instead, or SERVER_MODE=asgi to run the event
+loop server defined in qa327/asgi.py.
 """
 
-FLASK_PORT = 8081
+FLASK_PORT = int(os.getenv('PORT', 8081))
 
 if __name__ == "__main__":
-    app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
\ No newline at end of file
+    if os.getenv('SERVER_MODE') == 'production':
+        from qa327.wsgi import serve
+        serve(FLASK_PORT)
+    elif os.getenv('SERVER_MODE') == 'asgi':
+        from qa327.asgi import serve
+        serve(FLASK_PORT)
+    else:
+        app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
@@ -0,0 +1,178 @@
+from collections import namedtuple
+from sqlalchemy.engine.url import make_url
+import asyncio
+
+"""
+This file runs SQLAlchemy Core statements on an event loop, for the
+async endpoints in qa327/asgi.py.
+
+Statements are compiled with the dialect of the app's own engine, so
+they are the exact SQL the synchronous code runs, and are sent through
+an asyncio driver: aiosqlite for SQLite and aiomysql for MySQL. Bound
+values and results go through the column types' own conversions, so a
+date comes back as a date from either database.
+
+    database = AsyncDatabase(url, dialect, pool_size=8)
+    await database.connect()
+    rows = await database.fetch_all(select(Ticket.__table__.columns))
+
+Connections are opened by connect() and shared by every coroutine on
+the loop, a few of them are enough for thousands of open requests
+because each statement only holds one while it runs.
+"""
+
+
+class SQLiteDriver:
+    """
+    A fixed set of aiosqlite connections, each with its own thread
+    """
+
+    def __init__(self, path, size, pragmas):
+        self.path = path
+        self.size = size
+        self.pragmas = pragmas
+        self.connections = None
+
+    async def connect(self):
+        import aiosqlite
+        self.connections = asyncio.Queue()
+        for _ in range(self.size):
+            connection = await aiosqlite.connect(self.path)
+            for statement in self.pragmas:
+                await connection.execute(statement)
+            # these connections only ever read
+            await connection.execute('PRAGMA query_only=1')
+            self.connections.put_nowait(connection)
+
+    async def close(self):
+        while not self.connections.empty():
+            await self.connections.get_nowait().close()
+
+    async def fetch(self, sql, args):
+        connection = await self.connections.get()
+        try:
+            async with connection.execute(sql, args) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self.connections.put_nowait(connection)
+
+
+class MySQLDriver:
+    """
+    An aiomysql pool, sized like the synchronous DB_POOL_* pool
+    """
+
+    def __init__(self, url, size, recycle, connect_timeout):
+        self.url = url
+        self.size = size
+        self.recycle = recycle
+        self.connect_timeout = connect_timeout
+        self.pool = None
+
+    async def connect(self):
+        import aiomysql
+        self.pool = await aiomysql.create_pool(
+            minsize=1, maxsize=self.size, pool_recycle=self.recycle,
+            host=self.url.host or 'localhost', port=self.url.port or 3306,
+            user=self.url.username, password=self.url.password or '',
+            db=self.url.database, charset=self.url.query.get('charset', 'utf8mb4'),
+            connect_timeout=self.connect_timeout, autocommit=True)
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+
+    async def fetch(self, sql, args):
+        async with self.pool.acquire() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(sql, args)
+                return await cursor.fetchall()
+
+
+class AsyncDatabase:
+    """
+    Runs Core statements compiled for the app's database on an asyncio driver
+    """
+
+    def __init__(self, url, dialect, pool_size=8, pragmas=(), recycle=-1,
+                 connect_timeout=10):
+        """
+        :param url: the SQLALCHEMY_DATABASE_URI
+        :param dialect: the dialect of the app's engine, to compile with
+        :param pool_size: the connections to keep open
+        :param pragmas: statements run on every new SQLite connection
+        :param recycle: seconds before a MySQL connection is replaced
+        :param connect_timeout: seconds to wait when opening a MySQL connection
+        """
+        url = make_url(url)
+        self.dialect = dialect
+        self._row_types = {}
+        if url.get_backend_name() == 'sqlite':
+            if not url.database or url.database == ':memory:':
+                raise ValueError('an in-memory SQLite database can not be '
+                                 'shared with other connections')
+            self.driver = SQLiteDriver(url.database, pool_size, pragmas)
+        elif url.get_backend_name() == 'mysql':
+            self.driver = MySQLDriver(url, pool_size, recycle, connect_timeout)
+        else:
+            raise ValueError('no async driver for {}'.format(url.get_backend_name()))
+
+    async def connect(self):
+        await self.driver.connect()
+
+    async def disconnect(self):
+        await self.driver.close()
+
+    def compile(self, statement):
+        """
+        :param statement: a Core SELECT
+        :return: the SQL, its bound values in the driver's format, and the
+            (key, result processor) of each result column
+        """
+        compiled = statement.compile(dialect=self.dialect)
+        params = compiled.construct_params()
+        for name, value in params.items():
+            processor = compiled.binds[name].type._cached_bind_processor(self.dialect)
+            if processor is not None:
+                params[name] = processor(value)
+        if self.dialect.positional:
+            args = tuple(params[name] for name in compiled.positiontup)
+        else:
+            args = params
+        columns = [(column.key, column.type._cached_result_processor(self.dialect, None))
+                   for column in statement.inner_columns]
+        return str(compiled), args, columns
+
+    def _row_type(self, keys):
+        row_type = self._row_types.get(keys)
+        if row_type is None:
+            row_type = self._row_types[keys] = namedtuple('Row', keys, rename=True)
+        return row_type
+
+    async def fetch_all(self, statement):
+        """
+        :return: the rows of the statement, with the columns as attributes
+        """
+        sql, args, columns = self.compile(statement)
+        rows = await self.driver.fetch(sql, args)
+        row_type = self._row_type(tuple(key for key, _ in columns))
+        processors = [processor for _, processor in columns]
+        if not any(processors):
+            return [row_type(*row) for row in rows]
+        return [row_type(*[value if processor is None else processor(value)
+                           for processor, value in zip(processors, row)])
+                for row in rows]
+
+    async def fetch_one(self, statement):
+        """
+        :return: the first row of the statement, or None
+        """
+        rows = await self.fetch_all(statement.limit(1))
+        return rows[0] if rows else None
+
+    async def scalar(self, statement):
+        """
+        :return: the first column of the first row, or None
+        """
+        row = await self.fetch_one(statement)
+        return row[0] if row is not None else None
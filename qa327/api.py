@@ -0,0 +1,96 @@
+from flask import Response, jsonify, request, stream_with_context
+from qa327 import app
+from qa327.frontend import ticket_filters, ticket_json
+from datetime import date
+import hashlib
+import json
+import qa327.backend as bn
+
+"""
+This file defines the read-only JSON API over the ticket catalogue, for
+partners that would otherwise scrape the profile page. The catalogue is
+the same for every user, so the API needs no login.
+
+    GET /api/tickets            one page of tickets, as on the profile page
+    GET /api/tickets/<name>     a single ticket
+    GET /api/tickets.ndjson     every ticket, streamed one per line
+
+The list and the export take the profile page filters and sort order
+(min_price, max_price, expires_from, expires_to, min_quantity, sort).
+Pages take `limit` and follow `next_cursor` with `after=` or
+`prev_cursor` with `before=`.
+"""
+
+
+# one encoder for every exported line, rather than one per json.dumps call
+encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def list_request(args):
+    """
+    Read the filters, page size and cursor of a ticket list request
+    :param args: The query string values
+    :return: The filters for get_all_tickets, the accepted filter values,
+        the page size, the cursor, and whether to list backwards from it
+    """
+    filters, accepted = ticket_filters(args)
+    try:
+        limit = int(args.get('limit', app.config['TICKETS_PER_PAGE']))
+    except ValueError:
+        limit = app.config['TICKETS_PER_PAGE']
+    limit = max(1, min(limit, app.config['API_MAX_PAGE_SIZE']))
+    if 'before' in args:
+        return filters, accepted, limit, args['before'], True
+    return filters, accepted, limit, args.get('after'), False
+
+
+def list_etag(version, accepted, limit, cursor, backwards):
+    """
+    :return: The ETag of a ticket list page, which changes with the catalogue
+    """
+    return hashlib.sha1(repr((version, date.today(), sorted(accepted.items()), limit,
+                              None if backwards else cursor, cursor if backwards else None)
+                             ).encode('utf-8')).hexdigest()
+
+
+@app.route('/api/tickets')
+def api_tickets():
+    # Read the version before the tickets, like the profile page
+    version = bn.get_catalogue_version()
+    filters, accepted, limit, cursor, backwards = list_request(request.args)
+
+    # Polling partners get a 304 until the catalogue changes
+    etag = list_etag(version, accepted, limit, cursor, backwards)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    page = bn.get_all_tickets(cursor, limit, backwards=backwards, **filters)
+    response = jsonify(tickets=[ticket_json(ticket) for ticket in page.tickets],
+                       prev_cursor=page.prev_cursor, next_cursor=page.next_cursor)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/api/tickets/<name>')
+def api_ticket(name):
+    ticket = bn.get_ticket(name)
+    # expired tickets are left out, as they are from the list
+    if ticket is None or ticket.expiration_date < date.today():
+        return jsonify(error='Ticket does not exist.'), 404
+    return jsonify(ticket_json(ticket))
+
+
+@app.route('/api/tickets.ndjson')
+def api_export_tickets():
+    filters, _ = ticket_filters()
+
+    def generate():
+        # One chunk per page keeps the memory used flat however many
+        # tickets there are, without a write to the socket per ticket
+        for tickets in bn.iter_ticket_pages(app.config['EXPORT_PAGE_SIZE'], **filters):
+            yield ''.join(encode_json(ticket_json(ticket)) + '\n' for ticket in tickets)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=tickets.ndjson'})
@@ -0,0 +1,346 @@
+from qa327 import app, api, assets, compression, events, frontend, holds, metrics, profiler
+from qa327.aiodb import AsyncDatabase
+from qa327.models import db, CatalogueVersion, Ticket, User
+from sqlalchemy import select
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_accept_header, parse_etags
+from datetime import date
+from functools import wraps
+import asyncio
+import glob
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import qa327.backend as bn
+import qa327.sqlite_tuning as sqlite_tuning
+
+"""
+This file defines the ASGI server, for deployments where many clients
+hold connections open: slow readers, pollers and /events/tickets
+listeners.
+
+The read-heavy endpoints run as coroutines on one event loop per worker
+process and read the database through the async drivers in
+qa327/aiodb.py, so an idle connection costs a little memory rather than
+a server thread:
+
+    GET /api/tickets            the catalogue pages
+    GET /api/tickets/<name>     a single ticket
+    GET /search                 the ticket name type-ahead
+    GET /events/tickets         the live ticket changes
+
+Everything else, the form routes in qa327/frontend.py included, is the
+Flask app mounted behind them, run on a thread pool. The async
+endpoints answer exactly as the Flask versions do, and share their
+helpers. Settings come from environment variables:
+
+    WEB_WORKERS          worker processes (default cores + 1)
+    ASGI_DB_POOL_SIZE    database connections per worker (default 8)
+    ASGI_EVENTS_MAX_CLIENTS
+                         /events/tickets clients per worker (default 10000)
+    ASGI_MAX_CONNECTIONS open connections per worker before new ones get
+                         503 (default 20000)
+    ASGI_BACKLOG         connections waiting to be accepted (default 4096)
+
+Run it with SERVER_MODE=asgi python -m qa327, or load qa327.asgi:application
+in any ASGI server.
+"""
+
+KEEP_ALIVE = ': keep-alive\n\n'
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+def open_database():
+    """
+    :return: an AsyncDatabase on the app's database, not yet connected
+    """
+    with app.app_context():
+        dialect = db.engine.dialect
+    pragmas = sqlite_tuning.pragmas(os.environ) if app.config['SQLITE_TUNING'] else ()
+    return AsyncDatabase(app.config['SQLALCHEMY_DATABASE_URI'], dialect,
+                         pool_size=_env_int('ASGI_DB_POOL_SIZE', 8), pragmas=pragmas,
+                         recycle=_env_int('DB_POOL_RECYCLE', 280),
+                         connect_timeout=_env_int('DB_CONNECT_TIMEOUT', 10))
+
+
+database = open_database()
+
+version_statement = select([CatalogueVersion.version]).where(CatalogueVersion.id == 1)
+
+
+def timed(rule):
+    """
+    Record the endpoint's requests in the /metrics numbers, under the same
+    rule as the Flask route it stands in for
+    """
+    def decorate(endpoint):
+        @wraps(endpoint)
+        async def wrapped(request):
+            metrics.start_flusher()
+            key = '{} {}'.format(request.method, rule)
+            metrics.registry.started(key)
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await endpoint(request)
+                status = response.status_code
+                return response
+            finally:
+                metrics.registry.finished(key, status, time.perf_counter() - start)
+        return wrapped
+    return decorate
+
+
+def json_response(request, data, etag=None):
+    """
+    JSON in the Flask API's format, compressed as qa327/compression.py would
+    """
+    body = (json.dumps(data, separators=(',', ':'), sort_keys=True) + '\n').encode('utf-8')
+    headers = {'Vary': 'Accept-Encoding'}
+    if etag is not None:
+        headers['ETag'] = '"{}"'.format(etag)
+    if len(body) >= app.config['COMPRESS_MIN_SIZE']:
+        encoding = compression.choose_encoding(
+            parse_accept_header(request.headers.get('accept-encoding')))
+        if encoding is not None:
+            body = compression.encode(body, encoding)
+            headers['Content-Encoding'] = encoding
+            if etag is not None:
+                headers['ETag'] = 'W/' + headers['ETag']
+    return Response(body, media_type='application/json', headers=headers)
+
+
+@timed('/api/tickets')
+async def api_tickets(request):
+    # Read the version before the tickets, like the profile page
+    version = await database.scalar(version_statement)
+    filters, accepted, limit, cursor, backwards = api.list_request(request.query_params)
+
+    etag = api.list_etag(version, accepted, limit, cursor, backwards)
+    if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+        return Response(status_code=304, headers={'ETag': '"{}"'.format(etag)})
+
+    listing = bn.plan_ticket_listing(cursor, backwards, **filters)
+    rows = await database.fetch_all(bn.ticket_page_statement(listing, limit))
+    page = bn.ticket_page(rows, limit, listing)
+    return json_response(request, {
+        'tickets': [frontend.ticket_json(ticket) for ticket in page.tickets],
+        'prev_cursor': page.prev_cursor,
+        'next_cursor': page.next_cursor,
+    }, etag)
+
+
+@timed('/api/tickets/<name>')
+async def api_ticket(request):
+    ticket = await database.fetch_one(select(Ticket.__table__.columns).where(
+        Ticket.name == request.path_params['name']).where(
+        Ticket.expiration_date >= date.today()))
+    if ticket is None:
+        return JSONResponse({'error': 'Ticket does not exist.'}, status_code=404)
+    return json_response(request, frontend.ticket_json(ticket))
+
+
+async def logged_in_user(request):
+    """
+    Read the Flask session cookie, as @authenticate does
+    :return: the id of the logged in user, or None
+    """
+    cookie = request.cookies.get(app.session_cookie_name)
+    if not cookie:
+        return None
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        session = serializer.loads(
+            cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return None
+    user_id = session.get('logged_in')
+    if not isinstance(user_id, int):
+        return None
+    if bn.user_cache.get(user_id) is not None:
+        return user_id
+    return await database.scalar(select([User.id]).where(User.id == user_id))
+
+
+@timed('/search')
+async def search(request):
+    if await logged_in_user(request) is None:
+        return Response(status_code=302, headers={'Location': '/login'})
+    query = request.query_params.get('q', '')
+    statement = bn.search_statement(query, frontend.search_limit(request.query_params))
+    tickets = await database.fetch_all(statement) if statement is not None else []
+    return json_response(request, {
+        'query': query,
+        'tickets': [frontend.ticket_json(ticket) for ticket in tickets],
+    })
+
+
+class LoopRelay:
+    """
+    Carries the events of the process broadcaster onto the event loop, one
+    hand-over per event however many clients are waiting for it
+    """
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.clients = set()
+        self.loop = None
+
+    def put_nowait(self, message):
+        # called on the poller thread
+        self.loop.call_soon_threadsafe(self.fan_out, message)
+
+    def fan_out(self, message):
+        for client in list(self.clients):
+            try:
+                client.put_nowait(message)
+            except asyncio.QueueFull:
+                # a client this far behind gets the whole list again
+                # instead of every change it missed
+                while not client.empty():
+                    client.get_nowait()
+                client.put_nowait(events.resync_message())
+
+    def subscribe(self, limit):
+        """
+        :param limit: the most clients allowed at once
+        :return: a new client's queue, or None if there are `limit` already
+        """
+        if len(self.clients) >= limit:
+            return None
+        if not self.clients:
+            self.loop = asyncio.get_event_loop()
+            events.broadcaster.attach(self)
+        client = asyncio.Queue(self.queue_size)
+        self.clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        self.clients.discard(client)
+        if not self.clients:
+            # the poller stops reading changes when nobody listens
+            events.broadcaster.unsubscribe(self)
+
+
+relay = LoopRelay(app.config['EVENTS_QUEUE_SIZE'])
+
+
+class EventStream:
+    """
+    The text/event-stream response of one /events/tickets client. It ends
+    as soon as the client disconnects, rather than at the next write.
+    """
+
+    status_code = 200
+
+    def __init__(self, client, first):
+        self.client = client
+        self.first = first
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        message = None
+        try:
+            for chunk in self.first:
+                await send({'type': 'http.response.body',
+                            'body': chunk.encode('utf-8'), 'more_body': True})
+            while True:
+                if message is None:
+                    message = asyncio.ensure_future(self.client.get())
+                done, _ = await asyncio.wait(
+                    {message, disconnected}, timeout=app.config['EVENTS_HEARTBEAT'],
+                    return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    return
+                if message in done:
+                    chunk, message = message.result(), None
+                else:
+                    # a comment line keeps proxies from closing an idle stream
+                    chunk = KEEP_ALIVE
+                await send({'type': 'http.response.body',
+                            'body': chunk.encode('utf-8'), 'more_body': True})
+        finally:
+            disconnected.cancel()
+            if message is not None:
+                message.cancel()
+            relay.unsubscribe(self.client)
+
+    @staticmethod
+    async def wait_for_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+
+@timed('/events/tickets')
+async def ticket_events(request):
+    # The version the client last saw, from the page or a reconnect
+    since = request.headers.get('last-event-id') or request.query_params.get('since')
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        since = None
+
+    client = relay.subscribe(_env_int('ASGI_EVENTS_MAX_CLIENTS', 10000))
+    if client is None:
+        return Response('Too many live clients, try again later.\n', status_code=503,
+                        media_type='text/plain', headers={'Retry-After': '30'})
+    # Read the version after subscribing: a change published in between
+    # is then both queued and covered by the resync, never lost
+    try:
+        version = await database.scalar(version_statement)
+    except Exception:
+        relay.unsubscribe(client)
+        raise
+    events.start_poller(version)
+
+    first = ['retry: {}\n\n'.format(app.config['EVENTS_RETRY_MS'])]
+    if since is not None and since != version:
+        first.append(events.resync_message(version))
+    return EventStream(client, first)
+
+
+application = Starlette(
+    routes=[
+        Route('/api/tickets', api_tickets),
+        Route('/api/tickets/{name}', api_ticket),
+        Route('/search', search),
+        Route('/events/tickets', ticket_events),
+        Mount('/', WSGIMiddleware(app)),
+    ],
+    on_startup=[database.connect],
+    on_shutdown=[database.disconnect],
+)
+
+
+def serve(port):
+    """
+    Run the ASGI server under uvicorn until it is stopped
+    :param port: the port to listen on
+    """
+    import uvicorn
+
+    # the workers import the app afresh, they share the directory through
+    # the environment
+    directory = app.config['METRICS_DIR'] or tempfile.mkdtemp(prefix='qa327-metrics-')
+    os.environ['METRICS_DIR'] = directory
+    for stale in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(stale)
+
+    uvicorn.run('qa327.asgi:application', host='0.0.0.0', port=port,
+                workers=_env_int('WEB_WORKERS', multiprocessing.cpu_count() + 1),
+                timeout_keep_alive=_env_int('WEB_KEEPALIVE', 5),
+                limit_concurrency=_env_int('ASGI_MAX_CONNECTIONS', 20000),
+                backlog=_env_int('ASGI_BACKLOG', 4096))
@@ -0,0 +1,249 @@
+from flask import abort, request, send_from_directory
+from qa327 import app, package_dir
+from urllib.parse import urljoin
+from urllib.request import Request, urlopen
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+This file vendors the third-party CSS, JS, fonts and icons used by
+base.html so pages load without any request to an outside host.
+
+Build the assets once, e.g. as part of the Docker image:
+
+    python -m qa327.assets
+
+This downloads every source below, rewrites the url(...) references
+inside the stylesheets to local copies of the fonts and images, joins
+and minifies the stylesheets and scripts into one file each, and names
+every file after a hash of its content. Gzip and brotli copies are
+written next to each file, and manifest.json maps the logical names
+used by the templates to the hashed file names.
+
+Because a hashed file never changes, it is served with a far-future
+immutable cache header. Until the assets are built, base.html falls
+back to loading everything from the original hosts.
+"""
+
+dist_dir = os.path.join(package_dir, 'static', 'dist')
+manifest_path = os.path.join(dist_dir, 'manifest.json')
+
+STYLESHEETS = [
+    'https://fonts.googleapis.com/css?family=Poppins:200,300,400,600,700,800',
+    'https://use.fontawesome.com/releases/v5.0.6/css/all.css',
+    'https://l1nna.com/black-assets/css/nucleo-icons.css',
+    'https://l1nna.com/black-assets/css/blk-design-system.css?v=1.0.0',
+    'https://l1nna.com/black-assets/demo/demo.css',
+]
+
+SCRIPTS = [
+    'https://l1nna.com/black-assets/js/core/jquery.min.js',
+    'https://l1nna.com/black-assets/js/core/popper.min.js',
+    'https://l1nna.com/black-assets/js/core/bootstrap.min.js',
+    'https://l1nna.com/black-assets/js/plugins/perfect-scrollbar.jquery.min.js',
+    'https://l1nna.com/black-assets/js/plugins/bootstrap-switch.js',
+    'https://l1nna.com/black-assets/js/plugins/nouislider.min.js',
+    'https://l1nna.com/black-assets/js/plugins/chartjs.min.js',
+    'https://l1nna.com/black-assets/js/plugins/moment.min.js',
+    'https://l1nna.com/black-assets/js/plugins/bootstrap-datetimepicker.js',
+    'https://l1nna.com/black-assets/demo/demo.js',
+    'https://l1nna.com/black-assets/js/blk-design-system.min.js?v=1.0.0',
+]
+
+# files used on their own rather than bundled, by logical name
+FILES = {
+    'apple-icon.png': 'https://l1nna.com/black-assets/img/apple-icon.png',
+    'favicon.ico': 'https://l1nna.com/images/favicon.ico',
+}
+
+# Google Fonts only sends woff2 fonts to browsers it recognises
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 ' \
+    '(KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36'
+
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+CSS_SPACE = re.compile(r'\s+')
+CSS_PUNCTUATION_SPACE = re.compile(r'\s*([{};,>])\s*')
+# a space before a colon in a selector makes `.a :hover` a descendant
+# selector, so colons are only tightened inside declaration blocks
+CSS_DECLARATIONS = re.compile(r'\{[^{}]*\}')
+CSS_COLON_SPACE = re.compile(r'\s*:\s*')
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+_manifest = None
+
+
+def fetch(url):
+    with urlopen(Request(url, headers={'User-Agent': USER_AGENT}), timeout=30) as response:
+        return response.read()
+
+
+def write_hashed(name, content):
+    """
+    Write a file named after a hash of its content, with compressed copies
+    :param name: the logical name, whose extension is kept
+    :param content: the file content as bytes
+    :return: the hashed file name, relative to the dist directory
+    """
+    stem, ext = os.path.splitext(os.path.basename(name))
+    digest = hashlib.sha256(content).hexdigest()[:16]
+    hashed = '{}.{}{}'.format(stem, digest, ext)
+    path = os.path.join(dist_dir, hashed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'wb') as f:
+        f.write(content)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+    return hashed
+
+
+def vendor_css(css, source_url, resources):
+    """
+    Point every url(...) in a stylesheet at a local copy of the resource
+    :param css: the stylesheet text
+    :param source_url: where the stylesheet came from, for relative urls
+    :param resources: a cache of already vendored urls to hashed names
+    :return: the rewritten stylesheet
+    """
+    def replace(match):
+        url = match.group(2).strip()
+        if url.startswith(('data:', '#')):
+            return match.group(0)
+        # fonts are often referenced with ?#iefix or #svgid suffixes
+        absolute, _, fragment = urljoin(source_url, url).partition('#')
+        if absolute not in resources:
+            name = absolute.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+            resources[absolute] = write_hashed(name, fetch(absolute))
+        local = resources[absolute] + ('#' + fragment if fragment else '')
+        return 'url("{}")'.format(local)
+
+    return CSS_URL.sub(replace, css)
+
+
+def minify_css(css):
+    css = CSS_COMMENT.sub('', css)
+    css = CSS_SPACE.sub(' ', css)
+    css = CSS_PUNCTUATION_SPACE.sub(r'\1', css)
+    return CSS_DECLARATIONS.sub(
+        lambda block: CSS_COLON_SPACE.sub(':', block.group(0)), css).strip()
+
+
+def minify_js(js):
+    try:
+        import rjsmin
+    except ImportError:
+        # most of the scripts already ship minified
+        return js
+    return rjsmin.jsmin(js)
+
+
+def build():
+    """
+    Download, bundle and hash all assets, then write the manifest
+    :return: the manifest
+    """
+    os.makedirs(dist_dir, exist_ok=True)
+    resources = {}
+
+    css = []
+    for url in STYLESHEETS:
+        css.append(vendor_css(fetch(url).decode('utf-8'), url, resources))
+    js = [minify_js(fetch(url).decode('utf-8')) for url in SCRIPTS]
+
+    manifest = {
+        'app.css': write_hashed('app.css', minify_css('\n'.join(css)).encode('utf-8')),
+        # a script without a trailing semicolon must not run into the next one
+        'app.js': write_hashed('app.js', ';\n'.join(js).encode('utf-8')),
+    }
+    for name, url in FILES.items():
+        manifest[name] = write_hashed(name, fetch(url))
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest():
+    """
+    :return: the manifest of the built assets, or an empty one if they are not built
+    """
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@app.context_processor
+def asset_helpers():
+    global _manifest
+    if _manifest is None:
+        _manifest = load_manifest()
+
+    def asset_url(name):
+        """
+        :return: the url of a built asset, or None if the assets are not built
+        """
+        hashed = _manifest.get(name)
+        return '/static/dist/' + hashed if hashed else None
+
+    return {'asset_url': asset_url}
+
+
+@app.route('/static/dist/<path:filename>')
+def dist_asset(filename):
+    """
+    Serve a built asset, using a precompressed copy if the client accepts one
+    """
+    if filename.endswith(('.gz', '.br', '.json')):
+        abort(404)
+
+    accepted = request.accept_encodings
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[candidate] and os.path.isfile(
+                os.path.join(dist_dir, filename + suffix)):
+            encoding = candidate
+            break
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if encoding is None:
+        response = send_from_directory(dist_dir, filename, mimetype=mimetype,
+                                       cache_timeout=ONE_YEAR, conditional=True)
+    else:
+        response = send_from_directory(dist_dir, filename + (
+            '.br' if encoding == 'br' else '.gz'), mimetype=mimetype,
+            cache_timeout=ONE_YEAR, conditional=True)
+        response.headers['Content-Encoding'] = encoding
+
+    # the name changes whenever the content does, so it never needs revalidating
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__).parse_args()
+    manifest = build()
+    for name, hashed in sorted(manifest.items()):
+        print('{:<16} {}'.format(name, hashed))
+
+
+if __name__ == '__main__':
+    main()
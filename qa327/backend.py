@@ -1,11 +1,28 @@
-from qa327.models import db, Ticket, User
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import date, datetime
+from qa327 import app
+from qa327.cache import LRUCache
+from qa327.models import db, CatalogueVersion, Hold, Ticket, TicketChange, User
+from sqlalchemy import and_, bindparam, collate, event, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from qa327.passwords import HashingBusy, hash_password, needs_rehash, verify_password
+from qa327.sqlite_tuning import single_writer
+from qa327.utils import parse_ticket_date, validate_tickets_batch
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+import math
+import re
 """
 This file defines all backend logic that interacts with database and other services
 """
 
+# The fields of a user that the pages need, copied out of the database row
+# so they can be shared between requests without an open session
+CachedUser = namedtuple('CachedUser', ['id', 'email', 'name', 'balance'])
 
+user_cache = LRUCache(app.config['USER_CACHE_SIZE'],
+                      app.config['USER_CACHE_TTL'])
+
+
+@db.read_only
 def get_user(email):
     """
     Get a user by a given email
@@ -16,20 +33,73 @@ def get_user(email):
     return user
 
 
+@db.read_only
+def get_user_by_id(user_id):
+    """
+    Get a user by id, served from the user cache when possible
+    :param user_id: the id of the user, as stored in the session
+    :return: a CachedUser with the matched id, or None
+    """
+    if not isinstance(user_id, int):
+        # sessions made before ids were stored hold an email instead
+        return None
+
+    user = user_cache.get(user_id)
+    if user is None:
+        row = User.query.get(user_id)
+        if row is None:
+            return None
+        user = CachedUser(row.id, row.email, row.name, row.balance)
+        user_cache.set(user_id, user)
+    return user
+
+
+def invalidate_user(user_id):
+    """
+    Drop a user from the user cache, must be called after changing their row
+    :param user_id: the id of the user
+    """
+    user_cache.invalidate(user_id)
+
+
 def login_user(email, password):
     """
     Check user authentication by comparing the password
     :param email: the email of the user
     :param password: the password input
     :return: the user if login succeeds
+    :raises HashingBusy: if too many hashes are running or waiting
     """
     # if this returns a user, then the name already exists in database
     user = get_user(email)
-    if not user or not check_password_hash(user.password, password):
+    if not user or not verify_password(user.password, password):
         return None
+
+    # the plain password is only available here, so this is where hashes
+    # made with an older algorithm or work factor get upgraded
+    if needs_rehash(user.password):
+        try:
+            set_password(user.id, hash_password(password))
+        except HashingBusy:
+            pass
     return user
 
 
+@db.writes
+@single_writer
+def set_password(user_id, hashed_pw):
+    """
+    Replace the stored password hash of a user
+    :param user_id: the id of the user
+    :param hashed_pw: the new hash
+    """
+    try:
+        User.query.filter_by(id=user_id).update({User.password: hashed_pw})
+        db.session.commit()
+    except:
+        db.session.rollback()
+
+
 def register_user(email, name, password, password2):
     """
     Register the user to the database
@@ -40,7 +110,24 @@ def register_user(email, name, password, password2):
     :return: an error message if there is any, or None if register succeeds
     """
     try:
-        hashed_pw = generate_password_hash(password, method='sha256')
+        # hashing is slow, so it happens before taking the write path
+        hashed_pw = hash_password(password)
+    except:
+        return "Unable to register user"
+    return add_user(email, name, hashed_pw)
+
+
+@db.writes
+@single_writer
+def add_user(email, name, hashed_pw):
+    """
+    Store a new user
+    :param email: the email of the user
+    :param name: the name of the user
+    :param hashed_pw: the hash of the user's password
+    :return: an error message if there is any, or None if it succeeds
+    """
+    try:
         # store the encrypted password rather than the plain password
         new_user = User(email=email,
                         name=name,
@@ -52,25 +139,391 @@ def register_user(email, name, password, password2):
         db.session.commit()
         return None
     except:
+        db.session.rollback()
         return "Unable to register user"
 
 
-def get_all_tickets():
+TicketPage = namedtuple('TicketPage', ['tickets', 'prev_cursor', 'next_cursor'])
+
+# The orders the ticket listing can be sorted in, as the column sorted on
+# and whether it is descending. Ties are broken by id in the same direction,
+# and each column has a composite index starting with (column, id).
+TICKET_SORTS = {
+    'date': ('expiration_date', False),
+    'date_desc': ('expiration_date', True),
+    'price': ('price', False),
+    'price_desc': ('price', True),
+}
+
+
+def encode_cursor(ticket, sort='date'):
+    """
+    Builds the cursor that points at a ticket in the listing order
+    :param ticket: The ticket to point at
+    :param sort: The listing order, one of TICKET_SORTS
+    :return: The cursor as a string, e.g. 20771210-15 when sorting by
+        date or 45.0-15 when sorting by price
+    """
+    if TICKET_SORTS[sort][0] == 'price':
+        return '{!r}-{}'.format(ticket.price, ticket.id)
+    return '{}-{}'.format(ticket.expiration_date.strftime('%Y%m%d'), ticket.id)
+
+
+def decode_cursor(cursor, sort='date'):
+    """
+    Reads a cursor made by encode_cursor
+    :param cursor: The cursor string
+    :param sort: The listing order the cursor was made for
+    :return: The (sort value, id) pair, or None if the cursor is invalid
+    """
+    try:
+        value, ticket_id = cursor.rsplit('-', 1)
+        if TICKET_SORTS[sort][0] == 'price':
+            value = float(value)
+            if not math.isfinite(value):
+                return None
+        else:
+            value = datetime.strptime(value, '%Y%m%d').date()
+        return value, int(ticket_id)
+    except (AttributeError, KeyError, ValueError):
+        return None
+
+
+# The filters and order of one page of the ticket listing, see plan_ticket_listing
+TicketListing = namedtuple('TicketListing', ['conditions', 'order', 'sort',
+                                             'position', 'backwards'])
+
+
+def plan_ticket_listing(cursor=None, backwards=False, sort='date', min_price=None,
+                        max_price=None, expires_from=None, expires_to=None,
+                        min_quantity=None):
+    """
+    Work out the conditions and order of one page of the tickets that have
+    not expired yet, filtered and sorted as asked, without running anything.
+    Pages are found with keyset pagination on (sort column, id), so every
+    page costs the same index range scan no matter how deep into the listing
+    it is, and the composite index of each order also holds the filtered
+    columns.
+    :param cursor: The cursor of the ticket the page starts after
+    :param backwards: List the page that ends before the cursor instead
+    :param sort: The listing order, one of TICKET_SORTS
+    :param min_price: The lowest price to list
+    :param max_price: The highest price to list
+    :param expires_from: The first expiration date to list, never before today
+    :param expires_to: The last expiration date to list
+    :param min_quantity: The fewest tickets left to list
+    :return: A TicketListing, for ticket_page_statement or a query's filter
+        and order_by, and then ticket_page
+    """
+    if sort not in TICKET_SORTS:
+        sort = 'date'
+    sort_name, descending = TICKET_SORTS[sort]
+    column = getattr(Ticket, sort_name)
+
+    # Date objects bind as the column's own type, so every date
+    # comparison is a plain range on a date index
+    today = date.today()
+    lower = {'expiration_date': max(expires_from or today, today),
+             'price': min_price}
+    upper = {'expiration_date': expires_to, 'price': max_price}
+
+    # Walking the listing backwards is walking the reverse order forwards
+    ascending = descending == backwards
+    position = decode_cursor(cursor, sort)
+    conditions = []
+    ties = None
+    if position is not None:
+        value, ticket_id = position
+        # The cursor becomes the bound of the sort column, folded into any
+        # filter on it so the database gets a single range to seek to, and
+        # the tickets up to the cursor within its value are skipped
+        bounds = lower if ascending else upper
+        bounds[sort_name] = value if bounds[sort_name] is None else (
+            max if ascending else min)(bounds[sort_name], value)
+        if ascending:
+            ties = or_(column > value, Ticket.id > ticket_id)
+        else:
+            ties = or_(column < value, Ticket.id < ticket_id)
+
+    for name in ('expiration_date', 'price'):
+        bounded = getattr(Ticket, name)
+        if name == 'price' and sort_name != 'price':
+            # Keep the database walking the index of the sort order and
+            # checking prices from it, rather than sorting every ticket in
+            # a price range; the expiry window is a range worth seeking to
+            bounded = bounded + 0
+        if lower[name] is not None:
+            conditions.append(bounded >= lower[name])
+        if upper[name] is not None:
+            conditions.append(bounded <= upper[name])
+    if min_quantity is not None:
+        conditions.append(Ticket.quantity >= min_quantity)
+    if ties is not None:
+        conditions.append(ties)
+
+    if ascending:
+        order = [column, Ticket.id]
+    else:
+        order = [column.desc(), Ticket.id.desc()]
+    return TicketListing(conditions, order, sort, position, backwards)
+
+
+def ticket_page_statement(listing, page_size):
+    """
+    :param listing: A TicketListing from plan_ticket_listing
+    :param page_size: The number of tickets on the page
+    :return: The SELECT of the ticket columns for the page, one row more
+        than the page holds, to run on any connection
+    """
+    return select(Ticket.__table__.columns).where(and_(*listing.conditions)) \
+        .order_by(*listing.order).limit(page_size + 1)
+
+
+def ticket_page(tickets, page_size, listing):
+    """
+    Builds the page from the rows read for a listing
+    :param tickets: The tickets read, up to page_size + 1 of them
+    :param page_size: The number of tickets on the page
+    :param listing: The TicketListing they were read for
+    :return: A TicketPage with the tickets and the cursors of the pages around it
+    """
+    # One extra row tells us whether there is another page after this one
+    has_more = len(tickets) > page_size
+    tickets = list(tickets[:page_size])
+    sort = listing.sort
+
+    if listing.backwards:
+        tickets.reverse()
+        prev_cursor = encode_cursor(tickets[0], sort) if has_more else None
+        next_cursor = encode_cursor(tickets[-1], sort) if tickets else None
+    else:
+        prev_cursor = encode_cursor(tickets[0], sort) \
+            if tickets and listing.position is not None else None
+        next_cursor = encode_cursor(tickets[-1], sort) if has_more else None
+
+    return TicketPage(tickets, prev_cursor, next_cursor)
+
+
+@db.read_only
+def get_all_tickets(cursor=None, page_size=None, backwards=False, sort='date',
+                    min_price=None, max_price=None, expires_from=None,
+                    expires_to=None, min_quantity=None, plain_rows=False):
+    """
+    Retrieve one page of the tickets that have not expired yet, filtered and
+    sorted as asked, see plan_ticket_listing
+    :param cursor: The cursor of the ticket the page starts after
+    :param page_size: The number of tickets on the page
+    :param backwards: Return the page that ends before the cursor instead
+    :param sort: The listing order, one of TICKET_SORTS
+    :param min_price: The lowest price to list
+    :param max_price: The highest price to list
+    :param expires_from: The first expiration date to list, never before today
+    :param expires_to: The last expiration date to list
+    :param min_quantity: The fewest tickets left to list
+    :param plain_rows: Return read-only rows with the ticket columns as
+        attributes instead of Ticket objects, which are much cheaper to load
+    :return: A TicketPage with the tickets and the cursors of the pages around it
+    """
+    if page_size is None:
+        page_size = app.config['TICKETS_PER_PAGE']
+    listing = plan_ticket_listing(cursor, backwards, sort, min_price, max_price,
+                                  expires_from, expires_to, min_quantity)
+
+    if plain_rows:
+        ticket_list = db.session.query(*Ticket.__table__.columns)
+    else:
+        ticket_list = Ticket.query
+    tickets = ticket_list.filter(*listing.conditions).order_by(*listing.order) \
+        .limit(page_size + 1).all()
+    return ticket_page(tickets, page_size, listing)
+
+
+def iter_ticket_pages(page_size, **filters):
+    """
+    Walk every ticket get_all_tickets lists, one page at a time. Each page
+    is its own short keyset query, and the session is closed before the page
+    is handed over, so no connection or read lock is held while the caller
+    works through it or waits on a slow client.
+    :param page_size: The number of tickets in each page
+    :param filters: The filters and sort order, as for get_all_tickets
+    :return: A generator of lists of read-only ticket rows
+    """
+    cursor = None
+    while True:
+        page = get_all_tickets(cursor, page_size, plain_rows=True, **filters)
+        db.session.close()
+        if page.tickets:
+            yield page.tickets
+        if page.next_cursor is None:
+            return
+        cursor = page.next_cursor
+
+
+SEARCH_CHARACTERS = re.compile(r'[0-9A-Za-z]+')
+
+
+def search_statement(query, limit=None):
+    """
+    Builds the search for the tickets that have not expired whose names start
+    with the query, ignoring case. Ticket names are single alphanumeric
+    words, so a prefix is a range of the case-insensitive name index and
+    costs the same at any catalogue size. The first SEARCH_CANDIDATES matches
+    in name order are ranked with an exact match first, then the shortest
+    names, which are the closest completions.
+    :param query: What the user has typed so far
+    :param limit: The number of tickets to return
+    :return: The SELECT of the ticket columns, best first, to run on any
+        connection, or None if the query holds nothing to search for
+    """
+    if limit is None:
+        limit = app.config['SEARCH_LIMIT']
+    prefix = ''.join(SEARCH_CHARACTERS.findall(query or '')).lower()
+    if not prefix:
+        return None
+
+    candidates = select([Ticket.id]).where(Ticket.expiration_date >= date.today())
+    # read from the settings rather than the engine, so statements can be
+    # built outside an app context, e.g. by qa327/asgi.py
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # every name from the prefix up to, but not including, the next prefix
+        name = collate(Ticket.name, 'NOCASE')
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        candidates = candidates.where(and_(name >= prefix, name < upper)).order_by(name)
+    else:
+        candidates = candidates.where(
+            Ticket.name.like(prefix + '%')).order_by(Ticket.name)
+    # a derived table rather than IN, which MySQL does not allow a LIMIT in
+    candidates = candidates.limit(app.config['SEARCH_CANDIDATES']).alias('candidates')
+
+    return select(Ticket.__table__.columns).select_from(
+        Ticket.__table__.join(candidates, Ticket.id == candidates.c.id)).order_by(
+        (func.lower(Ticket.name) == prefix).desc(),
+        func.length(Ticket.name), Ticket.name).limit(limit)
+
+
+@db.read_only
+def search_tickets(query, limit=None):
+    """
+    Find the tickets whose names start with the query, see search_statement
+    :param query: What the user has typed so far
+    :param limit: The number of tickets to return
+    :return: The matching tickets as read-only rows, best first
+    """
+    statement = search_statement(query, limit)
+    if statement is None:
+        return []
+    return db.session.execute(statement).fetchall()
+
+
+@db.read_only
+def get_catalogue_version():
+    """
+    Gets the number of changes made to the tickets so far, a single primary key lookup
+    :return: The catalogue version
+    """
+    return db.session.query(CatalogueVersion.version).filter(
+        CatalogueVersion.id == 1).scalar()
+
+
+# Called in this process after every bump_catalogue_version commits, e.g.
+# to wake up the live event poller in qa327/events.py without waiting for
+# its timer
+catalogue_listeners = []
+
+# Recorded instead of the names when a write changes too many tickets to
+# send one by one; ticket names are alphanumeric, so it is never a name
+ALL_TICKETS = '*'
+
+
+def bump_catalogue_version(*names):
+    """
+    Marks the tickets as changed, so cached ticket lists in every process are rebuilt.
+    Called as the last statement of each write to the tickets, in the write's own
+    transaction, so the change and the new version commit or roll back together;
+    the version row stays locked only from here to the commit.
+    The names are recorded under the new version for get_ticket_changes.
+    :param names: The names of the tickets the write changed
+    """
+    CatalogueVersion.query.filter(CatalogueVersion.id == 1).update(
+        {CatalogueVersion.version: CatalogueVersion.version + 1},
+        synchronize_session=False)
+    # The version row is write locked until the commit, so the version
+    # read by the statements below is the one this write made
+    current = db.session.query(CatalogueVersion.version).filter(
+        CatalogueVersion.id == 1)
+    if len(names) > app.config['EVENTS_MAX_CHANGES']:
+        names = [ALL_TICKETS]
+    if names:
+        db.session.execute(TicketChange.__table__.insert().from_select(
+            ['version', 'name'],
+            current.add_columns(bindparam('name', type_=db.String)).statement),
+            [{'name': name} for name in names])
+    db.session.info['catalogue_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _catalogue_committed(session):
+    # the listeners only hear of versions that were committed
+    if session.info.pop('catalogue_changed', False):
+        for listener in catalogue_listeners:
+            listener()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _catalogue_rolled_back(session):
+    session.info.pop('catalogue_changed', None)
+
+
+@single_writer
+def trim_ticket_changes():
     """
-    Retrieve all the tickets belonging to a specific user, identified by email
-    :param email: The user's email
-    :return: The list of tickets belonging to the user
+    Deletes the change log entries older than the last TICKET_CHANGE_LOG_SIZE
+    versions, which get_ticket_changes never reads. Run now and then rather
+    than on every write, so writes stay at one insert into the log.
+    :return: The number of entries deleted
     """
+    current = db.session.query(CatalogueVersion.version).filter(
+        CatalogueVersion.id == 1).as_scalar()
+    try:
+        deleted = TicketChange.query.filter(
+            TicketChange.version <= current - app.config['TICKET_CHANGE_LOG_SIZE']
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+    except:
+        db.session.rollback()
+        return 0
 
-    # Gets todays date in format YYYYMMDD
-    date_string = date.today().strftime('%Y-%m-%d').replace("-", "")
 
-    # Query for all tickets where the expiration date is greater than or equal to current date
-    ticket_list = Ticket.query.filter(Ticket.expiration_date >= date_string)
+def get_ticket_changes(since):
+    """
+    Gets the tickets changed after a catalogue version, with one lookup of the
+    version and, if it moved, one range read of the change log and one of the
+    changed tickets
+    :param since: The catalogue version the caller has seen
+    :return: (the current version, the changed tickets as read-only rows), or
+        (the current version, None) when the changes since then are no longer
+        all in the log or are too many to send one by one
+    """
+    version = get_catalogue_version()
+    if version == since:
+        return version, []
+    if not 0 < version - since <= app.config['TICKET_CHANGE_LOG_SIZE'] // 2:
+        return version, None
 
-    return ticket_list
+    names = {row.name for row in db.session.query(TicketChange.name).filter(
+        TicketChange.version > since, TicketChange.version <= version)}
+    if ALL_TICKETS in names or len(names) > app.config['EVENTS_MAX_CHANGES']:
+        return version, None
+    if not names:
+        return version, []
+    tickets = db.session.query(
+        Ticket.name, Ticket.quantity, Ticket.price, Ticket.expiration_date
+    ).filter(Ticket.name.in_(names)).order_by(Ticket.name).all()
+    return version, tickets
 
 
+@db.read_only
 def get_ticket(name):
     """
     Gets a ticket by given name
@@ -81,6 +534,8 @@ def get_ticket(name):
     return Ticket.query.filter_by(name=name).first()
 
 
+@db.writes
+@single_writer
 def create_ticket(name, quantity, price, date):
     """
     Creates ticket quantity, price, and expiration date
@@ -97,34 +552,163 @@ def create_ticket(name, quantity, price, date):
                             price=price, expiration_date=date)
 
         db.session.add(new_ticket)
+        bump_catalogue_version(name)
         db.session.commit()
         return None
+    except IntegrityError:
+        # ticket names are unique
+        db.session.rollback()
+        return "A ticket with that name already exists."
     except:
+        db.session.rollback()
         return "Unable to parse query"
 
 
+def import_tickets(rows, batch_size=None):
+    """
+    Creates tickets from a stream of rows, validating and inserting them in
+    batches. Rows are consumed one batch at a time, so the whole import never
+    has to be held in memory.
+    :param rows: An iterable of (line number, ticket) pairs, where ticket is a
+        (name, quantity, price, date) tuple, or an error message for a row that
+        could not be read
+    :param batch_size: The number of rows validated, and tickets inserted and
+        committed, together
+    :return: A report with the number of tickets imported and failed, and the
+        error for each failed line (up to IMPORT_MAX_ERRORS of them)
+    """
+    if batch_size is None:
+        batch_size = app.config['IMPORT_BATCH_SIZE']
+    report = {'imported': 0, 'failed': 0, 'errors': []}
+
+    def flush(pending):
+        errors = [(line, ticket) for line, ticket in pending if isinstance(ticket, str)]
+        readable = [(line, ticket) for line, ticket in pending
+                    if not isinstance(ticket, str)]
+        errors += [(readable[index][0], error) for index, error in
+                   validate_tickets_batch(ticket for _, ticket in readable)]
+        failed = {line for line, _ in errors}
+        valid = [(line, ticket) for line, ticket in readable if line not in failed]
+
+        # One lookup for the names already taken, so a few duplicates do not
+        # send the whole batch down insert_tickets' row by row path
+        taken = get_taken_ticket_names([ticket[0] for _, ticket in valid])
+        batch = []
+        for line, (name, quantity, price, day) in valid:
+            if name in taken:
+                errors.append((line, "A ticket with that name already exists."))
+                continue
+            # a name repeated within the upload is taken by its first row
+            taken.add(name)
+            batch.append((line, {'name': name,
+                                 'quantity': int(quantity),
+                                 'price': float(price),
+                                 'expiration_date': date(*parse_ticket_date(day))}))
+        if batch:
+            not_inserted = insert_tickets(batch)
+            errors += not_inserted
+            report['imported'] += len(batch) - len(not_inserted)
+
+        for line, error in sorted(errors):
+            report['failed'] += 1
+            if len(report['errors']) < app.config['IMPORT_MAX_ERRORS']:
+                report['errors'].append({'line': line, 'error': error})
+
+    pending = []
+    for line, ticket in rows:
+        pending.append((line, ticket))
+        if len(pending) >= batch_size:
+            flush(pending)
+            pending = []
+    if pending:
+        flush(pending)
+
+    return report
+
+
+@db.read_only
+def get_taken_ticket_names(names):
+    """
+    Looks up which of many ticket names are already taken, with one query
+    :param names: The ticket names to look for
+    :return: The set of names that a ticket already has
+    """
+    if not names:
+        return set()
+    return {row.name for row in db.session.query(Ticket.name).filter(
+        Ticket.name.in_(set(names)))}
+
+
+@db.writes
+@single_writer
+def insert_tickets(batch):
+    """
+    Inserts a batch of tickets with one multi-row insert and one commit
+    :param batch: A list of (line number, column values) pairs
+    :return: A list of (line number, error message) for the tickets not inserted
+    """
+    try:
+        db.session.execute(Ticket.__table__.insert(),
+                           [values for _, values in batch])
+        bump_catalogue_version(*[values['name'] for _, values in batch])
+        db.session.commit()
+        return []
+    except IntegrityError:
+        db.session.rollback()
+
+    # Some name in the batch is taken, insert one at a time to find which
+    errors = []
+    for line, values in batch:
+        try:
+            db.session.execute(Ticket.__table__.insert(), values)
+            bump_catalogue_version(values['name'])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            errors.append((line, "A ticket with that name already exists."))
+    return errors
+
+
+@db.writes
+@single_writer
 def update_ticket(name, quantity, price, date):
     """
     Updates ticket quantity, price, and expiration date
     :param name: The ticket name to update
-    :param quantity: The new quantity
+    :param quantity: The new quantity, including the tickets held
     :param price: The new price
     :param date: The new expiration date
+    :return: an error message if there is any, or None if the update succeeds
     """
 
-    ticket = get_ticket(name)
+    # Locking the row makes holds wait for this update, so none can land
+    # between counting the held tickets and setting the stock
+    ticket = Ticket.query.filter_by(name=name).with_for_update().first()
+    if ticket is None:
+        db.session.rollback()
+        return 'Ticket does not exist.'
 
-    if ticket is not None:
-        try:
-            ticket.quantity = int(quantity)
-            ticket.price = float(price)
-            ticket.expiration_date = datetime.strptime(date, '%Y%m%d')
-            db.session.commit()
-            return None
-        except:
-            return 'Could not update ticket'
+    try:
+        quantity = int(quantity)
+        # Held tickets are already off Ticket.quantity and come back when
+        # their holds end, so they are taken off the new quantity too
+        held = db.session.query(func.coalesce(func.sum(Hold.quantity), 0)) \
+            .filter(Hold.ticket_name == name).scalar()
+        if quantity < held:
+            db.session.rollback()
+            return 'Quantity can not be less than the {} tickets held.'.format(held)
+        ticket.quantity = quantity - held
+        ticket.price = float(price)
+        ticket.expiration_date = datetime.strptime(date, '%Y%m%d')
+        bump_catalogue_version(name)
+        db.session.commit()
+        return None
+    except:
+        db.session.rollback()
+        return 'Could not update ticket'
 
 
+@db.read_only
 def ticket_exists(name):
     # The ticket name exists in the database
     if get_ticket(name) is None:
@@ -133,6 +717,7 @@ def ticket_exists(name):
         return True
 
 
+@db.read_only
 def enough_tickets(name, quantity):
     # Check type
     try:
@@ -141,21 +726,271 @@ def enough_tickets(name, quantity):
         # Handle the exception
         return False
 
-    # Check ticket exists
-    if not ticket_exists(name):
+    # One lookup both checks the ticket exists and reads its stock
+    ticket = get_ticket(name)
+    if ticket is None:
         return False
 
     # Enough tickets exist in the database to sell
-    ticket = get_ticket(name)
     if quantity > ticket.quantity:
         return False
 
     return True
 
 
+def ticket_cost(price, quantity):
+    # Ticket price * quantity + service fee (35%) + tax (5%), rounded up
+    # to a whole unit since balances are stored as integers
+    return int(math.ceil(price*quantity*1.35*1.05))
+
+
 def enough_balance(balance, price, quantity):
     # The user has more balance than the ticket price * quantity + service fee (35%) + tax (5%)
     if (balance < (price*quantity*1.35*1.05)):
         return False
     else:
         return True
+
+
+@db.writes
+@single_writer
+def purchase_ticket(user, name, quantity):
+    """
+    Buys tickets for a user, taking the stock and the balance in one transaction
+    :param user: The user buying the tickets
+    :param name: The ticket name to buy
+    :param quantity: The number of tickets to buy
+    :return: an error message if there is any, or None if the purchase succeeds
+    """
+    try:
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        return "Invalid ticket."
+    if quantity < 1:
+        # a negative quantity would add stock and credit the balance
+        return "Invalid ticket."
+
+    try:
+        # Conditional UPDATE: the stock check and the decrement happen in a
+        # single statement, so concurrent buyers can never oversell
+        taken = Ticket.query.filter(Ticket.name == name,
+                                    Ticket.quantity >= quantity,
+                                    Ticket.expiration_date >= date.today()) \
+            .update({Ticket.quantity: Ticket.quantity - quantity},
+                    synchronize_session=False)
+
+        if taken == 0:
+            db.session.rollback()
+            # Only the failure path pays for working out why
+            ticket = get_ticket(name)
+            if ticket is None:
+                return "Ticket does not exist."
+            if ticket.expiration_date < date.today():
+                return "Ticket has expired."
+            return "The request quantity is not available."
+
+        # The ticket row is write locked by this transaction from here on,
+        # so the price can not change under us
+        price = db.session.query(Ticket.price).filter(
+            Ticket.name == name).scalar()
+        cost = ticket_cost(price, quantity)
+
+        paid = User.query.filter(User.id == user.id,
+                                 User.balance >= cost) \
+            .update({User.balance: User.balance - cost},
+                    synchronize_session=False)
+
+        if paid == 0:
+            # Give the stock back by discarding the whole transaction
+            db.session.rollback()
+            return "Insufficient balance."
+
+        bump_catalogue_version(name)
+        db.session.commit()
+        invalidate_user(user.id)
+        return None
+    except:
+        db.session.rollback()
+        return "Unable to complete purchase"
+
+
+@db.writes
+@single_writer
+def hold_tickets(user, name, quantity, ttl=None):
+    """
+    Sets tickets aside for a user while they check out, taking them off the
+    stock until the hold is confirmed, released or expires
+    :param user: The user holding the tickets
+    :param name: The ticket name to hold
+    :param quantity: The number of tickets to hold
+    :param ttl: Seconds before the hold expires, HOLD_TTL if not given
+    :return: an error message if there is any, or None if the hold succeeds
+    """
+    try:
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        return "Invalid ticket."
+    if quantity < 1:
+        # a negative hold would add stock, and its confirm credit the balance
+        return "Invalid ticket."
+    if ttl is None:
+        ttl = app.config['HOLD_TTL']
+
+    try:
+        # The same conditional UPDATE as a purchase, so holds and buys
+        # can never take more than the stock between them
+        taken = Ticket.query.filter(Ticket.name == name,
+                                    Ticket.quantity >= quantity,
+                                    Ticket.expiration_date >= date.today()) \
+            .update({Ticket.quantity: Ticket.quantity - quantity},
+                    synchronize_session=False)
+
+        if taken == 0:
+            db.session.rollback()
+            ticket = get_ticket(name)
+            if ticket is None:
+                return "Ticket does not exist."
+            if ticket.expiration_date < date.today():
+                return "Ticket has expired."
+            return "The request quantity is not available."
+
+        db.session.add(Hold(user_id=user.id, ticket_name=name, quantity=quantity,
+                            expires_at=datetime.utcnow() + timedelta(seconds=ttl)))
+        bump_catalogue_version(name)
+        db.session.commit()
+        return None
+    except:
+        db.session.rollback()
+        return "Unable to hold tickets"
+
+
+@db.read_only
+def get_holds(user_id):
+    """
+    Gets the holds of a user that have not expired yet
+    :param user_id: The id of the user
+    :return: The holds, the ones expiring soonest first
+    """
+    return Hold.query.filter(Hold.user_id == user_id,
+                             Hold.expires_at > datetime.utcnow()) \
+        .order_by(Hold.expires_at).all()
+
+
+@db.writes
+@single_writer
+def confirm_hold(user, hold_id):
+    """
+    Buys the tickets of a hold that has not expired, charging the price
+    the ticket has now
+    :param user: The user who made the hold
+    :param hold_id: The id of the hold
+    :return: an error message if there is any, or None if the purchase succeeds
+    """
+    try:
+        hold = db.session.query(Hold.ticket_name, Hold.quantity).filter(
+            Hold.id == hold_id, Hold.user_id == user.id).first()
+        if hold is None:
+            return "Hold does not exist."
+
+        # Conditional DELETE: only one of a confirm and the sweeper can
+        # take the hold, however close to its expiry they run
+        taken = Hold.query.filter(Hold.id == hold_id,
+                                  Hold.expires_at > datetime.utcnow()) \
+            .delete(synchronize_session=False)
+        if taken == 0:
+            db.session.rollback()
+            return "Hold has expired."
+
+        price = db.session.query(Ticket.price).filter(
+            Ticket.name == hold.ticket_name).scalar()
+        cost = ticket_cost(price, hold.quantity)
+
+        paid = User.query.filter(User.id == user.id,
+                                 User.balance >= cost) \
+            .update({User.balance: User.balance - cost},
+                    synchronize_session=False)
+
+        if paid == 0:
+            # Keep the hold, the user may still top up before it expires
+            db.session.rollback()
+            return "Insufficient balance."
+
+        db.session.commit()
+        invalidate_user(user.id)
+        return None
+    except:
+        db.session.rollback()
+        return "Unable to complete purchase"
+
+
+@db.writes
+@single_writer
+def release_hold(user, hold_id):
+    """
+    Gives the tickets of a hold back to the stock before it expires
+    :param user: The user who made the hold
+    :param hold_id: The id of the hold
+    :return: an error message if there is any, or None if it was released
+    """
+    try:
+        hold = db.session.query(Hold.ticket_name, Hold.quantity).filter(
+            Hold.id == hold_id, Hold.user_id == user.id).first()
+        if hold is None:
+            return "Hold does not exist."
+
+        taken = Hold.query.filter(Hold.id == hold_id).delete(synchronize_session=False)
+        if taken == 0:
+            # the sweeper released it first
+            db.session.rollback()
+            return None
+        Ticket.query.filter(Ticket.name == hold.ticket_name) \
+            .update({Ticket.quantity: Ticket.quantity + hold.quantity},
+                    synchronize_session=False)
+        bump_catalogue_version(hold.ticket_name)
+        db.session.commit()
+        return None
+    except:
+        db.session.rollback()
+        return "Unable to release hold"
+
+
+@single_writer
+def release_expired_holds(limit=None):
+    """
+    Gives the tickets of expired holds back to the stock, in one transaction
+    with one update per ticket. Reads only the expired holds, through the
+    expires_at index.
+    :param limit: The most holds to release, HOLD_SWEEP_BATCH if not given
+    :return: The number of holds released
+    """
+    if limit is None:
+        limit = app.config['HOLD_SWEEP_BATCH']
+    now = datetime.utcnow()
+    try:
+        expired = db.session.query(Hold.id, Hold.ticket_name, Hold.quantity) \
+            .filter(Hold.expires_at <= now).order_by(Hold.expires_at) \
+            .limit(limit).with_for_update().all()
+        if not expired:
+            db.session.rollback()
+            return 0
+
+        released = Hold.query.filter(Hold.id.in_([hold.id for hold in expired])) \
+            .delete(synchronize_session=False)
+        if released != len(expired):
+            # some were confirmed or released meanwhile, try again next time
+            db.session.rollback()
+            return 0
+
+        totals = {}
+        for hold in expired:
+            totals[hold.ticket_name] = totals.get(hold.ticket_name, 0) + hold.quantity
+        for name, quantity in totals.items():
+            Ticket.query.filter(Ticket.name == name) \
+                .update({Ticket.quantity: Ticket.quantity + quantity},
+                        synchronize_session=False)
+        bump_catalogue_version(*totals)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        return 0
+    return len(expired)
@@ -0,0 +1,133 @@
+from qa327 import app
+import argparse
+import csv
+import io
+import json
+import qa327.backend as bn
+import sys
+
+"""
+This file reads ticket uploads for bulk imports.
+
+Two formats are accepted, both read one row at a time:
+
+CSV with a header row naming the columns name, quantity, price and date
+
+    name,quantity,price,date
+    concert1,100,45,20771210
+
+NDJSON with one ticket object per line
+
+    {"name": "concert1", "quantity": 100, "price": 45, "date": "20771210"}
+
+Each reader yields (line number, ticket) pairs for backend.import_tickets,
+where ticket is a (name, quantity, price, date) tuple or, for a row that
+could not be read, an error message.
+
+The same import can be run from the command line:
+
+    python -m qa327.bulk tickets.csv
+"""
+
+COLUMNS = ('name', 'quantity', 'price', 'date')
+FORMATS = ('csv', 'ndjson')
+
+
+def read_csv(stream):
+    """
+    :param stream: a text stream of CSV
+    """
+    reader = csv.DictReader(stream)
+    missing = [column for column in COLUMNS
+               if column not in (reader.fieldnames or ())]
+    if missing:
+        yield 1, 'Missing columns: ' + ', '.join(missing)
+        return
+    for row in reader:
+        # line_num is the line the row ended on, which is the row's line
+        # unless a quoted field spans several lines
+        if None in row or None in row.values():
+            # DictReader keys extra fields by None and fills short rows with it
+            yield reader.line_num, 'Row must have {} columns, like the header'.format(
+                len(reader.fieldnames))
+            continue
+        yield reader.line_num, tuple(row[column] for column in COLUMNS)
+
+
+def read_ndjson(stream):
+    """
+    :param stream: a text stream with one JSON object per line
+    """
+    for line, text in enumerate(stream, start=1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+            yield line, tuple(str(row[column]) for column in COLUMNS)
+        except (ValueError, TypeError, KeyError):
+            yield line, 'Row must be a JSON object with ' + ', '.join(COLUMNS)
+
+
+def guess_format(filename, content_type):
+    """
+    Work out the upload format from its file name or content type
+    :return: 'csv', 'ndjson' or None
+    """
+    filename = (filename or '').lower()
+    content_type = (content_type or '').lower()
+    if filename.endswith('.csv') or 'csv' in content_type:
+        return 'csv'
+    if filename.endswith(('.ndjson', '.jsonl')) or 'ndjson' in content_type:
+        return 'ndjson'
+    return None
+
+
+def read_tickets(stream, upload_format):
+    """
+    :param stream: a binary stream of the upload
+    :param upload_format: 'csv' or 'ndjson'
+    :return: the (line number, ticket) pairs of the upload, ending with an
+        error for the line reading stopped at if the upload is not UTF-8
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    rows = read_csv(text) if upload_format == 'csv' else read_ndjson(text)
+    line = 0
+    try:
+        for line, ticket in rows:
+            yield line, ticket
+    except UnicodeDecodeError:
+        # the text is decoded a block at a time, so the rest of the block
+        # the bad bytes are in is not read either
+        yield line + 1, 'File is not UTF-8, nothing from this line on was read'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import tickets from a CSV or NDJSON file')
+    parser.add_argument('file', help='the file to import, - for stdin')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='the file format, guessed from the name if not given')
+    parser.add_argument('--batch-size', type=int,
+                        help='tickets inserted per commit')
+    args = parser.parse_args()
+
+    upload_format = args.format or guess_format(args.file, None)
+    if upload_format is None:
+        parser.error('can not tell the format of {}, use --format'.format(args.file))
+
+    with app.app_context():
+        if args.file == '-':
+            rows = read_tickets(sys.stdin.buffer, upload_format)
+            report = bn.import_tickets(rows, args.batch_size)
+        else:
+            with open(args.file, 'rb') as stream:
+                rows = read_tickets(stream, upload_format)
+                report = bn.import_tickets(rows, args.batch_size)
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
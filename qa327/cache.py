@@ -0,0 +1,72 @@
+from collections import OrderedDict
+import threading
+import time
+
+"""
+This file defines the in-process caches used to keep hot reads away from the database
+"""
+
+
+class LRUCache:
+    """
+    A thread safe least recently used cache whose entries expire after a time to live.
+
+    Each worker process has its own copy, so anything cached here can be up
+    to ttl seconds behind changes made by other processes. Changes made by
+    this process should call invalidate so they are seen straight away.
+    """
+
+    def __init__(self, maxsize, ttl):
+        """
+        :param maxsize: The number of entries kept before the oldest is evicted
+        :param ttl: The number of seconds an entry stays valid
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get a cached value
+        :param key: The key the value was stored under
+        :param default: Returned when the key is missing or expired
+        :return: The cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Store a value, evicting the least recently used entry if the cache is full
+        :param key: The key to store the value under
+        :param value: The value to store
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Drop a cached value so the next get misses
+        :param key: The key to drop
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
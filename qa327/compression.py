@@ -0,0 +1,79 @@
+from flask import request
+from qa327 import app
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+This file compresses responses on the fly.
+
+Responses of a compressible type and at least COMPRESS_MIN_SIZE bytes
+are sent with brotli when the client accepts it and the brotli package
+is installed, and with gzip otherwise. Files and streamed responses are
+sent as they are; prebuilt assets have their own precompressed copies.
+"""
+
+COMPRESSIBLE = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+}
+
+
+def choose_encoding(accepted):
+    """
+    :param accepted: the parsed Accept-Encoding header of the request
+    :return: 'br', 'gzip' or None
+    """
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def encode(data, encoding):
+    """
+    :param data: the response body
+    :param encoding: 'br' or 'gzip', from choose_encoding
+    :return: the compressed body
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=app.config['COMPRESS_GZIP_LEVEL'])
+
+
+@app.after_request
+def compress(response):
+    if response.direct_passthrough or response.is_streamed \
+            or not 200 <= response.status_code < 300 \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE:
+        return response
+
+    # caches must keep one copy per encoding, whether or not this one is compressed
+    response.vary.add('Accept-Encoding')
+
+    if response.content_length is None or \
+            response.content_length < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    response.set_data(encode(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+
+    # the compressed bytes differ from the uncompressed ones, so only a weak
+    # validator still describes both
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,237 @@
+from flask import Response, request
+from qa327 import app
+from qa327.frontend import ticket_json
+from qa327.models import db
+from sqlalchemy.exc import DatabaseError
+import json
+import os
+import queue
+import threading
+import qa327.backend as bn
+
+"""
+This file defines /events/tickets, a Server-Sent Events stream that
+pushes ticket changes to open profile pages, so they stay current
+without reloading.
+
+Each process runs one poller thread while it has clients. The poller
+looks up the catalogue version every EVENTS_POLL_INTERVAL seconds, or
+straight away after a write in this process, and when it moved reads
+the changed tickets from the change log once. Each change is formatted
+once and handed to every client of the process by the broadcaster, so
+N clients cost one query and N queue puts, not N page renders.
+
+Events:
+
+    event: ticket     data is one changed ticket, as the JSON API sends it
+    event: resync     too much changed, reload the ticket list
+
+Every event carries the catalogue version as its id. A reconnecting
+browser sends it back as Last-Event-ID, and pages pass the version they
+were rendered at as ?since=, so a client that may have missed changes
+is told to resync.
+"""
+
+# sent for a client whose view of the tickets can not be patched up
+RESYNC = 'resync'
+
+
+def format_event(event, data, version=None):
+    """
+    :param event: the event name
+    :param data: the JSON data of the event
+    :param version: the catalogue version the event brings the client to
+    :return: the event in the text/event-stream format
+    """
+    lines = []
+    if version is not None:
+        lines.append('id: {}'.format(version))
+    lines.append('event: {}'.format(event))
+    lines.append('data: {}'.format(json.dumps(data, separators=(',', ':'))))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Broadcaster:
+    """
+    Hands each message to the queue of every client of this process
+    """
+
+    def __init__(self, queue_size):
+        self.lock = threading.Lock()
+        self.queue_size = queue_size
+        self.queues = set()
+
+    def __len__(self):
+        return len(self.queues)
+
+    def subscribe(self, limit=None):
+        """
+        :param limit: the most clients allowed at once
+        :return: a new client's queue, or None if there are `limit` already
+        """
+        with self.lock:
+            if limit is not None and len(self.queues) >= limit:
+                return None
+            client = queue.Queue(self.queue_size)
+            self.queues.add(client)
+            return client
+
+    def attach(self, client):
+        """
+        Subscribe a client made elsewhere, any object with a put_nowait
+        method, e.g. the relay of the event loop in qa327/asgi.py
+        """
+        with self.lock:
+            self.queues.add(client)
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.queues.discard(client)
+
+    def publish(self, message):
+        with self.lock:
+            clients = list(self.queues)
+        for client in clients:
+            try:
+                client.put_nowait(message)
+            except queue.Full:
+                # a client this far behind gets the whole list again
+                # instead of every change it missed
+                _replace_backlog(client, resync_message())
+
+
+def _replace_backlog(client, message):
+    while True:
+        try:
+            client.get_nowait()
+        except queue.Empty:
+            break
+    try:
+        client.put_nowait(message)
+    except queue.Full:
+        pass
+
+
+def resync_message(version=None):
+    return format_event(RESYNC, {}, version)
+
+
+broadcaster = Broadcaster(app.config['EVENTS_QUEUE_SIZE'])
+_wake_up = threading.Event()
+_poller_lock = threading.Lock()
+_poller_pid = None
+# the catalogue version the poller has published up to, None while
+# this process has no clients
+_published = None
+
+
+def poll_once(version):
+    """
+    Publish the ticket changes made after a catalogue version
+    :param version: the last version published
+    :return: the version published up to
+    """
+    with app.app_context():
+        try:
+            current, tickets = bn.get_ticket_changes(version)
+            # trim the change log each time half of it has been used up
+            half = app.config['TICKET_CHANGE_LOG_SIZE'] // 2
+            if current // half != version // half:
+                bn.trim_ticket_changes()
+        except DatabaseError:
+            app.logger.exception('could not read the ticket changes')
+            return version
+        finally:
+            db.session.remove()
+
+    if tickets is None:
+        broadcaster.publish(resync_message(current))
+    for ticket in tickets or ():
+        broadcaster.publish(format_event('ticket', ticket_json(ticket), current))
+    return current
+
+
+def _poll_forever(interval):
+    global _published
+    while True:
+        _wake_up.wait(interval)
+        _wake_up.clear()
+        with _poller_lock:
+            if not len(broadcaster):
+                # nobody is listening, the next client starts us again
+                # from the version it has seen
+                _published = None
+            version = _published
+        if version is None:
+            continue
+        version = poll_once(version)
+        with _poller_lock:
+            if _published is not None:
+                _published = version
+
+
+def start_poller(version):
+    """
+    Start the poller of this process, once per process: threads do not
+    survive a fork, so each worker starts its own
+    :param version: the catalogue version a new client has seen
+    """
+    global _poller_pid, _published
+    with _poller_lock:
+        if _published is None:
+            _published = version
+        if _poller_pid != os.getpid():
+            _poller_pid = os.getpid()
+            threading.Thread(target=_poll_forever, name='ticket-events', daemon=True,
+                             args=(app.config['EVENTS_POLL_INTERVAL'],)).start()
+
+
+bn.catalogue_listeners.append(_wake_up.set)
+
+
+@app.route('/events/tickets')
+def ticket_events():
+    # The version the client last saw, from the page or a reconnect
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        since = None
+
+    client = broadcaster.subscribe(app.config['EVENTS_MAX_CLIENTS'])
+    if client is None:
+        response = Response('Too many live clients, try again later.\n',
+                            status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = '30'
+        return response
+    # Read the version after subscribing: a change published in between
+    # is then both queued and covered by the resync, never lost
+    try:
+        version = bn.get_catalogue_version()
+    except DatabaseError:
+        broadcaster.unsubscribe(client)
+        raise
+    start_poller(version)
+
+    def stream():
+        # The request context, and with it the database session, is gone
+        # by now: an open stream holds a queue and a thread, no connection
+        yield 'retry: {}\n\n'.format(app.config['EVENTS_RETRY_MS'])
+        if since is not None and since != version:
+            yield resync_message(version)
+        while True:
+            try:
+                yield client.get(timeout=app.config['EVENTS_HEARTBEAT'])
+            except queue.Empty:
+                # a comment line keeps proxies from closing an idle
+                # stream, and finds clients that have gone away
+                yield ': keep-alive\n\n'
+
+    response = Response(stream(), mimetype='text/event-stream')
+    # the server closes the response when the client goes away, even
+    # if the stream never started
+    response.call_on_close(lambda: broadcaster.unsubscribe(client))
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx would otherwise buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
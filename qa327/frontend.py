@@ -1,7 +1,19 @@
-from flask import flash, render_template, request, session, redirect
+from flask import flash, jsonify, make_response, render_template, request, session, redirect, Markup
+from datetime import date
+from functools import wraps
+from urllib.parse import urlencode
+import hashlib
+import math
 from qa327 import app
 from qa327.backend import enough_balance, enough_tickets, ticket_exists
-from qa327.utils import validate_email, validate_name, validate_password, validate_ticket, validate_ticket_date, validate_ticket_name, validate_ticket_price, validate_ticket_quantity
+from qa327.utils import parse_ticket_date, validate_email, validate_name, validate_password, validate_ticket, validate_ticket_date, validate_ticket_name, validate_ticket_price, validate_ticket_quantity
+from qa327.assets import load_manifest
+from qa327.bulk import FORMATS, guess_format, read_tickets
+from qa327.cache import LRUCache
+from qa327.models import db
+from qa327.passwords import HashingBusy
+from qa327.pool import pool_status
+from qa327.ratelimit import check_attempt
 import qa327.backend as bn
 
 """
@@ -11,6 +23,25 @@ http requests from the client (browser) through templating.
 The html templates are stored in the 'templates' folder. 
 """
 
+# Rendered ticket lists, see render_ticket_list
+ticket_list_cache = LRUCache(app.config['TICKET_LIST_CACHE_SIZE'],
+                             app.config['TICKET_LIST_CACHE_TTL'])
+
+
+def hash_page_sources():
+    """
+    Hash the templates and the asset manifest, so cached pages are
+    revalidated after a deploy changes how they look
+    """
+    digest = hashlib.sha1()
+    for name in sorted(app.jinja_env.list_templates()):
+        digest.update(app.jinja_env.loader.get_source(app.jinja_env, name)[0].encode('utf-8'))
+    digest.update(repr(sorted(load_manifest().items())).encode('utf-8'))
+    return digest.hexdigest()
+
+
+page_version = hash_page_sources()
+
 
 @app.route('/register', methods=['GET'])
 def register_get():
@@ -21,6 +52,16 @@ def register_get():
     return render_template('register.html', message='')
 
 
+def too_many_attempts(template, wait):
+    """
+    The form again, refused with 429 Too Many Requests
+    :param template: the form's template
+    :param wait: the seconds before the client may try again
+    """
+    message = 'Too many attempts, please try again in {} seconds.'.format(wait)
+    return render_template(template, message=message), 429, {'Retry-After': str(wait)}
+
+
 @app.route('/register', methods=['POST'])
 def register_post():
     email = request.form.get('email')
@@ -29,6 +70,11 @@ def register_post():
     password2 = request.form.get('password2')
     error_message = None
 
+    # before any lookup or hashing, so refused attempts cost next to nothing
+    wait = check_attempt('register', request.remote_addr, email)
+    if wait is not None:
+        return too_many_attempts('register.html', wait)
+
     # These helper functions return the error with a field if there is any, or False otherwise
     email_error = validate_email(email)
     name_error = validate_name(name)
@@ -74,24 +120,33 @@ def login_post():
     error_message = 'email/password combination incorrect'
     user = None
 
+    # before any lookup or hashing, so refused attempts cost next to nothing
+    wait = check_attempt('login', request.remote_addr, email)
+    if wait is not None:
+        return too_many_attempts('login.html', wait)
+
     # Check each condition and provide appropriate error message
     if len(password) == 0 and len(email) == 0:
         error_message = 'login failed'
     elif validate_email(email) is not False or validate_password(password) is not False:
         error_message = 'email/password format is incorrect.'
     else:
-        user = bn.login_user(email, password)
+        try:
+            user = bn.login_user(email, password)
+        except HashingBusy:
+            error_message = 'Too many logins right now, please try again.'
 
     if user:
-        session['logged_in'] = user.email
+        session['logged_in'] = user.id
         """
         Session is an object that contains sharing information 
         between browser and the end server. Typically it is encrypted 
         and stored in the browser cookies. They will be past 
         along between every request the browser made to this services.
 
-        Here we store the user object into the session, so we can tell
+        Here we store the user id into the session, so we can tell
         if the client has already login in the following sessions.
+        The session cookie is signed, so the id can not be forged.
 
         """
         # success! go back to the home page
@@ -124,20 +179,21 @@ def authenticate(inner_function):
         pass
     """
 
-    def wrapped_inner():
+    @wraps(inner_function)
+    def wrapped_inner(**kwargs):
         user = None
         # check did we store the key in the session
         if 'logged_in' in session:
-            email = session['logged_in']
-            user = bn.get_user(email)
+            user_id = session['logged_in']
+            user = bn.get_user_by_id(user_id)
 
             if user is None:
                 del session['logged_in']
 
         if user:
             # if the user exists, call the inner_function
-            # with user as parameter
-            return inner_function(user)
+            # with user as parameter, and any values from the url
+            return inner_function(user, **kwargs)
         else:
             # else, redirect to the login page
             return redirect('/login')
@@ -178,6 +234,30 @@ def sell():
     return redirect('/')
 
 
+@app.route('/sell/bulk', methods=['POST'])
+@authenticate
+def sell_bulk(user):
+    """
+    Imports many tickets from a CSV or NDJSON upload, either as the 'file'
+    field of a form or as the raw request body. The upload is read and
+    inserted row by row, and a JSON report of the failed rows is returned.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        stream = upload.stream
+        upload_format = guess_format(upload.filename, upload.content_type)
+    else:
+        stream = request.stream
+        upload_format = guess_format(None, request.content_type)
+    upload_format = request.args.get('format', upload_format)
+
+    if upload_format not in FORMATS:
+        return jsonify(error='Upload must be CSV or NDJSON.'), 400
+
+    report = bn.import_tickets(read_tickets(stream, upload_format))
+    return jsonify(report)
+
+
 @app.route('/update', methods=['POST'])
 def update():
     name = request.form.get('name')
@@ -194,11 +274,8 @@ def update():
             error_message = None
 
     if error_message == None:
-        # The ticket of the given name must exist
-        if not bn.ticket_exists(name):
-            error_message = 'Ticket does not exist.'
-        else:
-            error_message = bn.update_ticket(name, quantity, price, date)
+        # The ticket of the given name must exist, which the update checks
+        error_message = bn.update_ticket(name, quantity, price, date)
 
     if error_message is not None:
         flash(error_message)
@@ -210,30 +287,70 @@ def update():
 
 
 @app.route('/buy', methods=['POST'])
-def buy():
+@authenticate
+def buy(user):
     name = request.form.get('name')
     quantity = request.form.get('quantity')
 
     name_error = validate_ticket_name(name)
     quantity_error = validate_ticket_quantity(quantity) is not False
-    exists_error = bn.ticket_exists(name) is False
-    enough_error = bn.enough_tickets(name, quantity) is False
-    # user = bn.get_user(session['logged_in'])
-    # balance_error = bn.enough_balance(user.balance, price, quantity)
 
     if name_error or quantity_error:
         flash("Invalid ticket.")
-    elif exists_error:
-        flash("Ticket does not exist.")
-    elif enough_error:
-        flash("The request quantity is not available.")
-    # if balance_error:
-    #     flash("Insufficient balance")
+    else:
+        # Stock, balance and existence are all checked by the purchase itself
+        purchase_error = bn.purchase_ticket(user, name, quantity)
+        if purchase_error:
+            flash(purchase_error)
 
     # For any errors, redirect back to / and show an error message
     return redirect('/')
 
 
+@app.route('/search')
+@authenticate
+def search(user):
+    # Type-ahead for ticket names, e.g. /search?q=conc&limit=10
+    query = request.args.get('q', '')
+    tickets = bn.search_tickets(query, search_limit(request.args))
+    return jsonify(query=query, tickets=[ticket_json(ticket) for ticket in tickets])
+
+
+def search_limit(args):
+    """
+    :param args: The query string values of a search
+    :return: The number of tickets to return, SEARCH_LIMIT unless a valid
+        limit up to SEARCH_MAX_LIMIT was asked for
+    """
+    try:
+        limit = int(args.get('limit', app.config['SEARCH_LIMIT']))
+    except ValueError:
+        limit = app.config['SEARCH_LIMIT']
+    return max(1, min(limit, app.config['SEARCH_MAX_LIMIT']))
+
+
+def ticket_json(ticket):
+    """
+    :param ticket: A ticket
+    :return: The ticket as JSON data, as the search and the API send it
+    """
+    return {
+        'name': ticket.name,
+        'quantity': ticket.quantity,
+        'price': ticket.price,
+        'date': ticket.expiration_date.strftime('%Y%m%d'),
+    }
+
+
+@app.route('/metrics/pool')
+def pool_metrics():
+    # Connection pool numbers for sizing DB_POOL_SIZE against the server threads
+    status = pool_status(db.engine)
+    if app.config['REPLICA_URLS']:
+        status['replicas'] = db.router.status()
+    return jsonify(status)
+
+
 @app.route('/')
 @authenticate
 def profile(user):
@@ -242,8 +359,100 @@ def profile(user):
     # by using @authenticate, we don't need to re-write
     # the login checking code all the time for other
     # front-end portals
-    tickets = bn.get_all_tickets()
-    return render_template('index.html', user=user, tickets=tickets)
+    # Read the version before the tickets: if a write lands in between,
+    # the cached list is newer than its key, never older
+    version = bn.get_catalogue_version()
+    holds = bn.get_holds(user.id)
+
+    # Pages showing flashed messages are one-offs and never revalidated
+    etag = None
+    if '_flashes' not in session:
+        etag = profile_etag(user, version, holds)
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+    response = make_response(render_template(
+        'index.html', user=user, holds=holds, tickets_html=render_ticket_list(version)))
+    if etag is not None:
+        response.set_etag(etag)
+    # browsers may keep the page but must check it is current before reuse
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def profile_etag(user, version, holds):
+    """
+    Build the validator for a user's profile page. It covers everything the
+    page shows: the user and their holds, the tickets on the requested page,
+    the date that decides which tickets have expired, and the templates and
+    assets.
+    :return: The ETag value
+    """
+    parts = (user.id, user.name, user.balance, [hold.id for hold in holds],
+             version, date.today(),
+             request.args.get('after'), request.args.get('before'),
+             sorted(ticket_filters()[1].items()), page_version)
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def ticket_filters(args=None):
+    """
+    Read the ticket list filters and sort order from the query string,
+    ignoring any value that is not valid
+    :param args: The query string values, those of the current request
+        if not given
+    :return: The keyword arguments for get_all_tickets, and the accepted
+        query string values to carry over to the other pages
+    """
+    if args is None:
+        args = request.args
+    filters, accepted = {}, {}
+    for name, convert in (('min_price', float), ('max_price', float),
+                          ('min_quantity', int)):
+        try:
+            value = convert(args[name])
+        except (KeyError, ValueError):
+            continue
+        if math.isfinite(value):
+            filters[name], accepted[name] = value, args[name]
+    for name in ('expires_from', 'expires_to'):
+        parsed = parse_ticket_date(args.get(name))
+        if parsed is not None:
+            filters[name], accepted[name] = date(*parsed), args[name]
+    if args.get('sort') in bn.TICKET_SORTS:
+        filters['sort'] = accepted['sort'] = args['sort']
+    return filters, accepted
+
+
+def render_ticket_list(version):
+    """
+    Render the ticket list for the requested page. The catalogue is the same
+    for every user and only changes when tickets are written, so the rendered
+    list is cached under the catalogue version and the current date (tickets
+    drop off the list when they expire), and only rebuilt when either changes.
+    :param version: The catalogue version read before the tickets
+    :return: The ticket list html
+    """
+    filters, accepted = ticket_filters()
+    key = (version, date.today(), tuple(sorted(accepted.items())),
+           request.args.get('after'), request.args.get('before'))
+    tickets_html = ticket_list_cache.get(key)
+    if tickets_html is None:
+        if 'before' in request.args:
+            page = bn.get_all_tickets(request.args['before'], backwards=True, **filters)
+        else:
+            page = bn.get_all_tickets(request.args.get('after'), **filters)
+        tickets_html = Markup(render_template(
+            'tickets.html', page=page, version=version,
+            filter_query=urlencode(sorted(accepted.items()))))
+        ticket_list_cache.set(key, tickets_html)
+    return tickets_html
 
 # custom page for 404 error
 
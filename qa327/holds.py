@@ -0,0 +1,104 @@
+from flask import flash, redirect, request
+from qa327 import app
+from qa327.frontend import authenticate
+from qa327.models import db
+from qa327.utils import validate_ticket_name, validate_ticket_quantity
+from sqlalchemy.exc import DatabaseError
+import os
+import threading
+import time
+import qa327.backend as bn
+
+"""
+This file defines the routes that hold tickets while a user checks out,
+and the sweeper that gives back the tickets of expired holds.
+
+    POST /hold                       hold `quantity` of ticket `name`
+    POST /holds/<id>/confirm         buy the held tickets
+    POST /holds/<id>/release         give them back early
+
+A hold takes its tickets off the stock straight away, so the listings
+and the live events show what is left for everyone else, and lasts
+HOLD_TTL seconds. Each process runs a sweeper thread that releases the
+expired holds every HOLD_SWEEP_INTERVAL seconds, HOLD_SWEEP_BATCH at a
+time; a hold confirmed after it expired is refused even if the sweeper
+has not got to it yet.
+"""
+
+_sweeper_lock = threading.Lock()
+_sweeper_pid = None
+
+
+def sweep():
+    """
+    Release every expired hold, a batch at a time
+    :return: The number of holds released
+    """
+    released = 0
+    with app.app_context():
+        try:
+            while True:
+                batch = bn.release_expired_holds()
+                released += batch
+                if batch < app.config['HOLD_SWEEP_BATCH']:
+                    return released
+        except DatabaseError:
+            app.logger.exception('could not release the expired holds')
+            return released
+        finally:
+            db.session.remove()
+
+
+def _sweep_forever(interval):
+    while True:
+        time.sleep(interval)
+        sweep()
+
+
+@app.before_first_request
+def start_sweeper():
+    """
+    Start the sweeper of this process, once per process: threads do not
+    survive a fork, so each worker starts its own
+    """
+    global _sweeper_pid
+    with _sweeper_lock:
+        if _sweeper_pid != os.getpid():
+            _sweeper_pid = os.getpid()
+            threading.Thread(target=_sweep_forever, name='hold-sweeper', daemon=True,
+                             args=(app.config['HOLD_SWEEP_INTERVAL'],)).start()
+
+
+@app.route('/hold', methods=['POST'])
+@authenticate
+def hold(user):
+    name = request.form.get('name')
+    quantity = request.form.get('quantity')
+
+    if validate_ticket_name(name) or validate_ticket_quantity(quantity) is not False:
+        flash("Invalid ticket.")
+    else:
+        hold_error = bn.hold_tickets(user, name, quantity)
+        if hold_error:
+            flash(hold_error)
+        else:
+            flash("Tickets held for {} minutes.".format(app.config['HOLD_TTL'] // 60))
+    return redirect('/')
+
+
+@app.route('/holds/<int:hold_id>/confirm', methods=['POST'])
+@authenticate
+def confirm_hold(user, hold_id):
+    confirm_error = bn.confirm_hold(user, hold_id)
+    if confirm_error:
+        flash(confirm_error)
+    return redirect('/')
+
+
+@app.route('/holds/<int:hold_id>/release', methods=['POST'])
+@authenticate
+def release_hold(user, hold_id):
+    release_error = bn.release_hold(user, hold_id)
+    if release_error:
+        flash(release_error)
+    return redirect('/')
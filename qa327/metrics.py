@@ -0,0 +1,436 @@
+from flask import Response, g, request
+from qa327 import app
+from qa327.models import db
+from qa327.pool import pool_status
+import atexit
+import json
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import os
+import threading
+import time
+
+"""
+This file instruments every request and serves the numbers on /metrics
+in the Prometheus text format.
+
+For each endpoint and method it keeps a latency histogram, the number
+of requests in flight and a count of responses per status code. The
+histograms use HDR-style buckets: every power of two is split into
+SUB_BUCKETS equal steps, so any latency from a microsecond to hours is
+recorded within 1/SUB_BUCKETS of its value in a fixed amount of memory.
+
+Each worker process has its own numbers. When METRICS_DIR is set, every
+process writes a snapshot of them to <METRICS_DIR>/<pid>.json each
+METRICS_FLUSH_INTERVAL seconds and when it exits, and /metrics adds up
+the snapshots of all processes, so it does not matter which worker
+answers the scrape. Processes that have exited still count towards the
+totals, but not towards the in-flight and connection pool gauges: the
+first scrape after a process exits adds its snapshot into exited.json
+and deletes it, so recycled workers do not pile up files. The
+production server in qa327/wsgi.py sets METRICS_DIR up automatically.
+"""
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# latencies are recorded in microseconds, up to 2**36 us (about 19 hours)
+MAX_MAGNITUDE = 36
+
+# the Prometheus buckets, powers of two from 256 us to 16.8 s, line up
+# with the edges of the histogram buckets so their counts are exact
+EXPORT_BOUNDS = [1 << k for k in range(8, 25)]
+QUANTILES = (0.5, 0.95, 0.99)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# the added up snapshots of the processes that have exited
+EXITED = 'exited.json'
+
+
+def bucket_index(micros):
+    """
+    :param micros: a latency in whole microseconds
+    :return: the index of the histogram bucket it falls in
+    """
+    micros = min(max(micros, 0), (1 << (MAX_MAGNITUDE + 1)) - 1)
+    if micros < SUB_BUCKETS:
+        return micros
+    magnitude = micros.bit_length() - 1
+    shift = magnitude - SUB_BUCKET_BITS
+    return SUB_BUCKETS + shift * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS
+
+
+def bucket_lower_bound(index):
+    """
+    :param index: a histogram bucket index
+    :return: the smallest latency in microseconds the bucket holds
+    """
+    if index < SUB_BUCKETS:
+        return index
+    shift, step = divmod(index - SUB_BUCKETS, SUB_BUCKETS)
+    return (SUB_BUCKETS + step) << shift
+
+
+class Histogram:
+    """
+    Latency counts in log-linear buckets, with the total and sum of all samples
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        index = bucket_index(int(seconds * 1e6))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+
+    def cumulative(self, bound):
+        """
+        :param bound: a latency in microseconds at a power of two
+        :return: the number of samples below it
+        """
+        return sum(count for index, count in self.counts.items()
+                   if bucket_lower_bound(index + 1) <= bound)
+
+    def quantile(self, fraction):
+        """
+        :return: the latency in seconds that fraction of the samples are under,
+            rounded up to the end of its bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return bucket_lower_bound(index + 1) / 1e6
+        return bucket_lower_bound(max(self.counts) + 1) / 1e6
+
+    def to_dict(self):
+        return {'counts': {str(index): count for index, count in self.counts.items()},
+                'count': self.count, 'sum': self.sum}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts = {int(index): count for index, count in data['counts'].items()}
+        histogram.count = data['count']
+        histogram.sum = data['sum']
+        return histogram
+
+
+class Registry:
+    """
+    The request numbers of one process, keyed by "METHOD endpoint"
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.statuses = {}
+        self.in_flight = {}
+
+    def started(self, key):
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+    def finished(self, key, status, seconds):
+        with self.lock:
+            self.in_flight[key] -= 1
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(seconds)
+            status_key = '{} {}'.format(key, status)
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+
+    def snapshot(self):
+        """
+        :return: the numbers of this process as plain data, for writing as JSON
+        """
+        with self.lock:
+            snapshot = {
+                'pid': os.getpid(),
+                'histograms': {key: histogram.to_dict()
+                               for key, histogram in self.histograms.items()},
+                'statuses': dict(self.statuses),
+                'in_flight': dict(self.in_flight),
+            }
+        with app.app_context():
+            snapshot['pool'] = pool_status(db.engine)
+        return snapshot
+
+
+registry = Registry()
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def request_key():
+    # the url rule rather than the path, so the number of series stays bounded
+    rule = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+    return '{} {}'.format(request.method, rule)
+
+
+@app.before_request
+def start_timer():
+    start_flusher()
+    g.metrics_key = request_key()
+    g.metrics_start = time.perf_counter()
+    registry.started(g.metrics_key)
+
+
+@app.after_request
+def remember_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def stop_timer(exc):
+    if 'metrics_start' not in g:
+        return
+    status = g.get('metrics_status', 500 if exc is not None else 200)
+    registry.finished(g.metrics_key, status,
+                      time.perf_counter() - g.metrics_start)
+
+
+def write_snapshot(directory):
+    """
+    Write this process's numbers to <directory>/<pid>.json
+    """
+    path = os.path.join(directory, '{}.json'.format(os.getpid()))
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(registry.snapshot(), f)
+    # readers never see a half written file
+    os.replace(temporary, path)
+
+
+def _flush_forever(directory, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot(directory)
+        except OSError:
+            app.logger.exception('could not write the metrics snapshot')
+
+
+def start_flusher():
+    """
+    Start writing snapshots from this process, once per process: threads
+    do not survive a fork, so each worker starts its own
+    """
+    global _flusher_pid
+    directory = app.config['METRICS_DIR']
+    if directory is None or _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=_flush_forever, name='metrics-flusher', daemon=True,
+                         args=(directory, app.config['METRICS_FLUSH_INTERVAL'])).start()
+        atexit.register(write_snapshot, directory)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect(directory):
+    """
+    Read the snapshots of every process, with a fresh one for this process
+    :param directory: the METRICS_DIR, or None for this process only
+    :return: the snapshots
+    """
+    snapshots = {os.getpid(): registry.snapshot()}
+    if directory is None or not os.path.isdir(directory):
+        return list(snapshots.values())
+    fold_exited(directory)
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        snapshots.setdefault(snapshot['pid'], snapshot)
+    return list(snapshots.values())
+
+
+def fold_exited(directory):
+    """
+    Add the snapshots of exited processes into EXITED and delete them, so
+    the directory holds one file per running process plus one
+    :param directory: the METRICS_DIR
+    """
+    if fcntl is None:
+        return
+    with open(os.path.join(directory, 'fold.lock'), 'w') as lock:
+        # one process at a time, or two scrapes could add the same snapshot
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(directory, EXITED)
+        try:
+            with open(path) as f:
+                exited = json.load(f)
+        except (OSError, ValueError):
+            exited = {'pid': 0, 'histograms': {}, 'statuses': {},
+                      'in_flight': {}, 'folded': []}
+        # files added last time but not deleted, e.g. after a crash in between
+        done = {tuple(entry) for entry in exited.get('folded', [])}
+
+        folded = []
+        for name in os.listdir(directory):
+            stem, ext = os.path.splitext(name)
+            if ext != '.json' or not stem.isdigit() or int(stem) == os.getpid() \
+                    or is_alive(int(stem)):
+                continue
+            try:
+                entry = (name, os.stat(os.path.join(directory, name)).st_mtime_ns)
+                if entry not in done:
+                    with open(os.path.join(directory, name)) as f:
+                        snapshot = json.load(f)
+                    merge_snapshot(exited, snapshot)
+            except (OSError, ValueError):
+                continue
+            folded.append(entry)
+        if not folded:
+            return
+
+        exited['folded'] = folded
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(exited, f)
+        os.replace(temporary, path)
+        for name, _ in folded:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def merge_snapshot(total, snapshot):
+    """
+    Add the counters of a snapshot to another, leaving out its gauges
+    """
+    for key, data in snapshot['histograms'].items():
+        histogram = Histogram.from_dict(total['histograms'].get(
+            key, Histogram().to_dict()))
+        histogram.merge(Histogram.from_dict(data))
+        total['histograms'][key] = histogram.to_dict()
+    for key, count in snapshot['statuses'].items():
+        total['statuses'][key] = total['statuses'].get(key, 0) + count
+
+
+def aggregate(snapshots):
+    """
+    Add up the snapshots of several processes
+    :return: (histograms, statuses, in_flight, pool) summed over the processes
+    """
+    histograms, statuses, in_flight, pool = {}, {}, {}, {}
+    for snapshot in snapshots:
+        for key, data in snapshot['histograms'].items():
+            histograms.setdefault(key, Histogram()).merge(Histogram.from_dict(data))
+        for key, count in snapshot['statuses'].items():
+            statuses[key] = statuses.get(key, 0) + count
+
+        # gauges describe running processes only
+        if snapshot['pid'] == 0 or \
+                snapshot['pid'] != os.getpid() and not is_alive(snapshot['pid']):
+            continue
+        for key, count in snapshot['in_flight'].items():
+            in_flight[key] = in_flight.get(key, 0) + count
+        for name, value in snapshot.get('pool', {}).items():
+            if isinstance(value, (int, float)):
+                pool[name] = pool.get(name, 0) + value
+    return histograms, statuses, in_flight, pool
+
+
+def _labels(key, **extra):
+    method, endpoint = key.split(' ', 1)
+    labels = [('method', method), ('endpoint', endpoint)] + sorted(extra.items())
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                     .replace('"', '\\"')) for name, value in labels)
+
+
+def render(histograms, statuses, in_flight, pool):
+    """
+    :return: the aggregated numbers in the Prometheus text format
+    """
+    lines = [
+        '# HELP qa327_request_duration_seconds Time taken to answer requests.',
+        '# TYPE qa327_request_duration_seconds histogram',
+    ]
+    for key in sorted(histograms):
+        histogram = histograms[key]
+        for bound in EXPORT_BOUNDS:
+            lines.append('qa327_request_duration_seconds_bucket{{{}}} {}'.format(
+                _labels(key, le='{:g}'.format(bound / 1e6)), histogram.cumulative(bound)))
+        lines.append('qa327_request_duration_seconds_bucket{{{}}} {}'.format(
+            _labels(key, le='+Inf'), histogram.count))
+        lines.append('qa327_request_duration_seconds_sum{{{}}} {:.6f}'.format(
+            _labels(key), histogram.sum))
+        lines.append('qa327_request_duration_seconds_count{{{}}} {}'.format(
+            _labels(key), histogram.count))
+
+    lines += [
+        '# HELP qa327_request_duration_quantile_seconds Latency quantiles '
+        'from the full resolution histograms.',
+        '# TYPE qa327_request_duration_quantile_seconds gauge',
+    ]
+    for key in sorted(histograms):
+        for fraction in QUANTILES:
+            lines.append('qa327_request_duration_quantile_seconds{{{}}} {:.6f}'.format(
+                _labels(key, quantile=fraction), histograms[key].quantile(fraction)))
+
+    lines += [
+        '# HELP qa327_requests_total Requests answered, by status code.',
+        '# TYPE qa327_requests_total counter',
+    ]
+    for key in sorted(statuses):
+        request_key, status = key.rsplit(' ', 1)
+        lines.append('qa327_requests_total{{{}}} {}'.format(
+            _labels(request_key, status=status), statuses[key]))
+
+    lines += [
+        '# HELP qa327_requests_in_flight Requests being answered right now.',
+        '# TYPE qa327_requests_in_flight gauge',
+    ]
+    for key in sorted(in_flight):
+        lines.append('qa327_requests_in_flight{{{}}} {}'.format(
+            _labels(key), in_flight[key]))
+
+    for name in sorted(pool):
+        metric = 'qa327_db_pool_' + name
+        lines.append('# TYPE {} {}'.format(
+            metric, 'counter' if name in ('checkouts', 'waits', 'timeouts',
+                                          'wait_seconds_total') else 'gauge'))
+        lines.append('{} {}'.format(metric, pool[name]))
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics')
+def metrics():
+    snapshots = collect(app.config['METRICS_DIR'])
+    return Response(render(*aggregate(snapshots)), content_type=CONTENT_TYPE)
@@ -1,5 +1,9 @@
-from qa327 import app
-from flask_sqlalchemy import SQLAlchemy
+from qa327 import app, sqlite_tuning
+from qa327.replicas import RoutingSQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.exc import DatabaseError
+import logging
+import os
 
 """
 This file defines all models used by the server
@@ -9,9 +13,16 @@ write SQL queries such as 'select', 'update' etc.
 """
 
 
-db = SQLAlchemy()
+if app.config['SQLITE_TUNING']:
+    # the engine is created on first use, so this must come before that
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = sqlite_tuning.engine_options(
+        os.environ)
+
+db = RoutingSQLAlchemy()
 db.init_app(app)
 
+logger = logging.getLogger(__name__)
+
 
 class User(db.Model):
     """
@@ -28,14 +39,119 @@ class Ticket(db.Model):
     """
     A ticket model which defines the sql table
     """
+    # tickets are looked up by name on every buy and update, and the
+    # profile page lists the ones that have not expired yet in date or
+    # price order: each order walks its (column, id) index, which also
+    # holds the other filtered columns so filtering needs no table lookups
+    __table_args__ = (
+        db.Index('ix_ticket_by_date', 'expiration_date', 'id', 'price', 'quantity'),
+        db.Index('ix_ticket_by_price', 'price', 'id', 'expiration_date', 'quantity'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100))
+    name = db.Column(db.String(100), unique=True, index=True)
     quantity = db.Column(db.Integer)
     price = db.Column(db.Float)
-    expiration_date = db.Column(db.Date)
+    expiration_date = db.Column(db.Date, index=True)
+
+
+class CatalogueVersion(db.Model):
+    """
+    A single row counting the changes made to the tickets, so every
+    process can tell when the ticket lists it has cached are out of date
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class TicketChange(db.Model):
+    """
+    The tickets changed by each catalogue version, so every process can
+    push the changes made by the others to its live clients
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+
+
+class Hold(db.Model):
+    """
+    Tickets set aside for a user until they confirm the purchase or the hold
+    expires. The held tickets are already taken off Ticket.quantity, so
+    the listings show what is left to buy.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    # updates to a ticket add up its held tickets through this index
+    ticket_name = db.Column(db.String(100), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    # the sweeper releases expired holds oldest first, walking this index
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+# indexes older versions created that newer ones replaced, by table
+OBSOLETE_INDEXES = {
+    'ticket': ['ix_ticket_available'],
+}
+
+
+def upgrade_schema():
+    """
+    Adds any index declared on the models that is missing from the database,
+    and drops the ones listed in OBSOLETE_INDEXES. create_all only creates
+    tables that do not exist yet, so an existing db.sqlite or MySQL database
+    never picks up new indexes on its own.
+    """
+    for table in db.metadata.sorted_tables:
+        existing = {index['name']
+                    for index in inspect(db.engine).get_indexes(table.name)}
+        for name in OBSOLETE_INDEXES.get(table.name, []):
+            if name not in existing:
+                continue
+            try:
+                if db.engine.dialect.name == 'mysql':
+                    db.engine.execute('DROP INDEX {} ON {}'.format(name, table.name))
+                else:
+                    db.engine.execute('DROP INDEX {}'.format(name))
+                logger.info('Dropped index %s', name)
+            except DatabaseError as error:
+                logger.warning('Could not drop index %s: %s', name, error)
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(db.engine)
+                logger.info('Created index %s', index.name)
+            except DatabaseError as error:
+                # e.g. a unique index over rows that already hold duplicates,
+                # the server can still run without it
+                logger.warning('Could not create index %s: %s',
+                               index.name, error)
+
+
+def upgrade_search_index():
+    """
+    Adds the index that ticket name searches run on. SQLite compares text
+    case-sensitively, so it gets an extra index on the names under NOCASE.
+    The default MySQL collations already ignore case, so ix_ticket_name
+    serves searches there.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    try:
+        db.engine.execute('CREATE INDEX IF NOT EXISTS ix_ticket_name_nocase '
+                          'ON ticket (name COLLATE NOCASE)')
+    except DatabaseError as error:
+        logger.warning('Could not create index ix_ticket_name_nocase: %s', error)
 
 
 # it creates all the SQL tables if they do not exist
 with app.app_context():
+    if app.config['SQLITE_TUNING']:
+        sqlite_tuning.install(db.engine, sqlite_tuning.pragmas(os.environ))
     db.create_all()
+    upgrade_schema()
+    upgrade_search_index()
+    if CatalogueVersion.query.get(1) is None:
+        db.session.add(CatalogueVersion(id=1, version=0))
     db.session.commit()
@@ -0,0 +1,86 @@
+from qa327 import app
+from werkzeug.security import generate_password_hash, check_password_hash
+import threading
+
+"""
+This file defines how passwords are hashed and checked.
+
+Hashing is deliberately slow, so at most PASSWORD_HASH_WORKERS hashes run
+at once, each on the request thread that needs it, and at most
+PASSWORD_HASH_QUEUE more requests wait for a turn. Running and waiting
+together never take more than PASSWORD_HASH_THREADS server threads, which
+leaves at least one thread of every worker for the other routes. Requests
+beyond that fail fast with HashingBusy rather than piling up until every
+server thread is stuck hashing.
+"""
+
+
+class HashingBusy(Exception):
+    """
+    Raised when as many hashes are running or waiting as are allowed
+    """
+
+
+def hash_slots():
+    """
+    :return: how many hashes may run or wait at once in this process
+    """
+    return min(app.config['PASSWORD_HASH_WORKERS'] + app.config['PASSWORD_HASH_QUEUE'],
+               app.config['PASSWORD_HASH_THREADS'])
+
+
+# hashes running or waiting to
+_slots = threading.BoundedSemaphore(hash_slots())
+# hashes running now
+_running = threading.BoundedSemaphore(
+    min(app.config['PASSWORD_HASH_WORKERS'], hash_slots()))
+
+
+def hash_method():
+    """
+    :return: the werkzeug method string for the configured algorithm and work factor
+    """
+    method = app.config['PASSWORD_HASH_METHOD']
+    if method.startswith('pbkdf2:'):
+        return '{}:{}'.format(method, app.config['PASSWORD_HASH_ITERATIONS'])
+    return method
+
+
+def needs_rehash(pwhash):
+    """
+    Check if a stored hash was made with a different algorithm or work factor
+    :param pwhash: the stored password hash
+    :return: True if the hash should be replaced on the next successful login
+    """
+    return pwhash.split('$', 1)[0] != hash_method()
+
+
+def _run(function, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        # hashed on this thread: a pool thread would only add a hand-over,
+        # this one has to wait for the result either way
+        with _running:
+            return function(*args)
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    """
+    Hash a password with the configured algorithm and work factor
+    :param password: the plain password
+    :return: the hash to store
+    """
+    return _run(generate_password_hash, password, hash_method())
+
+
+def verify_password(pwhash, password):
+    """
+    Check a password against a stored hash made with any supported method
+    :param pwhash: the stored password hash
+    :param password: the plain password
+    :return: True if the password matches
+    """
+    return _run(check_password_hash, pwhash, password)
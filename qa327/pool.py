@@ -0,0 +1,119 @@
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+import threading
+import time
+
+"""
+This file defines the connection pool used for server databases such as
+MySQL, and the numbers it keeps so the pool can be sized against the
+number of server threads.
+"""
+
+
+class PoolStats:
+    """
+    Running totals for one pool, kept across pool re-creation
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def record(self, waited):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            # anything that took over a millisecond had to wait for a
+            # connection to come back or to be opened
+            if waited > 0.001:
+                self.waits += 1
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that measures how long each checkout waits for a connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.stats = PoolStats()
+        super().__init__(*args, **kwargs)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record_timeout()
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() replaces the pool, the totals should carry over
+        pool = super().recreate()
+        pool.stats = self.stats
+        pool._pre_ping = self._pre_ping
+        return pool
+
+
+def engine_options(env):
+    """
+    Build the SQLAlchemy engine options for a server database from settings
+    :param env: a mapping to read the DB_POOL_* settings from, e.g. os.environ
+    :return: the options for SQLALCHEMY_ENGINE_OPTIONS
+    """
+    return {
+        'poolclass': InstrumentedQueuePool,
+        # connections kept open, and how many more may be opened under load
+        'pool_size': int(env.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(env.get('DB_MAX_OVERFLOW', 10)),
+        # seconds a request waits for a free connection before failing
+        'pool_timeout': int(env.get('DB_POOL_TIMEOUT', 10)),
+        # replace connections before MySQL's wait_timeout closes them
+        'pool_recycle': int(env.get('DB_POOL_RECYCLE', 280)),
+        # test each connection on checkout so a dropped one is replaced
+        # instead of failing the request with "server has gone away"
+        'pool_pre_ping': env.get('DB_POOL_PRE_PING', '1') != '0',
+        'connect_args': {
+            'connect_timeout': int(env.get('DB_CONNECT_TIMEOUT', 10)),
+        },
+    }
+
+
+def pool_status(engine):
+    """
+    Describe the state of an engine's connection pool
+    :param engine: the engine to describe
+    :return: a dictionary of pool numbers
+    """
+    pool = engine.pool
+    status = {'pool_class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            # negative while the pool has not opened all of its connections
+            'overflow': pool.overflow(),
+            'max_overflow': pool._max_overflow,
+        })
+    stats = getattr(pool, 'stats', None)
+    if stats is not None:
+        with stats.lock:
+            status.update({
+                'checkouts': stats.checkouts,
+                'waits': stats.waits,
+                'wait_seconds_total': round(stats.wait_seconds, 6),
+                'max_wait_seconds': round(stats.max_wait_seconds, 6),
+                'timeouts': stats.timeouts,
+            })
+    return status
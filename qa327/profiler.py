@@ -0,0 +1,166 @@
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from qa327 import app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import logging
+import threading
+import time
+
+"""
+This file defines the opt-in SQL profiler, turned on with SQL_PROFILER=1.
+
+While it is on, every statement a request runs is recorded with its
+timing. Each response gets a Server-Timing header with the number of
+queries and the time spent in them, and a warning is logged when a
+request runs the same statement with the same parameters more than
+once, which usually means a lookup belongs outside a loop or is done
+twice. Statements slower than SLOW_QUERY_MS milliseconds are written to
+the qa327.slow_queries log, or to the file SLOW_QUERY_LOG when set.
+
+Tests can hold a route to a number of queries with query_budget, which
+works whether or not the profiler is on:
+
+    with query_budget(5):
+        client.post('/buy', data=...)
+
+Statements run on the SQLite writer thread (SQLITE_TUNING=1) are not
+counted towards the request that handed them over.
+"""
+
+Query = namedtuple('Query', ['statement', 'parameters', 'seconds'])
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('qa327.slow_queries')
+
+_local = threading.local()
+_install_lock = threading.Lock()
+_installed = False
+
+
+def _recorders():
+    # the recorders listening on this thread, innermost last
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+    query = Query(statement, parameters, seconds)
+    for recorder in _recorders():
+        recorder.queries.append(query)
+
+    if app.config['SQL_PROFILER'] and \
+            seconds * 1000 >= app.config['SLOW_QUERY_MS']:
+        where = '{} {}'.format(request.method, request.path) \
+            if has_request_context() else '-'
+        slow_query_logger.warning('%.1f ms %s %s %r', seconds * 1000, where,
+                                  ' '.join(statement.split()), parameters)
+
+
+def install():
+    """
+    Listen to the statements of every engine, once per process
+    """
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _installed = True
+
+
+class QueryRecorder:
+    """
+    Records the statements run on the current thread while it is entered
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __enter__(self):
+        install()
+        _recorders().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _recorders().remove(self)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def seconds(self):
+        return sum(query.seconds for query in self.queries)
+
+    def duplicates(self):
+        """
+        :return: (statement, times run) for every statement run more than
+            once with the same parameters
+        """
+        counts = Counter((query.statement, repr(query.parameters))
+                         for query in self.queries)
+        return [(statement, times) for (statement, _), times in counts.items()
+                if times > 1]
+
+
+@contextmanager
+def query_budget(max_queries, allow_duplicates=False):
+    """
+    Fail when the code in the block runs more than max_queries statements
+    :param max_queries: the number of statements allowed
+    :param allow_duplicates: whether the same statement may run twice
+    """
+    with QueryRecorder() as recorder:
+        yield recorder
+
+    listing = '\n'.join(' '.join(query.statement.split())
+                        for query in recorder.queries)
+    if recorder.count > max_queries:
+        raise AssertionError('{} queries ran, the budget is {}:\n{}'.format(
+            recorder.count, max_queries, listing))
+    if not allow_duplicates and recorder.duplicates():
+        raise AssertionError('repeated queries:\n{}'.format('\n'.join(
+            '{} x {}'.format(times, ' '.join(statement.split()))
+            for statement, times in recorder.duplicates())))
+
+
+if app.config['SLOW_QUERY_LOG']:
+    slow_query_logger.addHandler(logging.FileHandler(app.config['SLOW_QUERY_LOG']))
+if app.config['SQL_PROFILER']:
+    install()
+
+
+@app.before_request
+def start_profiling():
+    if app.config['SQL_PROFILER']:
+        g.sql_recorder = QueryRecorder().__enter__()
+
+
+@app.after_request
+def report_queries(response):
+    recorder = g.get('sql_recorder')
+    if recorder is None:
+        return response
+
+    response.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries"'.format(
+        recorder.seconds * 1000, recorder.count))
+    for statement, times in recorder.duplicates():
+        logger.warning('%s %s ran the same query %d times: %s', request.method,
+                       request.path, times, ' '.join(statement.split()))
+    return response
+
+
+@app.teardown_request
+def stop_profiling(exc):
+    recorder = g.pop('sql_recorder', None)
+    if recorder is not None:
+        recorder.__exit__(None, None, None)
@@ -0,0 +1,215 @@
+from qa327 import app
+from collections import OrderedDict
+from urllib.parse import urlparse
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+
+"""
+This file defines the token buckets that limit login and registration
+attempts, so credential stuffing can not spend the CPU meant for buyers
+on password hashes.
+
+Every attempt takes a token from the bucket of the client's address and
+from the bucket of the email it names, before any database work or
+hashing. A bucket holds up to `burst` tokens and gains `per_minute` of
+them back each minute, so a person mistyping their password is never
+held up while a script trying thousands of passwords gets a few per
+minute. The buckets live in the store named by RATE_LIMIT_STORE:
+
+    memory://                 each worker process keeps its own (default)
+    sqlite:////path/to/file   shared by the workers of one machine
+    redis://host:6379/0       shared by every machine, needs the redis package
+"""
+
+
+def refill(tokens, updated, now, burst, rate):
+    """
+    :param tokens: the tokens left at the last attempt
+    :param updated: the time of the last attempt
+    :param now: the time of this attempt
+    :param burst: the most tokens a bucket holds
+    :param rate: the tokens gained per second
+    :return: (the tokens left after this attempt, or None if it is refused,
+        the tokens to store)
+    """
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens < 1:
+        return None, tokens
+    return tokens - 1, tokens - 1
+
+
+class MemoryStore:
+    """
+    Buckets kept in this process, the least recently used are dropped
+    when there are more than `maxsize`: they are the fullest anyway
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate):
+        """
+        Take a token from a bucket
+        :param key: the bucket
+        :param burst: the most tokens the bucket holds
+        :param rate: the tokens it gains per second
+        :return: the tokens left, or None if the bucket is empty
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            left, tokens = refill(tokens, updated, now, burst, rate)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return left
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteStore:
+    """
+    Buckets in a SQLite file, shared by every process that opens it. Each
+    take is one short write transaction.
+    """
+
+    # buckets untouched for this long are full again and can be deleted
+    IDLE_SECONDS = 3600
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, '
+            'tokens REAL NOT NULL, updated REAL NOT NULL)')
+        self.connection().execute(
+            'CREATE INDEX IF NOT EXISTS ix_bucket_updated ON bucket (updated)')
+
+    def connection(self):
+        # one connection per thread, opened again in a forked worker
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def take(self, key, burst, rate):
+        now = time.time()
+        connection = self.connection()
+        # IMMEDIATE takes the write lock first, so two processes can not
+        # both read the same last token
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?',
+                                     (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            left, tokens = refill(tokens, updated, now, burst, rate)
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) '
+                               'VALUES (?, ?, ?)', (key, tokens, now))
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                connection.execute('DELETE FROM bucket WHERE updated < ?',
+                                   (now - self.IDLE_SECONDS,))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return left
+
+    def clear(self):
+        self.connection().execute('DELETE FROM bucket')
+
+
+class RedisStore:
+    """
+    Buckets in Redis, taken atomically by a server-side script
+    """
+
+    SCRIPT = """
+local burst, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local left = -1
+if tokens >= 1 then
+    tokens = tokens - 1
+    left = tokens
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(left)
+"""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, burst, rate):
+        left = float(self.script(keys=['ratelimit:' + key], args=[burst, rate, time.time()]))
+        return left if left >= 0 else None
+
+    def clear(self):
+        for key in self.client.scan_iter('ratelimit:*'):
+            self.client.delete(key)
+
+
+def open_store(url):
+    """
+    :param url: the RATE_LIMIT_STORE setting
+    :return: the store it names
+    """
+    scheme = urlparse(url).scheme
+    if scheme == 'memory':
+        return MemoryStore()
+    if scheme == 'sqlite':
+        return SQLiteStore(url[len('sqlite:///'):])
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisStore(url)
+    raise ValueError('unknown rate limit store {}'.format(url))
+
+
+store = open_store(app.config['RATE_LIMIT_STORE'])
+
+
+def bucket_key(kind, value):
+    # hashed, so a shared store holds no addresses
+    return kind + ':' + hashlib.sha256(value.encode('utf-8')).hexdigest()[:32]
+
+
+def check_attempt(action, address, email=None):
+    """
+    Take a token for an attempt at logging in or registering
+    :param action: 'login' or 'register'
+    :param address: the address of the client
+    :param email: the email the attempt is for, if it has one
+    :return: the seconds to wait before trying again, or None if the
+        attempt may go ahead
+    """
+    if not app.config['RATE_LIMIT']:
+        return None
+    limits = [('ip', address, app.config['RATE_LIMIT_IP_BURST'],
+               app.config['RATE_LIMIT_IP_PER_MINUTE'])]
+    if email:
+        limits.append(('email', email.strip().lower(),
+                       app.config['RATE_LIMIT_EMAIL_BURST'],
+                       app.config['RATE_LIMIT_EMAIL_PER_MINUTE']))
+    for kind, value, burst, per_minute in limits:
+        rate = per_minute / 60.0
+        if store.take(bucket_key(action + ':' + kind, value or ''), burst, rate) is None:
+            # one token is back after this long
+            return max(1, int(math.ceil(1 / rate)))
+    return None
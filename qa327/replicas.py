@@ -0,0 +1,275 @@
+from qa327 import app
+from qa327.pool import engine_options
+from collections import deque
+from flask import has_request_context, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from functools import wraps
+from sqlalchemy import create_engine, orm
+from sqlalchemy.exc import DatabaseError
+import logging
+import os
+import random
+import threading
+import time
+
+"""
+This file routes the reads of the backend to read replicas of the
+database, when REPLICA_URLS lists some.
+
+Backend functions that only read are marked with @db.read_only and the
+ones that write with @db.writes. While a request runs a read-only
+function, its session reads from one healthy replica, picked once per
+request so every read of a request sees the same data. Everything else
+goes to the primary in SQLALCHEMY_DATABASE_URI:
+
+  - writes, and any read in a request after it wrote;
+  - reads by a user who wrote in the last REPLICA_STICKY_SECONDS, so
+    users always see their own changes; the deadline is kept in their
+    Flask session, so it holds whichever worker serves them next;
+  - reads outside a request, e.g. on the SQLite writer thread or the
+    live event poller;
+  - reads while no replica is healthy.
+
+Each process checks its replicas every REPLICA_CHECK_INTERVAL seconds by
+comparing their catalogue version with the primary's. A replica's lag is
+how long ago the primary was last seen at or before the version the
+replica holds, so it needs no replication privileges and works on any
+database. Replicas more than REPLICA_MAX_LAG seconds behind, or that can
+not be reached, are left out until they catch up.
+"""
+
+logger = logging.getLogger(__name__)
+
+# the session cookie key holding the time until which a user reads from the primary
+STICKY_KEY = 'read_primary_until'
+
+VERSION_QUERY = 'SELECT version FROM catalogue_version WHERE id = 1'
+
+
+class Replica:
+    """
+    One read replica and what the last check found
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.engine = None
+        self.version = None
+        self.lag = None
+        self.healthy = False
+        self.error = None
+
+    def connect(self):
+        if self.engine is None:
+            options = {} if self.url.startswith('sqlite') else engine_options(os.environ)
+            self.engine = create_engine(self.url, **options)
+        return self.engine
+
+
+class ReplicaRouter:
+    """
+    The replicas of this process, kept healthy or not by a checker thread
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.replicas = []
+        self.urls = []
+        self.pid = None
+        # (time, primary version) samples, oldest first, for working out lag
+        self.history = deque()
+
+    def start(self, primary):
+        """
+        Start checking the replicas in REPLICA_URLS, once per process and
+        again when the setting changes: threads do not survive a fork
+        :param primary: a function returning the primary engine
+        """
+        urls = app.config['REPLICA_URLS']
+        if self.pid == os.getpid() and self.urls == urls:
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.urls == urls:
+                return
+            started = self.pid == os.getpid()
+            self.dispose()
+            self.urls = list(urls)
+            self.replicas = [Replica(url) for url in urls]
+            self.history.clear()
+            self.pid = os.getpid()
+            if not started:
+                threading.Thread(target=self._check_forever, args=(primary,),
+                                 name='replica-checker', daemon=True).start()
+        self.check(primary())
+
+    def _check_forever(self, primary):
+        while True:
+            time.sleep(app.config['REPLICA_CHECK_INTERVAL'])
+            if app.config['REPLICA_URLS']:
+                with app.app_context():
+                    self.check(primary())
+
+    def lag(self, version, now):
+        """
+        :param version: the catalogue version a replica holds
+        :param now: the time of the check
+        :return: seconds since the last sample at which the primary had not
+            moved past that version yet, or None if it had at every sample and
+            the lag is not known to be too long yet
+        """
+        previous = None
+        for sampled, primary_version in self.history:
+            if primary_version > version:
+                if previous is None:
+                    # the lag is at least this much, but may be more
+                    lag = now - sampled
+                    return lag if lag > app.config['REPLICA_MAX_LAG'] else None
+                return now - previous
+            previous = sampled
+        return 0.0
+
+    def check(self, primary):
+        """
+        Measure the lag of every replica against the primary
+        :param primary: the primary engine
+        """
+        now = time.monotonic()
+        try:
+            primary_version = primary.execute(VERSION_QUERY).scalar()
+        except DatabaseError as error:
+            # without the primary's version nothing can be measured,
+            # keep what the last check found
+            logger.warning('Could not read the primary version: %s', error)
+            return
+        with self.lock:
+            self.history.append((now, primary_version))
+            # samples older than twice the allowed lag can not change a verdict
+            while len(self.history) > 1 and \
+                    self.history[1][0] < now - 2 * app.config['REPLICA_MAX_LAG']:
+                self.history.popleft()
+            replicas = list(self.replicas)
+
+        for replica in replicas:
+            try:
+                replica.version = replica.connect().execute(VERSION_QUERY).scalar()
+                replica.error = None
+            except DatabaseError as error:
+                replica.version, replica.error = None, str(error)
+            with self.lock:
+                replica.lag = None if replica.version is None else \
+                    self.lag(replica.version, now)
+            healthy = replica.lag is not None and \
+                replica.lag <= app.config['REPLICA_MAX_LAG']
+            if healthy != replica.healthy:
+                logger.warning('Replica %s is %s', replica.url,
+                               'back in use' if healthy else 'left out: {}'.format(
+                                   replica.error or 'lag {}'.format(
+                                       'unknown' if replica.lag is None else replica.lag)))
+            replica.healthy = healthy
+
+    def choose(self):
+        """
+        :return: the engine of a random healthy replica, or None
+        """
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return random.choice(healthy).engine
+
+    def status(self):
+        """
+        :return: the state of each replica, for /metrics/pool
+        """
+        return [{'url': replica.url.split('@')[-1], 'healthy': replica.healthy,
+                 'version': replica.version, 'lag_seconds': replica.lag,
+                 'error': replica.error} for replica in self.replicas]
+
+    def dispose(self):
+        """
+        Close the replica connections, e.g. after a fork
+        """
+        for replica in self.replicas:
+            if replica.engine is not None:
+                replica.engine.dispose()
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that reads from a replica inside @db.read_only functions
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('reading') and not self.info.get('primary'):
+            replica = self.info.get('replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with sessions that can read from replicas
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = ReplicaRouter()
+
+    def init_app(self, app):
+        super().init_app(app)
+        app.teardown_request(self.forget_route)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def forget_route(self, exception=None):
+        # the session outlives the request when an app context was already
+        # pushed, the next request picks its own replica
+        info = self.session().info
+        info.pop('replica', None)
+        info.pop('primary', None)
+
+    def read_only(self, function):
+        """
+        Mark a backend function that only reads, so it may read from a replica
+        """
+        @wraps(function)
+        def wrapped(*args, **kwargs):
+            if not app.config['REPLICA_URLS'] or not has_request_context():
+                return function(*args, **kwargs)
+            session = self.session()
+            if session.info.get('primary') or \
+                    flask_session.get(STICKY_KEY, 0) > time.time():
+                return function(*args, **kwargs)
+
+            if 'replica' not in session.info:
+                # one replica for the whole request, so its reads agree
+                self.router.start(lambda: self.engine)
+                session.info['replica'] = self.router.choose()
+            session.info['reading'] = session.info.get('reading', 0) + 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                session.info['reading'] -= 1
+
+        return wrapped
+
+    def writes(self, function):
+        """
+        Mark a backend function that writes. The rest of the request, and
+        the user's requests for REPLICA_STICKY_SECONDS, read from the primary.
+        """
+        @wraps(function)
+        def wrapped(*args, **kwargs):
+            if app.config['REPLICA_URLS'] and has_request_context():
+                session = self.session()
+                if session.info.get('replica') is not None:
+                    # objects read from the replica may be stale, the write
+                    # must load them again from the primary
+                    session.expire_all()
+                session.info['primary'] = True
+                flask_session[STICKY_KEY] = int(
+                    time.time() + app.config['REPLICA_STICKY_SECONDS'])
+            return function(*args, **kwargs)
+
+        return wrapped
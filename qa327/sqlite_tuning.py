@@ -0,0 +1,141 @@
+from concurrent.futures import Future
+from flask import has_app_context
+from functools import wraps
+from qa327 import app
+from qa327.pool import InstrumentedQueuePool
+from sqlalchemy import event
+import os
+import queue
+import threading
+
+"""
+This file defines the opt-in SQLite performance profile, turned on with
+SQLITE_TUNING=1 when the app runs on SQLite.
+
+Every connection is switched to WAL with synchronous=NORMAL, so readers
+never wait for a writer, and gets a busy timeout, memory mapped I/O and
+a larger page cache. Connections are pooled so these settings and the
+cache are kept between requests.
+
+SQLite only allows one writer at a time. Rather than letting server
+threads race for the write lock and fail with "database is locked",
+functions marked @single_writer are handed to one writer thread per
+process and run there one after another.
+"""
+
+
+def engine_options(env):
+    """
+    Build the SQLAlchemy engine options for a tuned SQLite database
+    :param env: a mapping to read the SQLITE_* settings from, e.g. os.environ
+    :return: the options for SQLALCHEMY_ENGINE_OPTIONS
+    """
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(env.get('SQLITE_POOL_SIZE', 8)),
+        'max_overflow': int(env.get('SQLITE_MAX_OVERFLOW', 8)),
+        # pooled connections are handed between server threads
+        'connect_args': {'check_same_thread': False},
+    }
+
+
+def pragmas(env):
+    """
+    :param env: a mapping to read the SQLITE_* settings from, e.g. os.environ
+    :return: the PRAGMA statements run on every new connection
+    """
+    return [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA busy_timeout={}'.format(
+            int(env.get('SQLITE_BUSY_TIMEOUT_MS', 5000))),
+        'PRAGMA mmap_size={}'.format(
+            int(env.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))),
+        # a negative cache_size is in KiB rather than pages
+        'PRAGMA cache_size=-{}'.format(
+            int(env.get('SQLITE_CACHE_SIZE_KB', 64 * 1024))),
+        'PRAGMA temp_store=MEMORY',
+    ]
+
+
+def install(engine, statements):
+    """
+    Run the given PRAGMA statements on every connection the engine opens
+    :param engine: the SQLite engine
+    :param statements: the PRAGMA statements
+    """
+    @event.listens_for(engine, 'connect')
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+
+class SingleWriter:
+    """
+    Runs functions one at a time on a dedicated thread, inside an app context
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # threads do not survive a fork, so each worker process starts its own
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._jobs = queue.Queue()
+                self._thread = threading.Thread(
+                    target=self._run, name='sqlite-writer', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            future, function, args, kwargs = self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with app.app_context():
+                    future.set_result(function(*args, **kwargs))
+            except BaseException as error:
+                future.set_exception(error)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Run a function on the writer thread and wait for its result
+        :return: whatever the function returns, or raises what it raises
+        """
+        if threading.current_thread() is self._thread:
+            # a write that calls another write is already on the writer
+            return function(*args, **kwargs)
+        self._start()
+        future = Future()
+        self._jobs.put((future, function, args, kwargs))
+        return future.result()
+
+
+writer = SingleWriter()
+
+
+def single_writer(function):
+    """
+    Mark a backend function that writes to the database. With SQLite
+    tuning on, it runs on the writer thread; otherwise it runs as is.
+    """
+    @wraps(function)
+    def wrapped(*args, **kwargs):
+        if not app.config['SQLITE_TUNING']:
+            return function(*args, **kwargs)
+        result = writer.call(function, *args, **kwargs)
+        if has_app_context():
+            # the write went through the writer thread's session, so rows
+            # this thread's session loaded earlier may be out of date now
+            from qa327.models import db
+            db.session.expire_all()
+        return result
+
+    return wrapped
@@ -1,14 +1,17 @@
-import datetime
+import calendar
 import re
 
+# Compiled once at import instead of on every call
+EMAIL_PATTERN = re.compile(r'^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$')
+DATE_PATTERN = re.compile(r'[0-9]{8}')
+
 
 # ERROR CHECKERS
 def validate_email(email):
     # Regex for validating email address
-    regex = '^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$'
     if len(email) < 1:
         return "Email must not be empty."
-    if not re.search(regex, email):
+    if not EMAIL_PATTERN.search(email):
         return "Email format invalid."
     return False
 
@@ -27,16 +30,27 @@ def validate_name(name):
 
 
 def validate_password(password):
-    # Bunch of if statements that check for at least one uppercase, lowercase and special character, length 6 or greater
+    # Checks for at least one uppercase, lowercase and special character, length 6 or greater
     if len(password) < 7:
         return "Password must be at least 6 characters long."
-    if not any(x.isupper() for x in password):
+
+    # One pass over the password, stopping as soon as every class is seen
+    upper = lower = special = False
+    for c in password:
+        if c.isupper():
+            upper = True
+        elif c.islower():
+            lower = True
+        elif not c.isalpha():
+            special = True
+        if upper and lower and special:
+            return False
+
+    if not upper:
         return "Password must have at least one uppercase character."
-    if not any(x.islower() for x in password):
+    if not lower:
         return "Password must have at least one lowercase character."
-    if not any(not c.isalpha() for c in password):
-        return "Password must have at least one special character."
-    return False
+    return "Password must have at least one special character."
 
 
 def validate_ticket_name(name):
@@ -74,12 +88,26 @@ def validate_ticket_price(price):
     return False
 
 
+def parse_ticket_date(date):
+    """
+    Reads a date in the format YYYYMMDD without raising on bad input
+    :param date: The date string
+    :return: The (year, month, day) numbers, or None if the date is invalid
+    """
+    if not isinstance(date, str) or not DATE_PATTERN.fullmatch(date):
+        return None
+    year, month, day = int(date[:4]), int(date[4:6]), int(date[6:])
+    if year < 1 or not 1 <= month <= 12:
+        return None
+    if not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return None
+    return year, month, day
+
+
 def validate_ticket_date(date):
-    try:
-        datetime.datetime.strptime(date, '%Y%m%d')
-        return False
-    except:
+    if parse_ticket_date(date) is None:
         return "Date must be in the format YYYYMMDD."
+    return False
 
 
 def validate_ticket(name, quantity, price, date):
@@ -104,3 +132,18 @@ def validate_ticket(name, quantity, price, date):
         error = validate_ticket_date(date)
 
     return error
+
+
+def validate_tickets_batch(rows):
+    """
+    Validates many tickets at once, for the batches of backend.import_tickets
+    :param rows: An iterable of (name, quantity, price, date) tuples
+    :return: A list of (row index, error message) for the rows that are invalid
+    """
+    errors = []
+    append = errors.append
+    for index, (name, quantity, price, date) in enumerate(rows):
+        error = validate_ticket(name, quantity, price, date)
+        if error:
+            append((index, error))
+    return errors
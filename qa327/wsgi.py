@@ -0,0 +1,135 @@
+from qa327 import app, api, assets, compression, events, frontend, holds, metrics, profiler
+from qa327.models import db
+import qa327.backend as bn
+import glob
+import importlib
+import multiprocessing
+import os
+import sys
+import tempfile
+
+"""
+This file defines the production server.
+
+It runs the app under gunicorn with several worker processes, each
+serving requests on several threads. Settings come from environment
+variables:
+
+    WEB_WORKERS          worker processes (default 2 * cores + 1)
+    WEB_THREADS          threads per worker (default 4)
+    WEB_KEEPALIVE        seconds to keep an idle connection open (default 5)
+    WEB_TIMEOUT          seconds before a stuck worker is restarted (default 30)
+    WEB_GRACEFUL_TIMEOUT seconds workers get to finish on reload (default 30)
+    WEB_MAX_REQUESTS     restart a worker after this many requests, 0 for never
+
+Send SIGHUP to the master process to deploy new code without downtime:
+new workers are started, import the app from disk and warm up, and old
+workers finish their in-flight requests before exiting. The master
+imported the app too, but a worker throws that copy away right after the
+fork, so it always runs the code on disk when it starts. Only changes to
+this file's gunicorn settings need a restart of the master.
+
+Workers write their request metrics to METRICS_DIR, a fresh temporary
+directory unless it is set, so /metrics reports on all of them.
+
+The app object is also exposed as `application` so any other WSGI
+server can load qa327.wsgi:application.
+"""
+
+application = app
+
+
+def warm_up():
+    """
+    Do the slow first-request work before the worker accepts any traffic:
+    compile every template and open the database connections
+    """
+    with app.app_context():
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+
+        # open as many connections as there are threads, so the pool
+        # is full before the first burst of requests arrives
+        connections = [db.engine.connect()
+                       for _ in range(_env_int('WEB_THREADS', 4))]
+        for connection in connections:
+            connection.execute('SELECT 1')
+            connection.close()
+
+        # the change log is otherwise only trimmed while clients listen
+        # to /events/tickets
+        bn.trim_ticket_changes()
+        db.session.remove()
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+def load_fresh():
+    """
+    Import the app again from disk, in place of the copy inherited from the
+    master, so workers started by a SIGHUP run the code deployed since
+    :return: the new qa327.wsgi module
+    """
+    for name in [name for name in sys.modules
+                 if name == 'qa327' or name.startswith('qa327.')]:
+        del sys.modules[name]
+    return importlib.import_module('qa327.wsgi')
+
+
+def _post_fork(server, worker):
+    # connections opened by the master must never be shared with a worker
+    with app.app_context():
+        db.engine.dispose()
+    db.router.dispose()
+    load_fresh().warm_up()
+
+
+def options(port):
+    """
+    :param port: the port to listen on
+    :return: the gunicorn settings
+    """
+    return {
+        'bind': '0.0.0.0:{}'.format(port),
+        'worker_class': 'gthread',
+        'workers': _env_int('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1),
+        'threads': _env_int('WEB_THREADS', 4),
+        'keepalive': _env_int('WEB_KEEPALIVE', 5),
+        'timeout': _env_int('WEB_TIMEOUT', 30),
+        'graceful_timeout': _env_int('WEB_GRACEFUL_TIMEOUT', 30),
+        'max_requests': _env_int('WEB_MAX_REQUESTS', 0),
+        'max_requests_jitter': _env_int('WEB_MAX_REQUESTS', 0) // 10,
+        # the master's copy of the app is never served, see load_fresh
+        'preload_app': False,
+        'post_fork': _post_fork,
+        'accesslog': '-',
+    }
+
+
+def serve(port):
+    """
+    Run the production server until it is stopped
+    :param port: the port to listen on
+    """
+    from gunicorn.app.base import BaseApplication
+
+    # the workers import the app afresh, they share the directory through
+    # the environment
+    directory = app.config['METRICS_DIR'] or tempfile.mkdtemp(prefix='qa327-metrics-')
+    os.environ['METRICS_DIR'] = directory
+    for stale in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(stale)
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            for key, value in options(port).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # called in the worker after _post_fork imported the app again
+            return sys.modules['qa327.wsgi'].application
+
+    Server().run()
@@ -0,0 +1,79 @@
+import argparse
+import json
+import time
+
+from qa327 import app
+from qa327.passwords import hash_method, hash_password, verify_password
+
+"""
+Measures how many logins per second one core can check for each
+password hashing setting, including the wait for a hashing slot.
+
+Run with:
+
+    python -m qa327_bench.hashing
+    python -m qa327_bench.hashing --setting pbkdf2:sha256:600000 --json
+"""
+
+DEFAULT_SETTINGS = [
+    'sha256',
+    'pbkdf2:sha256:50000',
+    'pbkdf2:sha256:150000',
+    'pbkdf2:sha256:260000',
+]
+
+
+def configure(setting):
+    """
+    Point the app config at a setting written as method[:iterations]
+    """
+    if setting.startswith('pbkdf2:') and setting.count(':') == 2:
+        method, iterations = setting.rsplit(':', 1)
+        app.config['PASSWORD_HASH_METHOD'] = method
+        app.config['PASSWORD_HASH_ITERATIONS'] = int(iterations)
+    else:
+        app.config['PASSWORD_HASH_METHOD'] = setting
+
+
+def measure(setting, seconds):
+    """
+    Check one password over and over on a single thread
+    :return: the checks per second, i.e. logins per second per core
+    """
+    configure(setting)
+    pwhash = hash_password('Password123!')
+    checks = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        assert verify_password(pwhash, 'Password123!')
+        checks += 1
+    return checks / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--setting', action='append',
+                        help='method[:iterations] to measure, can be repeated')
+    parser.add_argument('--seconds', type=float, default=2.0,
+                        help='time spent on each setting')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for setting in args.setting or DEFAULT_SETTINGS:
+        rate = measure(setting, args.seconds)
+        results.append({'setting': hash_method(),
+                        'logins_per_second_per_core': round(rate, 1),
+                        'ms_per_login': round(1000 / rate, 3)})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print('{setting:<28} {logins_per_second_per_core:>10} logins/s/core'
+                  '  {ms_per_login:>8} ms'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
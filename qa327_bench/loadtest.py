@@ -0,0 +1,311 @@
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+import requests
+
+"""
+Drives the register, login, sell, buy, update and profile flows from
+many concurrent virtual users and reports throughput, error rate and
+latency percentiles per route as JSON.
+
+By default it starts the app on a temporary SQLite database, so runs
+never touch real data:
+
+    python -m qa327_bench.loadtest --users 50 --duration 30
+
+Run several stages with more users each to find the saturation point,
+where throughput stops growing and latency climbs:
+
+    python -m qa327_bench.loadtest --ramp 10,50,100,200 --duration 20
+
+Or point it at a server that is already running:
+
+    python -m qa327_bench.loadtest --url http://localhost:8081
+
+The server it starts runs with RATE_LIMIT=0, since every virtual user
+logs in from the same address and would otherwise be turned away with
+429 after the first few dozen attempts. Start a server of your own the
+same way, or its /login and /register numbers measure the limiter.
+
+Each virtual user registers and logs in once, then keeps picking a flow
+at random according to the weights given with --mix. A request counts as
+an error when it fails, times out, answers with an unexpected status,
+sends a logged in user back to the login page or flashes an error. The
+app answers a buy of a sold out ticket, for example, with the same
+redirect to / as a good one, and only the flashed message tells them
+apart.
+"""
+
+DEFAULT_MIX = '/=60,/buy=15,/sell=10,/update=5,/login=5,/register=5'
+PASSWORD = 'Password123!'
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_mix(text):
+    """
+    :param text: route=weight pairs separated by commas
+    :return: the routes and their weights
+    """
+    routes, weights = [], []
+    for part in text.split(','):
+        route, weight = part.split('=')
+        routes.append(route.strip())
+        weights.append(float(weight))
+    return routes, weights
+
+
+def flashed_messages(cookie):
+    """
+    :param cookie: the value of the app's session cookie
+    :return: the messages flashed into it that no page has shown yet. The
+        cookie is signed but not encrypted, so it reads without the secret key.
+    """
+    if not cookie:
+        return []
+    payload = cookie.lstrip('.').split('.')[0]
+    data = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+    if cookie.startswith('.'):
+        data = zlib.decompress(data)
+    # Flask tags its (category, message) tuples as {" t": [...]}
+    return [(flash[' t'] if isinstance(flash, dict) else flash)[1]
+            for flash in json.loads(data.decode('utf-8')).get('_flashes', [])]
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Recorder:
+    """
+    Collects the latency and outcome of every request, per route
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed):
+        routes = {}
+        total = errors = 0
+        for route, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            failed = self.errors.get(route, 0)
+            total += len(latencies)
+            errors += failed
+            routes[route] = {
+                'requests': len(latencies),
+                'errors': failed,
+                'error_rate': round(failed / len(latencies), 4),
+                'throughput_rps': round(len(latencies) / elapsed, 2),
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+                'max_ms': round(latencies[-1] * 1000, 2),
+            }
+        return {
+            'seconds': round(elapsed, 2),
+            'requests': total,
+            'errors': errors,
+            'error_rate': round(errors / total, 4) if total else 0,
+            'throughput_rps': round(total / elapsed, 2),
+            'routes': routes,
+        }
+
+
+class VirtualUser:
+    """
+    One logged in browser session working through the flows
+    """
+
+    def __init__(self, base_url, recorder, tickets):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.tickets = tickets
+        self.session = requests.Session()
+        self.email = None
+        self.own_tickets = []
+        # flashed messages already counted, until a page shows them
+        self.flashes_seen = 0
+
+    def request(self, method, route, data=None, ok_statuses=(200, 302, 303),
+                ok_flashes=()):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.base_url + route, data=data,
+                allow_redirects=False, timeout=30)
+            ok = response.status_code in ok_statuses
+            # a logged in page sending the user back to /login lost the session
+            if route not in ('/login', '/register') and \
+                    response.headers.get('Location', '').endswith('/login'):
+                ok = False
+            flashed = flashed_messages(self.session.cookies.get('session'))
+            if any(message not in ok_flashes
+                   for message in flashed[self.flashes_seen:]):
+                ok = False
+            self.flashes_seen = len(flashed)
+        except requests.RequestException:
+            ok = False
+        self.recorder.record(route, time.perf_counter() - start, ok)
+
+    def register(self):
+        self.email = 'load{}@test.com'.format(uuid.uuid4().hex[:12])
+        self.request('POST', '/register', {
+            'email': self.email, 'name': 'Load User',
+            'password': PASSWORD, 'password2': PASSWORD})
+
+    def login(self):
+        self.request('POST', '/login', {
+            'email': self.email, 'password': PASSWORD})
+
+    def sell(self):
+        name = 'load' + uuid.uuid4().hex[:12]
+        self.request('POST', '/sell', {
+            'name': name, 'quantity': '100', 'price': '10', 'date': '20771210'})
+        self.own_tickets.append(name)
+        self.tickets.append(name)
+
+    def buy(self):
+        if not self.tickets:
+            return self.sell()
+        self.request('POST', '/buy', {
+            'name': random.choice(self.tickets), 'quantity': '1'})
+
+    def update(self):
+        if not self.own_tickets:
+            return self.sell()
+        self.request('POST', '/update', {
+            'name': random.choice(self.own_tickets), 'quantity': '100',
+            'price': str(random.randint(10, 100)), 'date': '20771210'},
+            ok_flashes=('Successfully updated ticket',))
+
+    def profile(self):
+        self.request('GET', '/', ok_statuses=(200, 304))
+
+    def run(self, routes, weights, deadline):
+        self.register()
+        self.login()
+        flows = {
+            '/': self.profile,
+            '/buy': self.buy,
+            '/sell': self.sell,
+            '/update': self.update,
+            '/login': self.login,
+            # a new account, which the user then carries on as
+            '/register': lambda: (self.register(), self.login()),
+        }
+        while time.monotonic() < deadline:
+            flows[random.choices(routes, weights)[0]]()
+
+
+def run_stage(base_url, users, duration, routes, weights):
+    recorder = Recorder()
+    tickets = []
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(
+        target=VirtualUser(base_url, recorder, tickets).run,
+        args=(routes, weights, deadline), daemon=True)
+        for _ in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = recorder.report(time.perf_counter() - start)
+    report['users'] = users
+    return report
+
+
+def start_server(folder, port, server_mode):
+    """
+    Start the app in its own process on a fresh database and wait until it answers
+    """
+    env = dict(os.environ)
+    # DB_NAME is a path without its leading slash, see qa327/__init__.py
+    env['DB_NAME'] = os.path.join(folder, 'load.sqlite').lstrip('/')
+    env['PORT'] = str(port)
+    env['SERVER_MODE'] = server_mode
+    # every virtual user logs in from 127.0.0.1, see qa327/ratelimit.py
+    env['RATE_LIMIT'] = '0'
+    env.pop('db_string', None)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'qa327'], env=env, cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError('the server exited with {}'.format(process.returncode))
+        try:
+            requests.get(base_url + '/login', timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('the server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the register/login/sell/buy/update flows')
+    parser.add_argument('--url', help='test this server instead of starting one')
+    parser.add_argument('--users', type=int, default=20,
+                        help='concurrent virtual users')
+    parser.add_argument('--ramp', help='comma separated user counts, one stage each')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds each stage runs')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='route=weight pairs, default ' + DEFAULT_MIX)
+    parser.add_argument('--port', type=int, default=18081,
+                        help='port for the server the tool starts')
+    parser.add_argument('--server-mode', default='production',
+                        help='SERVER_MODE for the server the tool starts')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    routes, weights = parse_mix(args.mix)
+    stages = [int(n) for n in args.ramp.split(',')] if args.ramp else [args.users]
+
+    with tempfile.TemporaryDirectory() as folder:
+        process = None
+        base_url = args.url
+        if base_url is None:
+            process, base_url = start_server(folder, args.port, args.server_mode)
+        try:
+            results = [run_stage(base_url.rstrip('/'), users, args.duration, routes, weights)
+                       for users in stages]
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    report = {'mix': dict(zip(routes, weights)), 'stages': results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+"""
+Times the hot functions of qa327/backend.py and qa327/utils.py, and the
+profile page render, against SQLite databases of several sizes, and
+compares the results with a saved baseline.
+
+Each dataset is seeded with the same number of users and tickets, once
+in memory and once in a file, and measured in its own process because
+the app picks its database when it is imported:
+
+    python -m qa327_bench.micro --save          # record the baseline
+    python -m qa327_bench.micro                 # compare with it
+
+The comparison fails with exit status 1 when any function got slower
+than its baseline by more than --threshold (default 0.25, i.e. 25%),
+and with exit status 2 when there is no baseline to compare with.
+Timings depend on the machine, so no baseline is shipped: record one
+on the machine that runs the comparison. --sizes and --storage pick the datasets,
+e.g. --sizes 1000 --storage memory for a quick check.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, 'qa327_bench', 'micro_baseline.json')
+DEFAULT_SIZES = '1000,100000,1000000'
+PASSWORD = 'Password123!'
+SEED_CHUNK = 10000
+
+
+def per_call(function, repeat=5):
+    """
+    :return: the best per-call time in microseconds over a few runs
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def time_pure():
+    """
+    Time the functions that do not touch the database
+    """
+    from qa327 import utils
+    return {
+        'validate_email': per_call(
+            lambda: utils.validate_email('tester0@gmail.com')),
+        'validate_ticket': per_call(
+            lambda: utils.validate_ticket('concert1', '10', '20', '20771210')),
+    }
+
+
+def seed(rows):
+    """
+    Fill the empty database with `rows` users and `rows` tickets
+    """
+    from qa327.models import db, Ticket, User
+    from qa327.passwords import hash_password
+
+    # every user shares one hash, hashing a million passwords would take hours
+    hashed_pw = hash_password(PASSWORD)
+    today = datetime.date.today()
+    for start in range(0, rows, SEED_CHUNK):
+        stop = min(rows, start + SEED_CHUNK)
+        db.session.execute(User.__table__.insert(), [
+            {'email': 'user{}@test.com'.format(i), 'name': 'user{}'.format(i),
+             'password': hashed_pw, 'balance': 5000}
+            for i in range(start, stop)])
+        db.session.execute(Ticket.__table__.insert(), [
+            {'name': 't{}'.format(i), 'quantity': 100, 'price': 20,
+             'expiration_date': today + datetime.timedelta(days=1 + i % 3650)}
+            for i in range(start, stop)])
+        db.session.commit()
+
+
+def time_backend(rows):
+    """
+    Time the backend functions and the profile page against the seeded database
+    """
+    from flask import render_template
+    from qa327 import app, frontend
+    import qa327.backend as bn
+
+    middle = rows // 2
+    email = 'user{}@test.com'.format(middle)
+    ticket = 't{}'.format(middle)
+    cursor = bn.encode_cursor(bn.get_ticket(ticket))
+    user = bn.get_user(email)
+
+    def render_index():
+        # the ticket list is cached between requests, time it uncached
+        frontend.ticket_list_cache.clear()
+        with app.test_request_context('/'):
+            render_template('index.html', user=user, tickets_html=frontend.
+                            render_ticket_list(bn.get_catalogue_version()))
+
+    return {
+        'get_user': per_call(lambda: bn.get_user(email)),
+        'login_user': per_call(lambda: bn.login_user(email, PASSWORD)),
+        'get_all_tickets': per_call(lambda: bn.get_all_tickets()),
+        'get_all_tickets_cursor': per_call(lambda: bn.get_all_tickets(cursor)),
+        'enough_tickets': per_call(lambda: bn.enough_tickets(ticket, 1)),
+        'search_tickets': per_call(lambda: bn.search_tickets(ticket[:3])),
+        'render_index': per_call(render_index),
+    }
+
+
+def worker(rows, output):
+    """
+    Seed and time one dataset, in a process started by run_dataset
+    """
+    from qa327 import app
+    with app.app_context():
+        seed(rows)
+        results = time_backend(rows)
+    with open(output, 'w') as f:
+        json.dump(results, f)
+
+
+def run_dataset(storage, rows, folder):
+    """
+    :param storage: 'memory' or 'disk'
+    :param rows: users and tickets to seed
+    :param folder: where to keep the database file and the results
+    :return: the per-call times in microseconds
+    """
+    env = dict(os.environ)
+    env.pop('DB_NAME', None)
+    env.pop('db_string', None)
+    if storage == 'memory':
+        env['db_string'] = 'sqlite://'
+    else:
+        path = os.path.join(folder, '{}-{}.sqlite'.format(storage, rows))
+        # DB_NAME is a path without its leading slash, see qa327/__init__.py
+        env['DB_NAME'] = path.lstrip('/')
+    output = os.path.join(folder, '{}-{}.json'.format(storage, rows))
+    subprocess.run([sys.executable, '-m', 'qa327_bench.micro',
+                    '--worker', str(rows), output],
+                   env=env, cwd=ROOT, check=True)
+    with open(output) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold):
+    """
+    :param results: the new timings, as {dataset: {function: us}}
+    :param baseline: the saved timings in the same shape
+    :param threshold: the allowed slow-down, e.g. 0.25 for 25%
+    :return: (dataset, function, before, after) for every regression
+    """
+    regressions = []
+    for dataset, timings in results.items():
+        for function, after in timings.items():
+            before = baseline.get(dataset, {}).get(function)
+            if before and after > before * (1 + threshold):
+                regressions.append((dataset, function, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the backend and utils hot functions')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated row counts, default ' + DEFAULT_SIZES)
+    parser.add_argument('--storage', choices=('memory', 'disk', 'both'),
+                        default='both')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='the baseline file to compare with or save to')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slow-down before the run fails')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--worker', nargs=2, metavar=('ROWS', 'OUTPUT'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(int(args.worker[0]), args.worker[1])
+        return 0
+
+    storages = ('memory', 'disk') if args.storage == 'both' else (args.storage,)
+    results = {'pure': time_pure()}
+    with tempfile.TemporaryDirectory() as folder:
+        for rows in [int(n) for n in args.sizes.split(',')]:
+            for storage in storages:
+                dataset = '{}-{}'.format(storage, rows)
+                print('timing {}...'.format(dataset), file=sys.stderr)
+                results[dataset] = run_dataset(storage, rows, folder)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print('{:<16} {:<24} {:>12} {:>12} {:>8}'.format(
+        'dataset', 'function', 'baseline us', 'now us', 'change'))
+    for dataset, timings in results.items():
+        for function, after in timings.items():
+            before = baseline.get(dataset, {}).get(function)
+            print('{:<16} {:<24} {:>12} {:>12.2f} {:>8}'.format(
+                dataset, function,
+                '{:.2f}'.format(before) if before else '-', after,
+                '{:+.0%}'.format(after / before - 1) if before else '-'))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('saved the baseline to {}'.format(args.baseline))
+        return 0
+
+    if not baseline:
+        print('NO BASELINE at {}, nothing was compared; record one with '
+              '--save'.format(args.baseline))
+        return 2
+
+    regressions = compare(results, baseline, args.threshold)
+    for dataset, function, before, after in regressions:
+        print('REGRESSION {} {}: {:.2f} us -> {:.2f} us'.format(
+            dataset, function, before, after))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+import argparse
+import datetime
+import re
+import timeit
+
+from qa327 import utils
+
+"""
+Measures the per-call cost of the validators in qa327/utils.py next to
+the versions they replaced, which are kept below for comparison.
+
+Run with:
+
+    python -m qa327_bench.validators
+"""
+
+
+def legacy_validate_email(email):
+    regex = r'^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$'
+    if len(email) < 1:
+        return "Email must not be empty."
+    if not re.search(regex, email):
+        return "Email format invalid."
+    return False
+
+
+def legacy_validate_password(password):
+    if len(password) < 7:
+        return "Password must be at least 6 characters long."
+    if not any(x.isupper() for x in password):
+        return "Password must have at least one uppercase character."
+    if not any(x.islower() for x in password):
+        return "Password must have at least one lowercase character."
+    if not any(not c.isalpha() for c in password):
+        return "Password must have at least one special character."
+    return False
+
+
+def legacy_validate_ticket_date(date):
+    try:
+        datetime.datetime.strptime(date, '%Y%m%d')
+        return False
+    except:
+        return "Date must be in the format YYYYMMDD."
+
+
+CASES = [
+    ('validate_email', legacy_validate_email, utils.validate_email,
+     ['tester0@gmail.com', 'not an email']),
+    ('validate_password', legacy_validate_password, utils.validate_password,
+     ['Password123!', 'alllowercase1']),
+    ('validate_ticket_date', legacy_validate_ticket_date, utils.validate_ticket_date,
+     ['20771210', '2077-12-10']),
+]
+
+
+def per_call(function, argument, number):
+    """
+    :return: the best per-call time in microseconds over a few runs
+    """
+    runs = timeit.repeat(lambda: function(argument), number=number, repeat=5)
+    return min(runs) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000,
+                        help='calls per timing run')
+    args = parser.parse_args()
+
+    print('{:<22} {:<14} {:>10} {:>10}'.format(
+        'validator', 'input', 'before us', 'after us'))
+    for name, before, after, inputs in CASES:
+        for argument in inputs:
+            assert before(argument) == after(argument)
+            print('{:<22} {:<14} {:>10.3f} {:>10.3f}'.format(
+                name, argument[:14],
+                per_call(before, argument, args.number),
+                per_call(after, argument, args.number)))
+
+    rows = [('t{}'.format(i), '10', '20', '20771210') for i in range(10000)]
+    rows[::100] = [('bad!', '10', '20', '2077-12-10')] * len(rows[::100])
+    seconds = min(timeit.repeat(
+        lambda: utils.validate_tickets_batch(rows), number=1, repeat=5))
+    print('validate_tickets_batch: {} rows in {:.1f} ms ({:.2f} us/row)'.format(
+        len(rows), seconds * 1e3, seconds / len(rows) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
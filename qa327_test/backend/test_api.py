@@ -0,0 +1,69 @@
+import json
+import uuid
+
+from qa327 import app
+from qa327.backend import create_ticket, get_all_tickets
+
+"""
+This file tests the read-only JSON API over the ticket catalogue.
+"""
+
+
+def test_ticket_pages_follow_cursors():
+    for price in (15, 25, 35):
+        create_ticket('a' + uuid.uuid4().hex[:12], 5, price, '20771210')
+    client = app.test_client()
+
+    names, url = [], '/api/tickets?limit=2&sort=price'
+    while url:
+        page = client.get(url).get_json()
+        assert len(page['tickets']) <= 2
+        names += [ticket['name'] for ticket in page['tickets']]
+        url = page['next_cursor'] and \
+            '/api/tickets?limit=2&sort=price&after=' + page['next_cursor']
+
+    listing = get_all_tickets(page_size=10 ** 6, sort='price').tickets
+    assert names == [ticket.name for ticket in listing]
+
+
+def test_ticket_list_revalidates():
+    client = app.test_client()
+    first = client.get('/api/tickets?max_price=50')
+    again = client.get('/api/tickets?max_price=50',
+                       headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+    create_ticket('a' + uuid.uuid4().hex[:12], 5, 20, '20771210')
+    changed = client.get('/api/tickets?max_price=50',
+                         headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200
+
+
+def test_single_ticket():
+    name = 'a' + uuid.uuid4().hex[:12]
+    create_ticket(name, 3, 40, '20771210')
+    client = app.test_client()
+    assert client.get('/api/tickets/' + name).get_json() == {
+        'name': name, 'quantity': 3, 'price': 40, 'date': '20771210'}
+    missing = client.get('/api/tickets/nosuchticket' + uuid.uuid4().hex)
+    assert missing.status_code == 404
+
+    # expired tickets are not in the list, so not on their own either
+    expired = 'a' + uuid.uuid4().hex[:12]
+    create_ticket(expired, 3, 40, '20200101')
+    assert client.get('/api/tickets/' + expired).status_code == 404
+
+
+def test_export_streams_every_ticket(monkeypatch):
+    for _ in range(5):
+        create_ticket('a' + uuid.uuid4().hex[:12], 5, 30, '20771210')
+    # several pages, to cover the walk from one to the next
+    monkeypatch.setitem(app.config, 'EXPORT_PAGE_SIZE', 2)
+
+    response = app.test_client().get('/api/tickets.ndjson?min_quantity=1')
+    assert response.is_streamed
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.data.decode().splitlines()]
+
+    listing = get_all_tickets(page_size=10 ** 6, min_quantity=1).tickets
+    assert [row['name'] for row in rows] == [ticket.name for ticket in listing]
@@ -0,0 +1,91 @@
+import asyncio
+import uuid
+
+from starlette.testclient import TestClient
+
+from qa327 import app
+from qa327.asgi import application, relay
+from qa327.backend import create_ticket
+
+"""
+This file tests the async endpoints of the ASGI server against their
+Flask versions.
+"""
+
+
+def test_async_catalogue_matches_flask():
+    for price in (15, 25, 35):
+        create_ticket('a' + uuid.uuid4().hex[:12], 5, price, '20771210')
+    expired = 'a' + uuid.uuid4().hex[:12]
+    create_ticket(expired, 5, 20, '20200101')
+    flask_client = app.test_client()
+
+    with TestClient(application) as client:
+        for url in ('/api/tickets?limit=2&sort=price_desc&max_price=30',
+                    '/api/tickets?limit=100&expires_from=20771210',
+                    '/api/tickets/t1', '/api/tickets/nothing',
+                    '/api/tickets/' + expired):
+            # the same Accept-Encoding for both, or the larger pages come back
+            # compressed with a weak ETag from one client only
+            expected = flask_client.get(url, headers={'Accept-Encoding': 'identity'})
+            response = client.get(url, headers={'Accept-Encoding': 'identity'})
+            assert response.status_code == expected.status_code
+            assert response.json() == expected.get_json()
+            assert response.headers.get('ETag') == expected.headers.get('ETag')
+
+        etag = response.headers.get('ETag') or client.get('/api/tickets').headers['ETag']
+        assert client.get('/api/tickets', headers={
+            'If-None-Match': etag}).status_code == 304
+
+        # the form routes are the Flask app behind the async endpoints
+        assert client.get('/search?q=t1', allow_redirects=False).status_code == 302
+        client.post('/login', data={'email': 'tester0@gmail.com',
+                                    'password': 'Password123'})
+        result = client.get('/search?q=T1&limit=5').json()
+        assert result['tickets'][0] == {'name': 't1', 'quantity': 50,
+                                        'price': 70.5, 'date': '20771210'}
+
+
+async def read_event_stream(name):
+    received = asyncio.Queue()
+    sent = asyncio.Queue()
+
+    async def receive():
+        return await received.get()
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/events/tickets',
+             'raw_path': b'/events/tickets', 'root_path': '', 'scheme': 'http',
+             'query_string': b'', 'headers': [], 'http_version': '1.1',
+             'client': ('127.0.0.1', 1), 'server': ('127.0.0.1', 80)}
+    stream = asyncio.ensure_future(application(scope, receive, sent.put))
+
+    start = await asyncio.wait_for(sent.get(), 10)
+    assert start['status'] == 200
+    assert (b'content-type', b'text/event-stream; charset=utf-8') in start['headers']
+    assert (await asyncio.wait_for(sent.get(), 10))['body'].startswith(b'retry:')
+    assert len(relay.clients) == 1
+
+    create_ticket(name, 5, 20, '20771210')
+    body = (await asyncio.wait_for(sent.get(), 10))['body'].decode('utf-8')
+
+    # the stream ends, and lets go of its queue, when the client leaves
+    received.put_nowait({'type': 'http.disconnect'})
+    await asyncio.wait_for(stream, 10)
+    return body
+
+
+def test_events_stream_on_the_event_loop():
+    name = 'a' + uuid.uuid4().hex[:12]
+    # the test client starts the database on the current event loop, the
+    # stream must run on that same loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with TestClient(application):
+            body = loop.run_until_complete(read_event_stream(name))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert 'event: ticket' in body
+    assert '"name":"{}"'.format(name) in body
+    assert not relay.clients
@@ -0,0 +1,80 @@
+import gzip
+import json
+import os
+import tempfile
+
+from unittest.mock import patch
+
+from qa327 import app, assets
+
+"""
+This file tests the asset build against fake downloads, and how the
+built files are served.
+"""
+
+SOURCES = {
+    'https://example.com/css/site.css':
+        b'/* theme */ body { font-family: "Poppins"; }\n'
+        b'@font-face { src: url(../fonts/icons.woff2?v=1#iefix) format("woff2"),'
+        b' url("data:font/woff;base64,AAAA"); }',
+    'https://example.com/fonts/icons.woff2?v=1': b'font bytes',
+    'https://example.com/js/a.js': b'var a = 1',
+    'https://example.com/js/b.js': b'var b = 2;',
+    'https://example.com/favicon.ico': b'icon bytes',
+}
+
+
+def build(folder):
+    with patch.multiple(assets, dist_dir=folder,
+                        manifest_path=os.path.join(folder, 'manifest.json'),
+                        STYLESHEETS=['https://example.com/css/site.css'],
+                        SCRIPTS=['https://example.com/js/a.js', 'https://example.com/js/b.js'],
+                        FILES={'favicon.ico': 'https://example.com/favicon.ico'},
+                        fetch=lambda url: SOURCES[url]):
+        return assets.build()
+
+
+def read(folder, name):
+    with open(os.path.join(folder, name), 'rb') as f:
+        return f.read()
+
+
+def test_build_bundles_and_vendors():
+    with tempfile.TemporaryDirectory() as folder:
+        manifest = build(folder)
+
+        css = read(folder, manifest['app.css']).decode()
+        font = [name for name in os.listdir(folder)
+                if name.startswith('icons.') and name.endswith('.woff2')][0]
+        assert 'theme' not in css
+        assert 'url("{}#iefix")'.format(font) in css
+        assert 'data:font/woff' in css
+        assert read(folder, font) == b'font bytes'
+
+        assert read(folder, manifest['app.js']) == b'var a = 1;\nvar b = 2;'
+        assert gzip.decompress(read(folder, manifest['app.js'] + '.gz')) == \
+            b'var a = 1;\nvar b = 2;'
+        assert json.loads(read(folder, 'manifest.json')) == manifest
+
+
+def test_minify_keeps_descendant_pseudo_classes():
+    css = assets.minify_css('.nav :hover , .nav > li:focus { color : red ; }')
+    # `.nav :hover` and `.nav:hover` select different elements
+    assert css == '.nav :hover,.nav>li:focus{color:red;}'
+
+
+def test_dist_assets_served_precompressed_and_immutable():
+    with tempfile.TemporaryDirectory() as folder:
+        manifest = build(folder)
+        client = app.test_client()
+        with patch.object(assets, 'dist_dir', folder):
+            plain = client.get('/static/dist/' + manifest['app.js'])
+            zipped = client.get('/static/dist/' + manifest['app.js'],
+                                headers={'Accept-Encoding': 'gzip'})
+
+        assert plain.data == b'var a = 1;\nvar b = 2;'
+        assert 'immutable' in plain.headers['Cache-Control']
+        assert 'max-age=31536000' in plain.headers['Cache-Control']
+        assert zipped.headers['Content-Encoding'] == 'gzip'
+        assert zipped.headers['Content-Type'] == plain.headers['Content-Type']
+        assert gzip.decompress(zipped.data) == plain.data
@@ -0,0 +1,99 @@
+import io
+import uuid
+from unittest.mock import patch
+
+from qa327.bulk import read_tickets
+import qa327.backend as bn
+from qa327.backend import get_ticket, import_tickets
+
+"""
+This file tests bulk ticket imports from CSV and NDJSON uploads.
+"""
+
+
+def upload(text):
+    return io.BytesIO(text.encode('utf-8'))
+
+
+def test_csv_import_in_batches_with_errors():
+    prefix = 'i' + uuid.uuid4().hex[:8]
+    lines = ['name,quantity,price,date']
+    lines += ['{}{},10,20,20771210'.format(prefix, i) for i in range(25)]
+    lines += ['bad name,10,20,20771210', '{}0,10,20,20771210'.format(prefix)]
+
+    report = import_tickets(read_tickets(
+        upload('\n'.join(lines)), 'csv'), batch_size=10)
+
+    assert report['imported'] == 25
+    assert report['failed'] == 2
+    assert report['errors'] == [
+        {'line': 27, 'error': "Name must have alphanumeric characters only."},
+        {'line': 28, 'error': "A ticket with that name already exists."},
+    ]
+    assert get_ticket(prefix + '24').quantity == 10
+
+
+def test_duplicate_names_are_found_before_inserting():
+    prefix = 'm' + uuid.uuid4().hex[:8]
+    lines = ['name,quantity,price,date', 't1,10,20,20771210']
+    lines += ['{}{},10,20,20771210'.format(prefix, i) for i in range(3)]
+    lines += ['{}0,10,20,20771210'.format(prefix), 'bad name,10,20,20771210']
+
+    with patch('qa327.backend.insert_tickets', wraps=bn.insert_tickets) as insert:
+        report = import_tickets(read_tickets(upload('\n'.join(lines)), 'csv'))
+
+    # the taken names are looked up with one query, so the three new
+    # tickets go in with a single insert, not one at a time
+    assert insert.call_count == 1
+    assert [line for line, _ in insert.call_args[0][0]] == [3, 4, 5]
+    assert report['imported'] == 3
+    assert report['errors'] == [
+        {'line': 2, 'error': "A ticket with that name already exists."},
+        {'line': 6, 'error': "A ticket with that name already exists."},
+        {'line': 7, 'error': "Name must have alphanumeric characters only."},
+    ]
+
+
+def test_csv_missing_columns():
+    report = import_tickets(read_tickets(upload('name,price\nx,10\n'), 'csv'))
+    assert report['imported'] == 0
+    assert report['errors'][0]['error'] == 'Missing columns: quantity, date'
+
+
+def test_csv_rows_with_missing_or_extra_columns():
+    name = 'k' + uuid.uuid4().hex[:8]
+    text = 'name,quantity,price,date\nshort,10\nlong,10,20,20771210,x\n'
+    text += '{},10,20,20771210\n'.format(name)
+
+    report = import_tickets(read_tickets(upload(text), 'csv'))
+
+    assert report['imported'] == 1
+    assert report['errors'] == [
+        {'line': 2, 'error': 'Row must have 4 columns, like the header'},
+        {'line': 3, 'error': 'Row must have 4 columns, like the header'}]
+    assert get_ticket(name).quantity == 10
+
+
+def test_upload_that_is_not_utf8():
+    name = 'l' + uuid.uuid4().hex[:8]
+    data = 'name,quantity,price,date\n{},10,20,20771210\n'.format(name).encode('utf-8')
+    data += b'caf\xe9,10,20,20771210\n'
+
+    report = import_tickets(read_tickets(io.BytesIO(data), 'csv'))
+
+    assert report['imported'] == 0
+    assert report['errors'] == [
+        {'line': 1, 'error': 'File is not UTF-8, nothing from this line on was read'}]
+
+
+def test_ndjson_import():
+    name = 'j' + uuid.uuid4().hex[:8]
+    text = '{{"name": "{}", "quantity": 3, "price": 50, "date": "20771210"}}\n'.format(name)
+    text += '\n[1, 2]\n'
+
+    report = import_tickets(read_tickets(upload(text), 'ndjson'))
+
+    assert report['imported'] == 1
+    assert report['errors'] == [
+        {'line': 3, 'error': 'Row must be a JSON object with name, quantity, price, date'}]
+    assert get_ticket(name).price == 50
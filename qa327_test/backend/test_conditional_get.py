@@ -0,0 +1,55 @@
+import gzip
+import uuid
+
+from qa327 import app
+from qa327.backend import create_ticket
+
+"""
+This file tests ETag revalidation of the profile page and the on the
+fly compression of responses.
+"""
+
+
+def logged_in_client():
+    client = app.test_client()
+    client.post('/login', data={'email': 'tester0@gmail.com',
+                                'password': 'Password123'})
+    return client
+
+
+def test_profile_not_modified_until_tickets_change():
+    client = logged_in_client()
+    first = client.get('/')
+    etag = first.headers['ETag']
+    assert 'no-cache' in first.headers['Cache-Control']
+
+    again = client.get('/', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+
+    create_ticket('e' + uuid.uuid4().hex[:12], 10, 10, '20771210')
+    changed = client.get('/', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_profile_compressed_and_revalidated():
+    client = logged_in_client()
+    plain = client.get('/')
+    zipped = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in zipped.headers['Vary']
+    assert gzip.decompress(zipped.data) == plain.data
+    # the compressed page only gets a weak validator
+    assert zipped.headers['ETag'] == 'W/' + plain.headers['ETag']
+
+    again = client.get('/', headers={'Accept-Encoding': 'gzip',
+                                     'If-None-Match': zipped.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_small_responses_not_compressed():
+    response = app.test_client().get('/metrics/pool',
+                                     headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
@@ -0,0 +1,113 @@
+import json
+import uuid
+
+from qa327 import app
+from qa327.backend import create_ticket, get_catalogue_version, get_ticket_changes, import_tickets, trim_ticket_changes, update_ticket
+from qa327.events import broadcaster
+from qa327.models import TicketChange
+
+"""
+This file tests the live ticket changes pushed on /events/tickets.
+"""
+
+
+def read_events(response):
+    # the stream never ends, so read it one event at a time
+    for chunk in response.response:
+        yield chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+
+
+def next_ticket_event(events):
+    for event in events:
+        if 'event: ticket' in event:
+            return event
+
+
+def test_changes_are_pushed_once_to_every_client():
+    client = app.test_client()
+    first = client.get('/events/tickets', buffered=False)
+    second = client.get('/events/tickets', buffered=False)
+    assert first.mimetype == 'text/event-stream'
+    assert first.headers['Cache-Control'] == 'no-cache'
+    first_events, second_events = read_events(first), read_events(second)
+    assert next(first_events).startswith('retry:')
+    assert next(second_events).startswith('retry:')
+
+    name = 'a' + uuid.uuid4().hex[:12]
+    create_ticket(name, 5, 20, '20771210')
+    update_ticket(name, 3, 25, '20771210')
+
+    for events in (first_events, second_events):
+        event = next_ticket_event(events)
+        lines = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+        assert int(lines['id']) <= get_catalogue_version()
+        ticket = json.loads(lines['data'])
+        if ticket['quantity'] == 5:
+            # the poller may see the two writes separately
+            ticket = json.loads(next_ticket_event(events).split('data: ')[1])
+        assert ticket == {'name': name, 'quantity': 3, 'price': 25.0,
+                          'date': '20771210'}
+
+    listening = len(broadcaster)
+    first.close()
+    second.close()
+    assert len(broadcaster) == listening - 2
+
+
+def test_stale_client_is_told_to_resync():
+    version = get_catalogue_version()
+    client = app.test_client()
+
+    current = client.get('/events/tickets?since={}'.format(version), buffered=False)
+    events = read_events(current)
+    next(events)
+    create_ticket('a' + uuid.uuid4().hex[:12], 5, 20, '20771210')
+    assert 'event: ticket' in next(events)
+    current.close()
+
+    stale = client.get('/events/tickets', buffered=False,
+                       headers={'Last-Event-ID': str(version)})
+    events = read_events(stale)
+    next(events)
+    assert next(events).startswith('id: {}\nevent: resync'.format(
+        get_catalogue_version()))
+    stale.close()
+
+
+def test_large_changes_ask_for_a_resync():
+    with app.app_context():
+        version = get_catalogue_version()
+        prefix = 'a' + uuid.uuid4().hex[:8]
+        import_tickets((line, ('{}x{}'.format(prefix, line), '5', '20', '20771210'))
+                       for line in range(app.config['EVENTS_MAX_CHANGES'] + 1))
+        current, tickets = get_ticket_changes(version)
+        assert current == version + 1
+        assert tickets is None
+
+        name = 'a' + uuid.uuid4().hex[:12]
+        create_ticket(name, 5, 20, '20771210')
+        assert [ticket.name for ticket in get_ticket_changes(current)[1]] == [name]
+
+
+def test_change_log_keeps_the_last_versions():
+    size = app.config['TICKET_CHANGE_LOG_SIZE']
+    app.config['TICKET_CHANGE_LOG_SIZE'] = 1
+    try:
+        with app.app_context():
+            create_ticket('a' + uuid.uuid4().hex[:12], 5, 20, '20771210')
+            trim_ticket_changes()
+            versions = {change.version for change in TicketChange.query}
+            assert versions == {get_catalogue_version()}
+    finally:
+        app.config['TICKET_CHANGE_LOG_SIZE'] = size
+
+
+def test_clients_beyond_the_limit_are_turned_away():
+    limit = app.config['EVENTS_MAX_CLIENTS']
+    app.config['EVENTS_MAX_CLIENTS'] = len(broadcaster)
+    try:
+        response = app.test_client().get('/events/tickets')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '30'
+    finally:
+        app.config['EVENTS_MAX_CLIENTS'] = limit
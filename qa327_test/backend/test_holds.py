@@ -0,0 +1,107 @@
+import uuid
+
+from qa327 import app
+from qa327.backend import confirm_hold, create_ticket, get_holds, get_ticket, get_user, hold_tickets, register_user, release_hold, update_ticket
+from qa327.holds import sweep
+from qa327.models import Hold
+
+"""
+This file tests holding tickets while a user checks out.
+
+Every test creates its own user and ticket with a random name so the
+tests do not depend on each other.
+"""
+
+
+def make_user():
+    email = 'holder{}@test.com'.format(uuid.uuid4().hex[:8])
+    register_user(email, 'Holder', 'Password123!', 'Password123!')
+    return get_user(email)
+
+
+def make_ticket(quantity):
+    name = 'h' + uuid.uuid4().hex[:12]
+    create_ticket(name, quantity, 10, '20771210')
+    return name
+
+
+def test_held_tickets_are_taken_off_the_stock_until_confirmed():
+    user = make_user()
+    name = make_ticket(5)
+    balance = user.balance
+
+    assert hold_tickets(user, name, 3) is None
+    assert get_ticket(name).quantity == 2
+    assert hold_tickets(make_user(), name, 3) == "The request quantity is not available."
+
+    holds = get_holds(user.id)
+    assert [(hold.ticket_name, hold.quantity) for hold in holds] == [(name, 3)]
+    hold_id = holds[0].id
+    assert confirm_hold(make_user(), hold_id) == "Hold does not exist."
+    assert confirm_hold(user, hold_id) is None
+    assert get_user(user.email).balance == balance - 43
+    assert get_ticket(name).quantity == 2
+    assert get_holds(user.id) == []
+    assert confirm_hold(user, hold_id) == "Hold does not exist."
+
+
+def test_holds_of_invalid_quantities_or_expired_tickets_are_refused():
+    user = make_user()
+    name = make_ticket(5)
+    for quantity in (0, -5):
+        assert hold_tickets(user, name, quantity) == "Invalid ticket."
+
+    expired = 'h' + uuid.uuid4().hex[:12]
+    create_ticket(expired, 5, 10, '20200101')
+    assert hold_tickets(user, expired, 1) == "Ticket has expired."
+    assert get_ticket(name).quantity == 5
+    assert get_ticket(expired).quantity == 5
+    assert get_holds(user.id) == []
+
+
+def test_expired_holds_are_released_by_the_sweeper():
+    user = make_user()
+    name = make_ticket(5)
+    assert hold_tickets(user, name, 4, ttl=-1) is None
+    assert get_ticket(name).quantity == 1
+    # expired holds are no longer shown, and can not be bought
+    assert get_holds(user.id) == []
+    hold_id = Hold.query.filter_by(user_id=user.id).one().id
+    # the sweeper thread may already have released it
+    assert confirm_hold(user, hold_id) in ("Hold has expired.", "Hold does not exist.")
+    assert get_user(user.email).balance == user.balance
+
+    sweep()
+    assert get_ticket(name).quantity == 5
+
+
+def test_updates_leave_the_held_tickets_out_of_the_stock():
+    user = make_user()
+    name = make_ticket(5)
+    assert hold_tickets(user, name, 3) is None
+
+    # the owner sets 10 in all, 3 of them held
+    assert update_ticket(name, 10, 10, '20771210') is None
+    assert get_ticket(name).quantity == 7
+    assert update_ticket(name, 2, 10, '20771210') == \
+        'Quantity can not be less than the 3 tickets held.'
+
+    release_hold(user, get_holds(user.id)[0].id)
+    assert get_ticket(name).quantity == 10
+
+
+def test_holds_from_the_profile_page():
+    name = make_ticket(5)
+    client = app.test_client()
+    client.post('/login', data={'email': 'tester0@gmail.com',
+                                'password': 'Password123'})
+
+    client.post('/hold', data={'name': name, 'quantity': '2'})
+    page = client.get('/').data.decode('utf-8')
+    assert '2 x {}'.format(name) in page
+
+    user = get_user('tester0@gmail.com')
+    hold_id = [hold.id for hold in get_holds(user.id) if hold.ticket_name == name][0]
+    client.post('/holds/{}/release'.format(hold_id))
+    assert get_ticket(name).quantity == 5
+    assert '2 x {}'.format(name) not in client.get('/').data.decode('utf-8')
@@ -0,0 +1,48 @@
+import uuid
+
+from qa327 import app
+from qa327_bench.loadtest import Recorder, VirtualUser
+
+"""
+This file tests how the load test tells good requests from failed ones.
+"""
+
+
+class FlaskSession:
+    """
+    The part of requests.Session the virtual users need, on the Flask test client
+    """
+
+    def __init__(self):
+        self.client = app.test_client()
+        self.cookies = {}
+
+    def request(self, method, url, data=None, allow_redirects=False, timeout=None):
+        response = self.client.open(url, method=method, data=data,
+                                    follow_redirects=allow_redirects)
+        for cookie in self.client.cookie_jar:
+            if cookie.name == 'session':
+                self.cookies['session'] = cookie.value
+        return response
+
+
+def test_failed_buys_count_as_errors():
+    recorder = Recorder()
+    user = VirtualUser('', recorder, ['t1'])
+    user.session = FlaskSession()
+    user.register()
+    user.login()
+
+    user.buy()
+    user.sell()
+    user.update()
+    # a sold out or missing ticket is a 302 back to / like a good buy,
+    # with the reason flashed
+    user.tickets[:] = ['missing' + uuid.uuid4().hex[:8]]
+    user.buy()
+    user.profile()
+    user.tickets[:] = ['t1']
+    user.buy()
+
+    assert len(recorder.latencies['/buy']) == 3
+    assert recorder.errors == {'/buy': 1}
@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from qa327 import app
+from qa327.metrics import Histogram, aggregate, bucket_index, \
+    bucket_lower_bound, collect, registry
+
+"""
+This file tests the request metrics and their aggregation across processes.
+"""
+
+
+def test_buckets_within_relative_error():
+    for micros in (0, 1, 15, 16, 17, 100, 1000, 123456, 10 ** 9):
+        index = bucket_index(micros)
+        assert bucket_lower_bound(index) <= micros < bucket_lower_bound(index + 1)
+        assert bucket_lower_bound(index + 1) - bucket_lower_bound(index) <= \
+            max(1, micros / 16)
+
+
+def test_histogram_quantiles_and_merge():
+    first, second = Histogram(), Histogram()
+    for i in range(1, 101):
+        first.record(i / 1000)
+    second.record(5.0)
+    first.merge(second)
+    assert first.count == 101
+    assert 0.048 <= first.quantile(0.5) <= 0.053
+    assert first.quantile(1.0) >= 5.0
+    assert first.cumulative(1 << 20) == 100
+
+
+def test_metrics_endpoint_reports_routes():
+    client = app.test_client()
+    client.get('/login')
+    body = client.get('/metrics').data.decode('utf-8')
+    assert 'qa327_requests_total{method="GET",endpoint="/login",status="200"}' in body
+    assert 'qa327_request_duration_seconds_bucket{method="GET",endpoint="/login",le="+Inf"}' in body
+    assert 'qa327_requests_in_flight{method="GET",endpoint="/metrics"} 1' in body
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_aggregate_across_processes():
+    # two processes that have exited, each with one request still in flight
+    dead = Histogram()
+    dead.record(0.01)
+    ours = registry.statuses.get('GET / 200', 0)
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(2):
+            pid = dead_pid()
+            with open(os.path.join(directory, '{}.json'.format(pid)), 'w') as f:
+                json.dump({'pid': pid,
+                           'histograms': {'GET /': dead.to_dict()},
+                           'statuses': {'GET / 200': 1},
+                           'in_flight': {'GET /': 1},
+                           'pool': {'checked_out': 3}}, f)
+        histograms, statuses, in_flight, pool = aggregate(collect(directory))
+
+        # the exited processes are added up into one file, once
+        assert sorted(name for name in os.listdir(directory)
+                      if name.endswith('.json')) == ['exited.json']
+        assert aggregate(collect(directory))[1]['GET / 200'] == \
+            registry.statuses.get('GET / 200', 0) + 2
+
+    assert statuses['GET / 200'] == ours + 2
+    assert histograms['GET /'].count >= 2
+    # gauges of exited processes are dropped
+    assert in_flight.get('GET /', 0) == registry.in_flight.get('GET /', 0)
+    assert pool.get('checked_out', 0) < 3
@@ -0,0 +1,86 @@
+import threading
+import time
+import uuid
+
+import pytest
+from unittest.mock import patch
+from werkzeug.security import generate_password_hash
+
+from qa327 import app
+from qa327.models import db, User
+from qa327.passwords import HashingBusy, hash_method, hash_password, hash_slots, \
+    needs_rehash, verify_password
+from qa327.backend import get_user, login_user
+
+"""
+This file tests password hashing, the upgrade of old hashes on login
+and the bound on hashes running or waiting.
+"""
+
+
+def test_new_hashes_use_configured_method():
+    pwhash = hash_password('Password123!')
+    assert pwhash.startswith(hash_method() + '$')
+    assert not needs_rehash(pwhash)
+    assert verify_password(pwhash, 'Password123!')
+    assert not verify_password(pwhash, 'Wrong123!')
+
+
+def test_login_upgrades_old_hash():
+    email = 'legacy{}@test.com'.format(uuid.uuid4().hex[:8])
+    db.session.add(User(email=email, name='Legacy', balance=5000,
+                        password=generate_password_hash('Password123!', method='sha256')))
+    db.session.commit()
+
+    assert login_user(email, 'Password123!') is not None
+
+    db.session.expire_all()
+    upgraded = get_user(email).password
+    assert not needs_rehash(upgraded)
+    # and the upgraded hash still logs in
+    assert login_user(email, 'Password123!') is not None
+
+
+def test_full_pool_turns_logins_away():
+    with patch('qa327.passwords._slots', threading.BoundedSemaphore(1)) as slots:
+        slots.acquire()
+        with pytest.raises(HashingBusy):
+            login_user('tester0@gmail.com', 'Password123')
+
+
+def test_other_routes_are_served_while_hashing_is_full(monkeypatch):
+    # four server threads, so hashing may hold three of them
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_THREADS', 3)
+    assert hash_slots() == 3
+    slots = threading.BoundedSemaphore(hash_slots())
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def slow_check(pwhash, password):
+        started.release()
+        release.wait(10)
+        return False
+
+    pwhash = hash_password('Password123!')
+    with patch('qa327.passwords._slots', slots), \
+            patch('qa327.passwords._running', threading.BoundedSemaphore(1)), \
+            patch('qa327.passwords.check_password_hash', slow_check):
+        # one hash running and two waiting hold every slot
+        hashing = [threading.Thread(target=verify_password, args=(pwhash, 'x'))
+                   for _ in range(3)]
+        for thread in hashing:
+            thread.start()
+        try:
+            assert started.acquire(timeout=10)
+            while slots._value:
+                time.sleep(0.01)
+
+            client = app.test_client()
+            response = client.post('/login', data={'email': 'tester0@gmail.com',
+                                                   'password': 'Password123'})
+            assert b'Too many logins right now' in response.data
+            assert client.get('/api/tickets/t1').status_code == 200
+        finally:
+            release.set()
+            for thread in hashing:
+                thread.join(10)
@@ -0,0 +1,39 @@
+import pytest
+from sqlalchemy import create_engine, exc
+
+from qa327.pool import InstrumentedQueuePool, engine_options, pool_status
+
+"""
+This file tests the instrumented connection pool used for server databases.
+"""
+
+
+def test_engine_options_from_settings():
+    options = engine_options({'DB_POOL_SIZE': '4', 'DB_POOL_PRE_PING': '0'})
+    assert options['poolclass'] is InstrumentedQueuePool
+    assert options['pool_size'] == 4
+    assert options['pool_pre_ping'] is False
+    assert engine_options({})['pool_pre_ping'] is True
+
+
+def test_pool_counts_checkouts_and_timeouts():
+    engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                           pool_size=1, max_overflow=0, pool_timeout=0.1)
+    connection = engine.connect()
+
+    status = pool_status(engine)
+    assert status['checkouts'] == 1
+    assert status['checked_out'] == 1
+
+    # the only connection is taken, so the next checkout has to time out
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    connection.close()
+
+    status = pool_status(engine)
+    assert status['timeouts'] == 1
+    assert status['checked_out'] == 0
+
+    # the totals survive the pool being replaced
+    engine.dispose()
+    assert pool_status(engine)['checkouts'] == 1
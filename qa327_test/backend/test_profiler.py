@@ -0,0 +1,66 @@
+import uuid
+
+import pytest
+
+from qa327 import app
+from qa327.backend import create_ticket
+from qa327.profiler import QueryRecorder, query_budget
+
+"""
+This file holds the routes to their query budgets, so a change that adds
+queries to them, or runs the same one twice, fails here.
+"""
+
+
+def logged_in_client():
+    client = app.test_client()
+    client.post('/login', data={'email': 'tester0@gmail.com',
+                                'password': 'Password123'})
+    return client
+
+
+def test_route_query_budgets():
+    client = logged_in_client()
+    name = 'q' + uuid.uuid4().hex[:12]
+    create_ticket(name, 100, 10, '20771210')
+
+    # the user lookup, the stock and balance updates, the price, the version
+    # bump and the change log entry
+    with query_budget(6):
+        client.post('/buy', data={'name': name, 'quantity': '1'})
+    # the locked ticket lookup, the held tickets, the update, the version
+    # bump and the change log entry
+    with query_budget(5):
+        client.post('/update', data={'name': name, 'quantity': '50',
+                                     'price': '20', 'date': '20771210'})
+    with query_budget(3):
+        client.post('/sell', data={'name': 'q' + uuid.uuid4().hex[:12],
+                                   'quantity': '10', 'price': '10',
+                                   'date': '20771210'})
+    # the version, the user's holds and the ticket page
+    with query_budget(4):
+        client.get('/')
+
+
+def test_query_budget_reports_repeats():
+    client = logged_in_client()
+    with pytest.raises(AssertionError, match='repeated queries'):
+        with query_budget(10):
+            # both read the catalogue version
+            client.get('/')
+            client.get('/')
+
+    with pytest.raises(AssertionError, match='budget is 0'):
+        with query_budget(0):
+            client.get('/')
+
+
+def test_server_timing_header():
+    client = logged_in_client()
+    app.config['SQL_PROFILER'] = True
+    try:
+        with QueryRecorder() as recorder:
+            response = client.get('/')
+    finally:
+        app.config['SQL_PROFILER'] = False
+    assert '{} queries'.format(recorder.count) in response.headers['Server-Timing']
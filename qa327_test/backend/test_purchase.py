@@ -0,0 +1,106 @@
+import threading
+import uuid
+
+from qa327 import app
+from qa327.models import db, User
+from qa327.backend import create_ticket, get_ticket, get_user, purchase_ticket, register_user
+
+"""
+This file tests purchase_ticket against the real database.
+
+Every test creates its own user and ticket with a random name so the
+tests do not depend on each other or on the data left by other suites.
+"""
+
+
+def make_user():
+    email = 'buyer{}@test.com'.format(uuid.uuid4().hex[:8])
+    register_user(email, 'Buyer', 'Password123!', 'Password123!')
+    return get_user(email)
+
+
+def make_ticket(quantity, price=10):
+    name = 't' + uuid.uuid4().hex[:12]
+    create_ticket(name, quantity, price, '20771210')
+    return name
+
+
+def test_purchase_takes_stock_and_balance():
+    user = make_user()
+    name = make_ticket(10)
+
+    assert purchase_ticket(user, name, 3) is None
+
+    db.session.expire_all()
+    assert get_ticket(name).quantity == 7
+    # 3 * 10 * 1.35 * 1.05 = 42.525, rounded up
+    assert User.query.get(user.id).balance == 5000 - 43
+
+
+def test_purchase_ticket_does_not_exist():
+    user = make_user()
+    assert purchase_ticket(user, 'nosuchticket', 1) == "Ticket does not exist."
+
+
+def test_purchase_rejects_quantities_below_one():
+    user = make_user()
+    name = make_ticket(10)
+
+    for quantity in (0, -5):
+        assert purchase_ticket(user, name, quantity) == "Invalid ticket."
+
+    db.session.expire_all()
+    assert get_ticket(name).quantity == 10
+    assert User.query.get(user.id).balance == 5000
+
+
+def test_purchase_expired_ticket():
+    user = make_user()
+    name = 't' + uuid.uuid4().hex[:12]
+    create_ticket(name, 10, 10, '20200101')
+
+    assert purchase_ticket(user, name, 1) == "Ticket has expired."
+    db.session.expire_all()
+    assert get_ticket(name).quantity == 10
+    assert User.query.get(user.id).balance == 5000
+
+
+def test_purchase_not_enough_tickets():
+    user = make_user()
+    name = make_ticket(2)
+
+    assert purchase_ticket(
+        user, name, 3) == "The request quantity is not available."
+    db.session.expire_all()
+    assert get_ticket(name).quantity == 2
+
+
+def test_purchase_not_enough_balance_keeps_stock():
+    user = make_user()
+    name = make_ticket(100, price=100)
+
+    assert purchase_ticket(user, name, 100) == "Insufficient balance."
+    db.session.expire_all()
+    assert get_ticket(name).quantity == 100
+    assert User.query.get(user.id).balance == 5000
+
+
+def test_concurrent_purchases_never_oversell():
+    name = make_ticket(10)
+    buyers = [make_user() for _ in range(20)]
+    results = []
+
+    def buy(user_id):
+        with app.app_context():
+            user = User.query.get(user_id)
+            results.append(purchase_ticket(user, name, 1))
+
+    threads = [threading.Thread(target=buy, args=(u.id,)) for u in buyers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db.session.expire_all()
+    assert results.count(None) == 10
+    assert get_ticket(name).quantity == 0
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import time
+import uuid
+
+import qa327.backend as bn
+from qa327 import app
+from qa327.ratelimit import MemoryStore, SQLiteStore, store
+
+"""
+This file tests the limits on login and registration attempts.
+"""
+
+
+def limit_attempts(ip_burst, email_burst):
+    app.config.update(RATE_LIMIT=True, RATE_LIMIT_IP_BURST=ip_burst,
+                      RATE_LIMIT_EMAIL_BURST=email_burst)
+    store.clear()
+
+
+def test_login_attempts_beyond_the_burst_are_refused(monkeypatch):
+    saved = {key: app.config[key] for key in (
+        'RATE_LIMIT', 'RATE_LIMIT_IP_BURST', 'RATE_LIMIT_EMAIL_BURST')}
+    try:
+        limit_attempts(ip_burst=10, email_burst=2)
+        client = app.test_client()
+        for _ in range(2):
+            response = client.post('/login', data={'email': 'tester0@gmail.com',
+                                                   'password': 'Wrong1234!'})
+            assert response.status_code == 200
+
+        # refused before the user is looked up or a password hashed
+        monkeypatch.setattr(bn, 'get_user', None)
+        response = client.post('/login', data={'email': 'Tester0@gmail.com',
+                                               'password': 'Password123'})
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        assert b'Too many attempts' in response.data
+        monkeypatch.undo()
+
+        # other emails from the same address still count against it
+        limit_attempts(ip_burst=1, email_burst=10)
+        email = 'a{}@gmail.com'.format(uuid.uuid4().hex[:8])
+        form = {'email': email, 'name': 'Rate Limit', 'password': 'Password123!',
+                'password2': 'Password123!'}
+        assert client.post('/register', data=form).status_code != 429
+        assert client.post('/register', data=form).status_code == 429
+    finally:
+        app.config.update(saved)
+        store.clear()
+
+
+def test_buckets_refill_over_time():
+    buckets = MemoryStore()
+    assert buckets.take('key', 1, 20) == 0
+    assert buckets.take('key', 1, 20) is None
+    time.sleep(0.1)
+    assert buckets.take('key', 1, 20) is not None
+
+
+def test_sqlite_buckets_are_shared():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'ratelimit.sqlite')
+        # as two worker processes would open it
+        first, second = SQLiteStore(path), SQLiteStore(path)
+        assert first.take('key', 2, 0.01) is not None
+        assert second.take('key', 2, 0.01) is not None
+        assert first.take('key', 2, 0.01) is None
+        assert second.take('other', 2, 0.01) is not None
@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import tempfile
+import uuid
+
+from qa327 import app
+from qa327.backend import create_ticket
+from qa327.models import db
+
+"""
+This file tests the routing of reads to read replicas.
+"""
+
+
+def make_replica(folder):
+    """
+    Copy the test database into a replica file
+    :return: the URL of the replica
+    """
+    path = os.path.join(folder, 'replica.sqlite')
+    primary = sqlite3.connect(db.engine.url.database)
+    replica = sqlite3.connect(path)
+    primary.backup(replica)
+    primary.close()
+    replica.close()
+    return 'sqlite:///' + path
+
+
+def add_replica_ticket(url, name):
+    # a ticket only the replica has, to tell where a read went
+    replica = sqlite3.connect(url[len('sqlite:///'):])
+    replica.execute("INSERT INTO ticket (name, quantity, price, expiration_date) "
+                    "VALUES (?, 5, 20, '2077-12-10 00:00:00.000000')", (name,))
+    replica.commit()
+    replica.close()
+
+
+def use_replicas(*urls):
+    app.config['REPLICA_URLS'] = list(urls)
+    db.router.start(lambda: db.engine)
+
+
+def test_reads_go_to_the_replica_until_the_user_writes():
+    name = 'a' + uuid.uuid4().hex[:12]
+    with tempfile.TemporaryDirectory() as folder:
+        url = make_replica(folder)
+        add_replica_ticket(url, name)
+        try:
+            use_replicas(url)
+            assert db.router.status()[0]['healthy']
+            client = app.test_client()
+            assert client.get('/api/tickets/' + name).status_code == 200
+
+            client.post('/login', data={'email': 'tester0@gmail.com',
+                                        'password': 'Password123'})
+            client.post('/sell', data={'name': 'a' + uuid.uuid4().hex[:12],
+                                       'quantity': '5', 'price': '20',
+                                       'date': '20771210'})
+            # the user now reads their own writes from the primary
+            assert client.get('/api/tickets/' + name).status_code == 404
+            assert app.test_client().get('/api/tickets/' + name).status_code == 200
+        finally:
+            app.config['REPLICA_URLS'] = []
+            db.router.dispose()
+
+
+def test_lagging_and_unreachable_replicas_are_left_out():
+    name = 'a' + uuid.uuid4().hex[:12]
+    max_lag = app.config['REPLICA_MAX_LAG']
+    with tempfile.TemporaryDirectory() as folder:
+        url = make_replica(folder)
+        add_replica_ticket(url, name)
+        try:
+            use_replicas(url, 'sqlite:///' + os.path.join(folder, 'missing', 'db.sqlite'))
+            assert [replica['healthy'] for replica in db.router.status()] == [True, False]
+            assert db.router.status()[1]['error']
+
+            # the primary moves on and the replica does not follow
+            app.config['REPLICA_MAX_LAG'] = 0
+            create_ticket('a' + uuid.uuid4().hex[:12], 5, 20, '20771210')
+            db.router.check(db.engine)
+            assert db.router.choose() is None
+            assert not db.router.status()[0]['healthy']
+            assert app.test_client().get('/api/tickets/' + name).status_code == 404
+            assert app.test_client().get('/metrics/pool').get_json()['replicas']
+        finally:
+            app.config['REPLICA_MAX_LAG'] = max_lag
+            app.config['REPLICA_URLS'] = []
+            db.router.dispose()
@@ -0,0 +1,55 @@
+from sqlalchemy import inspect
+
+from qa327.models import db, upgrade_schema
+from qa327.backend import create_ticket
+
+"""
+This file tests the indexes declared on the models and the
+upgrade path for databases created before they existed.
+"""
+
+
+def ticket_indexes():
+    return {index['name']: index
+            for index in inspect(db.engine).get_indexes('ticket')}
+
+
+def test_ticket_indexes_exist():
+    indexes = ticket_indexes()
+    assert indexes['ix_ticket_name']['unique']
+    assert indexes['ix_ticket_expiration_date']['column_names'] == [
+        'expiration_date']
+    assert indexes['ix_ticket_by_date']['column_names'] == [
+        'expiration_date', 'id', 'price', 'quantity']
+    assert indexes['ix_ticket_by_price']['column_names'] == [
+        'price', 'id', 'expiration_date', 'quantity']
+    assert 'ix_ticket_available' not in indexes
+
+
+def test_upgrade_schema_adds_missing_index():
+    db.session.remove()
+    db.engine.execute('DROP INDEX ix_ticket_by_price')
+    # pooled SQLite connections cache the schema they last saw
+    db.engine.dispose()
+    assert 'ix_ticket_by_price' not in ticket_indexes()
+
+    upgrade_schema()
+
+    assert 'ix_ticket_by_price' in ticket_indexes()
+
+
+def test_upgrade_schema_drops_replaced_index():
+    db.session.remove()
+    db.engine.execute('CREATE INDEX ix_ticket_available '
+                      'ON ticket (expiration_date, quantity)')
+    db.engine.dispose()
+
+    upgrade_schema()
+
+    assert 'ix_ticket_available' not in ticket_indexes()
+
+
+def test_duplicate_ticket_name_rejected():
+    create_ticket('duplicatename', 10, 10, '20771210')
+    assert create_ticket('duplicatename', 10, 10, '20771210') == \
+        "A ticket with that name already exists."
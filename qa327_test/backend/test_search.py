@@ -0,0 +1,46 @@
+import uuid
+
+from qa327 import app
+from qa327.backend import create_ticket, search_tickets
+from qa327.models import db
+
+"""
+This file tests the ticket name search behind /search.
+"""
+
+
+def test_prefix_search_ranks_closest_first():
+    stem = 'srch' + uuid.uuid4().hex[:8]
+    for suffix in ('abc', '', 'a', 'zz'):
+        create_ticket(stem + suffix, 10, 10, '20771210')
+    create_ticket(stem + 'old', 10, 10, '20000101')
+
+    names = [ticket.name for ticket in search_tickets(stem)]
+    assert names == [stem, stem + 'a', stem + 'zz', stem + 'abc']
+
+    # case and anything but letters and digits are ignored
+    assert [t.name for t in search_tickets(stem.upper() + ' A', 5)] == \
+        [stem + 'a', stem + 'abc']
+    assert len(search_tickets(stem, limit=2)) == 2
+    assert search_tickets('') == []
+    assert search_tickets(stem + 'nothing') == []
+
+
+def test_search_uses_the_name_index():
+    plan = db.session.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM ticket "
+        "WHERE name >= 'ab' COLLATE NOCASE AND name < 'ac' COLLATE NOCASE").fetchall()
+    assert 'ix_ticket_name_nocase' in str(plan)
+
+
+def test_search_endpoint():
+    name = 'srch' + uuid.uuid4().hex[:8]
+    create_ticket(name, 7, 15, '20771210')
+
+    client = app.test_client()
+    assert client.get('/search?q=' + name).status_code == 302
+    client.post('/login', data={'email': 'tester0@gmail.com',
+                                'password': 'Password123'})
+    result = client.get('/search?q=' + name[:-2] + '&limit=abc').get_json()
+    assert result['tickets'][0] == {
+        'name': name, 'quantity': 7, 'price': 15, 'date': '20771210'}
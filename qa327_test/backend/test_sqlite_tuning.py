@@ -0,0 +1,58 @@
+import os
+import tempfile
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+
+from qa327.sqlite_tuning import SingleWriter, engine_options, install, pragmas
+
+"""
+This file tests the SQLite performance profile on its own engine,
+so the database the rest of the tests use is left alone.
+"""
+
+
+def test_pragmas_applied_on_connect():
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine('sqlite:///' + os.path.join(folder, 'tuned.sqlite'),
+                               **engine_options({}))
+        install(engine, pragmas({'SQLITE_BUSY_TIMEOUT_MS': '1234'}))
+
+        with engine.connect() as connection:
+            assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+            # NORMAL
+            assert connection.execute('PRAGMA synchronous').scalar() == 1
+            assert connection.execute('PRAGMA busy_timeout').scalar() == 1234
+        engine.dispose()
+
+
+def test_single_writer_runs_writes_in_order_on_one_thread():
+    writer = SingleWriter()
+    threads_used = set()
+    order = []
+
+    def write(number):
+        threads_used.add(threading.current_thread().name)
+        order.append(number)
+        return number * 2
+
+    results = []
+    callers = [threading.Thread(target=lambda n=n: results.append(writer.call(write, n)))
+               for n in range(20)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+
+    assert threads_used == {'sqlite-writer'}
+    assert sorted(order) == list(range(20))
+    assert sorted(results) == [n * 2 for n in range(20)]
+
+
+def test_single_writer_raises_errors_in_caller():
+    def fail():
+        raise ValueError('bad write')
+
+    with pytest.raises(ValueError):
+        SingleWriter().call(fail)
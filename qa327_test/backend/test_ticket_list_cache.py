@@ -0,0 +1,70 @@
+import uuid
+
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from qa327 import app
+import qa327.backend as bn
+from qa327.frontend import render_ticket_list, ticket_list_cache
+
+"""
+This file tests the catalogue version and the ticket list cache keyed on it.
+"""
+
+
+def test_ticket_writes_bump_catalogue_version():
+    name = 'v' + uuid.uuid4().hex[:12]
+    version = bn.get_catalogue_version()
+
+    bn.create_ticket(name, 10, 10, '20771210')
+    assert bn.get_catalogue_version() == version + 1
+
+    bn.update_ticket(name, 5, 10, '20771210')
+    assert bn.get_catalogue_version() == version + 2
+
+    # a failed write changes nothing
+    bn.create_ticket(name, 10, 10, '20771210')
+    assert bn.get_catalogue_version() == version + 2
+
+
+def test_version_bump_commits_with_the_write():
+    name = 'v' + uuid.uuid4().hex[:12]
+    version = bn.get_catalogue_version()
+    heard = []
+    bn.catalogue_listeners.append(lambda: heard.append(name))
+    try:
+        # a bump that fails takes the write with it, so no cached list or
+        # ETag can outlive a change it does not show
+        with patch('qa327.backend.bump_catalogue_version',
+                   side_effect=OperationalError('UPDATE', {}, Exception())):
+            assert bn.create_ticket(name, 10, 10, '20771210') is not None
+        assert bn.get_ticket(name) is None
+        assert bn.get_catalogue_version() == version
+        assert heard == []
+
+        assert bn.create_ticket(name, 10, 10, '20771210') is None
+        assert heard == [name]
+        assert bn.get_catalogue_version() == version + 1
+    finally:
+        bn.catalogue_listeners.pop()
+
+
+def test_ticket_list_rendered_once_per_version():
+    ticket_list_cache.clear()
+    with patch('qa327.backend.get_all_tickets', wraps=bn.get_all_tickets) as listing:
+        with app.test_request_context('/'):
+            first = render_ticket_list(bn.get_catalogue_version())
+            assert render_ticket_list(bn.get_catalogue_version()) == first
+        assert listing.call_count == 1
+
+        name = 'v' + uuid.uuid4().hex[:12]
+        bn.create_ticket(name, 10, 10, '20771210')
+        with app.test_request_context('/'):
+            render_ticket_list(bn.get_catalogue_version())
+        assert listing.call_count == 2
+
+        # other pages are cached separately
+        with app.test_request_context('/?after=20771210-1'):
+            render_ticket_list(bn.get_catalogue_version())
+        assert listing.call_count == 3
@@ -0,0 +1,104 @@
+import uuid
+from datetime import date, timedelta
+
+from qa327 import app
+from qa327.backend import create_ticket, decode_cursor, get_all_tickets
+
+"""
+This file tests the keyset pagination of get_all_tickets by walking
+the whole listing forwards and backwards a few tickets at a time.
+"""
+
+
+def walk(page_size, backwards=False):
+    seen = []
+    page = get_all_tickets(page_size=page_size, backwards=backwards)
+    while True:
+        assert len(page.tickets) <= page_size
+        if backwards:
+            seen = page.tickets + seen
+            cursor = page.prev_cursor
+        else:
+            seen = seen + page.tickets
+            cursor = page.next_cursor
+        if cursor is None:
+            return seen
+        page = get_all_tickets(cursor, page_size, backwards)
+
+
+def test_pages_cover_listing_in_order():
+    for day in ('20771210', '20771209', '20771211', '20771209'):
+        create_ticket('p' + uuid.uuid4().hex[:12], 10, 10, day)
+
+    tickets = walk(3)
+    keys = [(t.expiration_date, t.id) for t in tickets]
+
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+    assert len(keys) == len(get_all_tickets(page_size=10 ** 6).tickets)
+
+
+def test_prev_page_returns_to_previous_tickets():
+    first = get_all_tickets(page_size=2)
+    second = get_all_tickets(first.next_cursor, 2)
+    back = get_all_tickets(second.prev_cursor, 2, backwards=True)
+
+    assert [t.id for t in back.tickets] == [t.id for t in first.tickets]
+
+
+def test_invalid_cursor_starts_from_first_page():
+    assert decode_cursor('nonsense') is None
+    assert [t.id for t in get_all_tickets('nonsense', 2).tickets] == \
+        [t.id for t in get_all_tickets(page_size=2).tickets]
+
+
+def walk_filtered(page_size, backwards=False, **filters):
+    seen = []
+    page = get_all_tickets(page_size=page_size, backwards=backwards, **filters)
+    while True:
+        seen = page.tickets + seen if backwards else seen + page.tickets
+        cursor = page.prev_cursor if backwards else page.next_cursor
+        if cursor is None:
+            return seen
+        page = get_all_tickets(cursor, page_size, backwards, **filters)
+
+
+def test_filters_and_sorts():
+    today = date.today()
+    for offset, price, quantity in ((0, 12, 5), (2, 45, 1), (2, 30, 9),
+                                    (9, 30, 0), (40, 99, 3), (-1, 20, 5)):
+        day = (today + timedelta(days=offset)).strftime('%Y%m%d')
+        create_ticket('f' + uuid.uuid4().hex[:12], quantity, price, day)
+
+    everything = get_all_tickets(page_size=10 ** 6).tickets
+    # a ticket expiring later this year is listed, the expired one is not
+    assert all(t.expiration_date >= today for t in everything)
+    assert any(t.expiration_date == today + timedelta(days=2) for t in everything)
+
+    filters = {'min_price': 20, 'max_price': 45, 'min_quantity': 1,
+               'expires_to': today + timedelta(days=10)}
+    expected = [t for t in everything if 20 <= t.price <= 45 and t.quantity >= 1
+                and t.expiration_date <= filters['expires_to']]
+    for sort, key, reverse in (('date', 'expiration_date', False),
+                               ('date_desc', 'expiration_date', True),
+                               ('price', 'price', False),
+                               ('price_desc', 'price', True)):
+        ordered = sorted(expected, key=lambda t: (getattr(t, key), t.id),
+                         reverse=reverse)
+        for backwards in (False, True):
+            tickets = walk_filtered(2, backwards, sort=sort, **filters)
+            assert [t.id for t in tickets] == [t.id for t in ordered]
+
+
+def test_profile_page_filters():
+    cheap, dear = 'f' + uuid.uuid4().hex[:12], 'f' + uuid.uuid4().hex[:12]
+    create_ticket(cheap, 10, 11, '20771210')
+    create_ticket(dear, 10, 99, '20771210')
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'tester0@gmail.com',
+                                'password': 'Password123'})
+    html = client.get('/?max_price=11&sort=price_desc&min_price=oops').data.decode()
+    assert cheap in html and dear not in html
+    html = client.get('/?min_price=99&expires_from=20771210&expires_to=20771210').data.decode()
+    assert dear in html and cheap not in html
@@ -0,0 +1,64 @@
+import time
+import uuid
+
+from qa327.cache import LRUCache
+from qa327.models import db, User
+from qa327.backend import create_ticket, get_user, get_user_by_id, invalidate_user, purchase_ticket, register_user
+
+"""
+This file tests the user cache behind get_user_by_id.
+"""
+
+
+def make_user():
+    email = 'cached{}@test.com'.format(uuid.uuid4().hex[:8])
+    register_user(email, 'Cached', 'Password123!', 'Password123!')
+    return get_user(email)
+
+
+def set_balance(user_id, balance):
+    User.query.filter_by(id=user_id).update({'balance': balance})
+    db.session.commit()
+
+
+def test_cached_user_until_invalidated():
+    user = make_user()
+    assert get_user_by_id(user.id).balance == 5000
+
+    # a change the cache was not told about is not seen yet
+    set_balance(user.id, 10)
+    assert get_user_by_id(user.id).balance == 5000
+
+    invalidate_user(user.id)
+    assert get_user_by_id(user.id).balance == 10
+
+
+def test_purchase_invalidates_buyer():
+    user = make_user()
+    name = 'c' + uuid.uuid4().hex[:12]
+    create_ticket(name, 10, 10, '20771210')
+
+    assert get_user_by_id(user.id).balance == 5000
+    assert purchase_ticket(get_user_by_id(user.id), name, 1) is None
+    assert get_user_by_id(user.id).balance == 5000 - 15
+
+
+def test_unknown_or_legacy_session_value():
+    assert get_user_by_id(10 ** 9) is None
+    assert get_user_by_id('tester0@gmail.com') is None
+
+
+def test_lru_cache_evicts_and_expires():
+    cache = LRUCache(maxsize=2, ttl=0.05)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    # b was the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    assert cache.get('c') is None
@@ -0,0 +1,36 @@
+from qa327.utils import parse_ticket_date, validate_password, validate_ticket_date, validate_tickets_batch
+
+"""
+This file tests the validators that were rewritten to avoid exceptions
+and repeated passes over the input.
+"""
+
+
+def test_parse_ticket_date():
+    assert parse_ticket_date('20771210') == (2077, 12, 10)
+    assert parse_ticket_date('20240229') == (2024, 2, 29)
+    for bad in ('20230229', '20201301', '20201232', '2077-12-10', '2077121', '', None, '00000101'):
+        assert parse_ticket_date(bad) is None
+        assert validate_ticket_date(bad) == "Date must be in the format YYYYMMDD."
+
+
+def test_validate_password_messages():
+    assert validate_password('Pass1') == "Password must be at least 6 characters long."
+    assert validate_password('password1') == "Password must have at least one uppercase character."
+    assert validate_password('PASSWORD1') == "Password must have at least one lowercase character."
+    assert validate_password('Passwords') == "Password must have at least one special character."
+    assert validate_password('Password123') is False
+
+
+def test_validate_tickets_batch_reports_bad_rows():
+    rows = [
+        ('t1', '10', '20', '20771210'),
+        ('bad!', '10', '20', '20771210'),
+        ('t3', '0', '20', '20771210'),
+        ('t4', '10', '20', '20771310'),
+    ]
+    assert validate_tickets_batch(rows) == [
+        (1, "Name must have alphanumeric characters only."),
+        (2, "Quantity must be between 1 and 100."),
+        (3, "Date must be in the format YYYYMMDD."),
+    ]
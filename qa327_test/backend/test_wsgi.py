@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+
+from qa327 import app
+from qa327.wsgi import _post_fork, options, warm_up
+
+"""
+This file tests the gunicorn settings of the production server.
+"""
+
+
+def test_options_from_settings(monkeypatch):
+    monkeypatch.setenv('WEB_WORKERS', '3')
+    monkeypatch.setenv('WEB_THREADS', '8')
+    monkeypatch.setenv('WEB_MAX_REQUESTS', '1000')
+    settings = options(9000)
+
+    assert settings['bind'] == '0.0.0.0:9000'
+    assert settings['worker_class'] == 'gthread'
+    assert settings['workers'] == 3
+    assert settings['threads'] == 8
+    assert settings['max_requests'] == 1000
+    assert settings['max_requests_jitter'] == 100
+    assert settings['post_fork'] is _post_fork
+    # workers import the app themselves, so a SIGHUP deploys new code
+    assert settings['preload_app'] is False
+
+
+def test_options_defaults(monkeypatch):
+    for name in ('WEB_THREADS', 'WEB_KEEPALIVE', 'WEB_TIMEOUT',
+                 'WEB_GRACEFUL_TIMEOUT', 'WEB_MAX_REQUESTS'):
+        monkeypatch.delenv(name, raising=False)
+    settings = options(8081)
+
+    assert settings['threads'] == 4
+    assert settings['keepalive'] == 5
+    assert settings['timeout'] == 30
+    assert settings['graceful_timeout'] == 30
+    # workers are never recycled unless asked to
+    assert settings['max_requests'] == 0
+    assert settings['max_requests_jitter'] == 0
+
+
+def cached_templates(jinja_env):
+    return sorted(name for _, name in jinja_env.cache.keys())
+
+
+def test_workers_warm_up(monkeypatch):
+    monkeypatch.setenv('WEB_THREADS', '2')
+    app.jinja_env.cache.clear()
+    warm_up()
+    # the first request compiles no template
+    assert cached_templates(app.jinja_env) == sorted(app.jinja_env.list_templates())
+
+
+def test_forked_worker_runs_the_code_on_disk(tmp_path):
+    # the hook gunicorn calls in a new worker, run in a process of its own
+    # since it replaces the qa327 modules
+    script = '''
+import json, sys
+import qa327.wsgi as master
+master._post_fork(None, None)
+worker = sys.modules['qa327.wsgi']
+print(json.dumps({
+    'fresh': worker is not master and worker.app is not master.app,
+    'templates': sorted(name for _, name in worker.app.jinja_env.cache.keys()),
+}))
+'''
+    env = dict(os.environ, WEB_THREADS='2',
+               DB_NAME=str(tmp_path / 'worker.sqlite').lstrip('/'))
+    env.pop('db_string', None)
+    result = subprocess.run([sys.executable, '-c', script], env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    worker = json.loads(result.stdout.splitlines()[-1])
+
+    assert worker['fresh']
+    assert worker['templates'] == sorted(app.jinja_env.list_templates())
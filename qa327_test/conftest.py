@@ -8,11 +8,15 @@ from qa327.__main__ import FLASK_PORT
 from qa327.__main__ import app
 import threading
 from werkzeug.serving import make_server
-from qa327.backend import get_user, get_ticket, register_user, create_ticket
+from qa327.backend import get_user, get_ticket, invalidate_user, register_user, create_ticket, update_ticket
+from qa327.models import db, User
 
 
 base_url = 'http://localhost:{}'.format(FLASK_PORT)
 
+# every test logs in from the same address, test_ratelimit.py turns it on
+app.config['RATE_LIMIT'] = False
+
 
 class ServerThread(threading.Thread):
 
@@ -46,9 +50,20 @@ def server():
 
 @pytest.fixture(autouse=True)
 def run_around_tests():
-    if get_user('tester0@gmail.com') is None:
+    # /buy really takes stock and balance, so every test starts from the
+    # same t1 and the same balance whatever the tests before it bought
+    db.session.remove()
+    user = get_user('tester0@gmail.com')
+    if user is None:
         register_user('tester0@gmail.com', 'Tester Zero',
                       'Password123', 'Password123')
+    elif user.balance != 5000:
+        User.query.filter_by(id=user.id).update({User.balance: 5000})
+        db.session.commit()
+        invalidate_user(user.id)
 
-    if get_ticket('t1') is None:
+    ticket = get_ticket('t1')
+    if ticket is None:
         create_ticket('t1', 50, 70.50, '20771210')
+    elif ticket.quantity != 50:
+        update_ticket('t1', 50, 70.50, '20771210')